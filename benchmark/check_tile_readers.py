@@ -0,0 +1,116 @@
+import argparse
+import numpy as np
+import openslide
+import os
+import shutil
+import sys
+import tempfile
+
+from openslide import deepzoom
+
+# The check imports PyHIST from the root of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmark.synthetic_slide import write_synthetic_slide
+from src import tile_reader
+
+
+# Maximum difference per channel allowed between the tiles of each reader and the
+# tiles of the deepzoom reader (see the documentation of each reader)
+TOLERANCE = {"native": 0, "region": 0}
+
+
+def check_reader(slide, reader_name, patch_size, downsample):
+    """Compares the tiles of a reader with the tiles of the deepzoom reader.
+
+    Args:
+        slide: OpenSlide object.
+        reader_name: String with the reader to check (see --tile-reader in PyHIST).
+        patch_size: Integer with the size of the tiles.
+        downsample: Output downsampling factor.
+
+    Returns:
+        max_diff: Largest difference per channel between the tiles of both readers,
+            or None if the size of some tile differs.
+        n_tiles: Number of compared tiles.
+    """
+
+    dzg = deepzoom.DeepZoomGenerator(slide, tile_size=patch_size, overlap=0)
+    dzg_levels = [2**i for i in range(0, dzg.level_count)][::-1]
+    dzg_level = dzg_levels.index(downsample)
+    cols, rows = dzg.level_tiles[dzg_level]
+
+    reference = tile_reader.build_tile_reader(slide, {"tile_reader": "deepzoom", "patch_size": patch_size,
+                                                      "dzg_level": dzg_level})
+    reader = tile_reader.build_tile_reader(slide, {
+        "tile_reader": reader_name,
+        "patch_size": patch_size,
+        "dzg_level": dzg_level,
+        "output_downsample": downsample,
+        "level_dims": dzg.level_dimensions[dzg_level],
+        "band_height": 8 * patch_size
+    })
+
+    # Tiles are read in row order, as required by the region reader
+    max_diff = 0
+    for row in range(rows):
+        for col in range(cols):
+            expected = np.asarray(reference.get_tile(col, row), dtype=int)
+            tile = np.asarray(reader.get_tile(col, row), dtype=int)
+            if tile.shape != expected.shape:
+                return None, row * cols + col + 1
+            max_diff = max(max_diff, int(np.abs(tile - expected).max()))
+
+    return max_diff, rows * cols
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='''Checks that the tiles of each PyHIST tile reader match the tiles of
+        the deepzoom reader within the tolerance of the reader. A synthetic slide is
+        generated unless slides are given. Exits with an error if a check fails.''')
+    parser.add_argument("--slides", nargs="+", default=None,
+                        help="Slides to check. (default: a synthetic slide)")
+    parser.add_argument("--size", default="4003x3001",
+                        help="Size of the synthetic slide at level 0, as WIDTHxHEIGHT. (default: 4003x3001)")
+    parser.add_argument("--readers", nargs="+", default=sorted(TOLERANCE), choices=sorted(TOLERANCE),
+                        help="Tile readers to check. (default: all)")
+    parser.add_argument("--patch-size", type=int, default=64, help="Size of the tiles. (default: 64)")
+    parser.add_argument("--output-downsample", type=int, nargs="+", default=[1, 2, 8],
+                        help="Output downsampling factors to check. (default: 1 2 8)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pyhist_readers_")
+    failed = False
+    try:
+        slides = args.slides
+        if slides is None:
+            width, height = [int(x) for x in args.size.lower().split("x")]
+            slides = [os.path.join(workdir, "synthetic_" + args.size + ".tif")]
+            write_synthetic_slide(slides[0], width, height, 0.3)
+
+        for slide_path in slides:
+            slide = openslide.OpenSlide(slide_path)
+            for downsample in args.output_downsample:
+                for reader_name in args.readers:
+                    max_diff, n_tiles = check_reader(slide, reader_name, args.patch_size, downsample)
+                    if max_diff is None:
+                        status = "FAIL (size of tile " + str(n_tiles - 1) + " differs)"
+                        failed = True
+                    elif max_diff > TOLERANCE[reader_name]:
+                        status = "FAIL (tolerance " + str(TOLERANCE[reader_name]) + ")"
+                        failed = True
+                    else:
+                        status = "ok"
+                    print(os.path.basename(slide_path) + "\t" + str(downsample) + "x\t" + reader_name + "\t" +
+                          str(n_tiles) + " tiles\tmax diff " + str(max_diff) + "\t" + status)
+            slide.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
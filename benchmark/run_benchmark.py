@@ -0,0 +1,164 @@
+import argparse
+import datetime
+import json
+import logging
+import openslide
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+
+# The benchmark runs PyHIST from the root of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmark.synthetic_slide import write_synthetic_slide
+from src import parser_input, utility_functions
+from src.slide import PySlide, TileGenerator
+
+
+def run_pyhist(slide_path, method, pyhist_args, output_dir):
+    """Runs PyHIST end to end over a slide, collecting the metrics of each stage.
+
+    Args:
+        slide_path: Path to the slide.
+        method: String with the tile generation method.
+        pyhist_args: List with additional PyHIST arguments.
+        output_dir: Path to the output folder.
+
+    Returns:
+        result: Dictionary with the total time, the metrics of each stage
+            (see --save-metrics in PyHIST) and the number of saved tiles.
+    """
+
+    parser = parser_input.build_parser()
+    args = parser.parse_args(["--method", method, "--output", output_dir, "--info", "silent"] + pyhist_args + [slide_path])
+    parser_input.check_arguments(args)
+
+    ts = time.perf_counter()
+    slide = PySlide(vars(args))
+    tile_generator = TileGenerator(slide)
+    tile_generator.execute()
+    utility_functions.clean(slide)
+    total = time.perf_counter() - ts
+
+    report = tile_generator.metrics.report()
+    return {"total": round(total, 4), "stages": report["stages"], "counters": report["counters"],
+            "n_tiles": report["counters"]["tiles_saved"]}
+
+
+def git_commit():
+    """Commit of the PyHIST repository, if available."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, results):
+    """Prints the change of the total time of each configuration with respect to a previous benchmark.
+
+    Args:
+        baseline_path: Path to the JSON file of a previous benchmark.
+        results: Dictionary with the results of the current benchmark.
+    """
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def summarize(runs):
+        summary = defaultdict(list)
+        for run in runs:
+            summary[(run["slide"], run["method"])].append(run["total"])
+        return {k: min(v) for k, v in summary.items()}
+
+    before = summarize(baseline["runs"])
+    after = summarize(results["runs"])
+
+    print("slide\tmethod\tbaseline_s\tcurrent_s\tratio")
+    for key in sorted(after):
+        if key in before:
+            print(key[0] + "\t" + key[1] + "\t" + str(before[key]) + "\t" + str(after[key]) + "\t" +
+                  str(round(after[key] / before[key], 3)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='''Benchmarks the PyHIST tile generation methods over synthetic slides. Slides
+        are generated for each combination of size and tissue fraction, and each method
+        is run end to end, measuring the time spent in each stage of the pipeline.''')
+    parser.add_argument("--sizes", nargs="+", default=["8000x6000"],
+                        help="Slide sizes at level 0, as WIDTHxHEIGHT. (default: 8000x6000)")
+    parser.add_argument("--tissue-fractions", nargs="+", type=float, default=[0.3],
+                        help="Fractions of the slide covered by tissue. (default: 0.3)")
+    parser.add_argument("--methods", nargs="+", default=["randomsampling", "graph", "otsu", "adaptive"],
+                        choices=["randomsampling", "graph", "otsu", "adaptive"],
+                        help="Tile generation methods to benchmark. (default: all)")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs of each method. (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic slides. (default: 0)")
+    parser.add_argument("--slide-dir", default=None,
+                        help="Folder to keep the synthetic slides, so that they are reused across benchmarks. (default: temporary folder)")
+    parser.add_argument("--output", default="benchmark.json", help="Path to the output JSON file. (default: benchmark.json)")
+    parser.add_argument("--compare", default=None, metavar="BASELINE",
+                        help="JSON file of a previous benchmark to compare against.")
+    parser.add_argument("--pyhist-args", default="--patch-size 128 --output-downsample 2 --save-patches --npatches 200",
+                        help="Additional PyHIST arguments, as a single string. (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    os.chdir(REPO_DIR)
+
+    workdir = tempfile.mkdtemp(prefix="pyhist_benchmark_")
+    slide_dir = args.slide_dir if args.slide_dir is not None else workdir
+    os.makedirs(slide_dir, exist_ok=True)
+    pyhist_args = args.pyhist_args.split()
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "openslide": openslide.__library_version__,
+        "pyhist_args": pyhist_args,
+        "seed": args.seed,
+        "runs": []
+    }
+
+    try:
+        for size in args.sizes:
+            width, height = [int(x) for x in size.lower().split("x")]
+            for tissue_fraction in args.tissue_fractions:
+                slide_name = "synthetic_" + str(width) + "x" + str(height) + "_" + str(tissue_fraction) + "_" + str(args.seed)
+                slide_path = os.path.join(slide_dir, slide_name + ".tif")
+                if not os.path.exists(slide_path):
+                    print("Writing " + slide_path, file=sys.stderr)
+                    write_synthetic_slide(slide_path, width, height, tissue_fraction, seed=args.seed)
+
+                for method in args.methods:
+                    for repeat in range(args.repeats):
+                        output_dir = os.path.join(workdir, "output")
+                        result = run_pyhist(slide_path, method, pyhist_args, output_dir)
+                        shutil.rmtree(output_dir)
+
+                        result.update({"slide": slide_name, "width": width, "height": height,
+                                       "tissue_fraction": tissue_fraction, "method": method, "repeat": repeat})
+                        results["runs"].append(result)
+                        print(slide_name + "\t" + method + "\t" + str(repeat) + "\t" + str(result["total"]) + "s", file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import cv2
+import numpy as np
+
+
+def tissue_field(width, height, seed, grid=16):
+    """Builds the smooth random field that defines the tissue regions of a synthetic slide.
+
+    Args:
+        width, height: Dimensions of the slide at level 0.
+        seed: Integer with the random seed.
+        grid: Number of control points of the field along each dimension.
+
+    Returns:
+        field: Function that evaluates the field at level 0 coordinates (x, y).
+    """
+
+    rng = np.random.default_rng(seed)
+    control = rng.random((grid, grid)).astype(np.float32)
+
+    # Tissue is more likely towards the centre of the slide, as in a real slide
+    yy, xx = np.mgrid[0:grid, 0:grid] / (grid - 1) - 0.5
+    control -= (xx**2 + yy**2).astype(np.float32)
+
+    def field(x, y):
+        # Bilinear interpolation of the control points
+        gx = np.clip(x / width * (grid - 1), 0, grid - 1.001)
+        gy = np.clip(y / height * (grid - 1), 0, grid - 1.001)
+        x0, y0 = gx.astype(int), gy.astype(int)
+        fx, fy = gx - x0, gy - y0
+        return (control[y0, x0] * (1 - fx) * (1 - fy) + control[y0, x0 + 1] * fx * (1 - fy) +
+                control[y0 + 1, x0] * (1 - fx) * fy + control[y0 + 1, x0 + 1] * fx * fy)
+
+    return field
+
+
+def tissue_threshold(field, width, height, tissue_fraction, samples=512):
+    """Finds the value of the field above which the requested fraction of the slide is tissue.
+
+    Args:
+        field: Function returned by tissue_field.
+        width, height: Dimensions of the slide at level 0.
+        tissue_fraction: Float [0-1] with the fraction of the slide covered by tissue.
+        samples: Number of samples of the field along each dimension.
+
+    Returns:
+        _: Float with the threshold.
+    """
+
+    y, x = np.mgrid[0:samples, 0:samples].astype(np.float32)
+    values = field(x * width / samples, y * height / samples)
+    return float(np.quantile(values, 1 - tissue_fraction))
+
+
+def render_tile(field, threshold, x0, y0, tile_size, downsample, seed):
+    """Renders a tile of a level of a synthetic slide.
+
+    Tissue is drawn in pink and purple tones with a cell-like texture, and
+    the background is a noisy light gray.
+
+    Args:
+        field: Function returned by tissue_field.
+        threshold: Float with the threshold returned by tissue_threshold.
+        x0, y0: Coordinates of the top left corner of the tile in the level.
+        tile_size: Integer with the size of the tile.
+        downsample: Downsampling factor of the level.
+        seed: Integer with the random seed of the tile.
+
+    Returns:
+        tile: (tile_size, tile_size, 3) uint8 numpy array.
+    """
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:tile_size, 0:tile_size].astype(np.float32)
+    tissue = field((x0 + x) * downsample, (y0 + y) * downsample) > threshold
+
+    tile = np.empty((tile_size, tile_size, 3), dtype=np.uint8)
+    tile[...] = (235 + rng.integers(-6, 6, (tile_size, tile_size, 1))).astype(np.uint8)
+
+    # Dark blobs (nuclei) over a pink stroma
+    stroma = np.array([225, 150, 200]) + rng.integers(-25, 25, (tile_size, tile_size, 1))
+    nuclei = cv2.GaussianBlur(rng.random((tile_size, tile_size)).astype(np.float32), (0, 0), 2) > 0.52
+    stroma[nuclei] = np.array([110, 60, 150]) + rng.integers(-20, 20, (int(nuclei.sum()), 1))
+    tile[tissue] = stroma[tissue].clip(0, 255).astype(np.uint8)
+
+    return tile
+
+
+def write_synthetic_slide(path, width, height, tissue_fraction, seed=0, tile_size=256,
+                          downsamples=(1, 4, 16), compression="zlib"):
+    """Writes a synthetic pyramidal TIFF slide that can be read with OpenSlide.
+
+    The slide is generated tile by tile, so that slides larger than the
+    available memory can be produced. Each level of the pyramid is rendered
+    from the same tissue regions at its own resolution.
+
+    Args:
+        path: Path to the output TIFF file.
+        width, height: Dimensions of the slide at level 0.
+        tissue_fraction: Float [0-1] with the fraction of the slide covered by tissue.
+        seed: Integer with the random seed. The same seed produces the same slide.
+        tile_size: Integer with the size of the TIFF tiles.
+        downsamples: Downsampling factors of the levels of the pyramid.
+        compression: TIFF compression (e.g. zlib, or jpeg if imagecodecs is installed).
+    """
+
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError("The tifffile package is required to write synthetic slides.")
+
+    field = tissue_field(width, height, seed)
+    threshold = tissue_threshold(field, width, height, tissue_fraction)
+
+    def tiles(level_width, level_height, downsample, level):
+        for y0 in range(0, level_height, tile_size):
+            for x0 in range(0, level_width, tile_size):
+                tile_seed = [seed, level, y0, x0]
+                yield render_tile(field, threshold, x0, y0, tile_size, downsample, tile_seed)
+
+    with tifffile.TiffWriter(path, bigtiff=width * height * 3 > 2**31) as tif:
+        for level, downsample in enumerate(downsamples):
+            level_width, level_height = -(-width // downsample), -(-height // downsample)
+            tif.write(tiles(level_width, level_height, downsample, level), shape=(level_height, level_width, 3),
+                      dtype=np.uint8, tile=(tile_size, tile_size), photometric="rgb", compression=compression,
+                      subfiletype=1 if level > 0 else 0, metadata=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic pyramidal TIFF slide.")
+    parser.add_argument("output", help="Path to the output TIFF file.")
+    parser.add_argument("--width", type=int, default=20000, help="Width of the slide at level 0.")
+    parser.add_argument("--height", type=int, default=15000, help="Height of the slide at level 0.")
+    parser.add_argument("--tissue-fraction", type=float, default=0.3, help="Fraction of the slide covered by tissue.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--compression", default="zlib", help="TIFF compression (e.g. zlib, or jpeg with imagecodecs).")
+    args = parser.parse_args()
+
+    write_synthetic_slide(args.output, args.width, args.height, args.tissue_fraction,
+                          seed=args.seed, compression=args.compression)
@@ -3,30 +3,53 @@ import openslide
 import os
 import sys
 
-from src import utility_functions, parser_input
+from src import batch, server, utility_functions, parser_input
 from src.slide import PySlide, TileGenerator
 
 
 def main():
     
+    # Batch and server modes are requested with "batch" or "serve" as the first argument
+    argv = sys.argv[1:]
+    batch_mode = len(argv) > 0 and argv[0] == "batch"
+    serve_mode = len(argv) > 0 and argv[0] == "serve"
+    if batch_mode or serve_mode:
+        argv = argv[1:]
+
     # Read parser arguments
-    parser = parser_input.build_parser()
+    if serve_mode:
+        parser = parser_input.build_serve_parser()
+    else:
+        parser = parser_input.build_parser(batch=batch_mode)
 
-    if len(sys.argv) == 1:
+    if len(argv) == 0 and not serve_mode:
         parser.print_help()
         sys.exit(1)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Configure logger
     loglevel = {"default": logging.INFO, "verbose": logging.DEBUG, "silent": logging.CRITICAL}
     logging.basicConfig(level=loglevel[args.info], format='%(asctime)s [%(levelname)s]: %(message)s', datefmt="%d-%m-%Y %H:%M:%S")
 
+    # Process the jobs received by the server until it is stopped
+    if serve_mode:
+        parser_input.check_serve_arguments(args)
+        server.serve(args)
+        return
+
     # Checking correct arguments and compilation of segmentation algorithm
     parser_input.check_arguments(args)
-    utility_functions.check_image(args.svs)
+
+
+    # Process many slides in batch mode
+    if batch_mode:
+        summary = batch.run_batch(args)
+        sys.exit(int((summary["Status"] == "failed").any()))
+
+    openslide_slide = utility_functions.check_image(args.svs)
 
     # Extract tiles
-    slide = PySlide(vars(args))
+    slide = PySlide(vars(args), slide=openslide_slide)
     tile_extractor = TileGenerator(slide)
     tile_extractor.execute()
 
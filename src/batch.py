@@ -0,0 +1,165 @@
+import concurrent.futures
+import copy
+import glob
+import logging
+import openslide
+import os
+import pandas as pd
+import time
+import traceback
+
+from src import utility_functions
+from src.slide import PySlide, TileGenerator
+
+
+def collect_slides(source):
+    """Collects the slides to process in batch mode.
+
+    Args:
+        source: String with either a directory (all the slides that OpenSlide
+            can read inside it are used), a manifest file (a text file with one
+            slide path per line; empty lines and lines starting with # are
+            ignored) or a glob pattern.
+
+    Returns:
+        slides: List of strings with the paths to the slides.
+    """
+
+    if os.path.isdir(source):
+        candidates = sorted(os.path.join(source, x) for x in os.listdir(source))
+        slides = [x for x in candidates if os.path.isfile(x) and openslide.OpenSlide.detect_format(x) is not None]
+    elif os.path.isfile(source) and openslide.OpenSlide.detect_format(source) is None:
+        slides = []
+        manifest_dir = os.path.dirname(source)
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+
+                # Only the first column is used in tab-separated manifests,
+                # and relative paths are relative to the manifest
+                path = line.split("\t")[0]
+                slides.append(os.path.join(manifest_dir, path))
+    else:
+        slides = sorted(glob.glob(source))
+
+    return slides
+
+
+def process_slide(args):
+    """Runs the PyHIST pipeline over a single slide.
+
+    Any error is caught so that a failing slide does not stop the batch,
+    but KeyboardInterrupt is raised, so that the batch can be stopped.
+
+    Args:
+        args: Dictionary with the parsed arguments, where svs is the path to the slide.
+
+    Returns:
+        result: Dictionary with the slide path, the status (ok/failed),
+            the elapsed time, the error message, if any, and the metrics
+            of the pipeline (see PipelineMetrics.report), if it succeeded.
+    """
+
+    ts = time.time()
+    result = {"Slide": args["svs"], "Status": "ok", "Error": ""}
+
+    openslide_slide = None
+    try:
+        openslide_slide = utility_functions.check_image(args["svs"])
+        slide = PySlide(args, slide=openslide_slide)
+        tile_extractor = TileGenerator(slide)
+        tile_extractor.execute()
+        utility_functions.clean(slide)
+        result["Metrics"] = tile_extractor.metrics.report()
+    except (Exception, SystemExit) as e:
+        # SystemExit is raised by check_compilation when the segmentation
+        # executable cannot be built
+        logging.debug(traceback.format_exc())
+        result["Status"] = "failed"
+        result["Error"] = type(e).__name__ + ": " + str(e)
+    finally:
+        # Worker processes are reused for other slides
+        if openslide_slide is not None:
+            openslide_slide.close()
+
+    result["Elapsed"] = round(time.time() - ts, ndigits = 3)
+    logging.info("Processed " + args["svs"] + " (" + result["Status"] + ", " + str(result["Elapsed"]) + "s)")
+
+    return result
+
+
+def run_batch(args):
+    """Processes many slides with a pool of worker processes.
+
+    Each slide is processed independently with the same arguments. A summary
+    with the status of every slide is written to batch_summary.tsv in the
+    output folder.
+
+    Args:
+        args: Namespace with the parsed arguments, where svs is a directory,
+            manifest file or glob pattern with the slides to process.
+
+    Returns:
+        summary: Pandas DataFrame with one row per slide.
+    """
+
+    slides = collect_slides(args.svs)
+    if len(slides) == 0:
+        raise ValueError("No slides found in " + args.svs + ".")
+
+    logging.info("== Batch processing of " + str(len(slides)) + " slides with " + str(args.batch_workers) + " workers ==")
+
+    # The segmentation executable is checked once for the whole batch
+    if args.method in ["graph", "graphtestmode"]:
+        utility_functions.check_compilation()
+
+    # Slides are written to a folder named after the sample ID, so
+    # slides with a repeated ID would overwrite each other
+    results = [None] * len(slides)
+    jobs = {}
+    seen_ids = set()
+    for i, svs in enumerate(slides):
+        sample_id = os.path.splitext(os.path.basename(svs))[0]
+        if sample_id in seen_ids:
+            results[i] = {"Slide": svs, "Status": "failed", "Error": "Duplicated sample ID " + sample_id, "Elapsed": 0.0}
+            continue
+        seen_ids.add(sample_id)
+
+        job_args = copy.deepcopy(vars(args))
+        job_args["svs"] = svs
+        jobs[i] = job_args
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.batch_workers) as executor:
+        futures = {executor.submit(process_slide, job_args): i for i, job_args in jobs.items()}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    # The worker process died while processing the slide
+                    results[i] = {"Slide": slides[i], "Status": "failed",
+                                  "Error": type(e).__name__ + ": " + str(e), "Elapsed": 0.0}
+        except KeyboardInterrupt:
+            # Slides that did not start are cancelled, otherwise the pool would
+            # process them all before shutting down
+            for future in futures:
+                future.cancel()
+            raise
+
+    # Report the results in the same order as the input
+    summary = pd.DataFrame.from_records(results, columns=["Slide", "Status", "Elapsed", "Error"])
+
+    output = os.path.join(args.output, '')
+    if not os.path.exists(output):
+        os.makedirs(output)
+    summary.to_csv(output + "batch_summary.tsv", index=False, sep="\t")
+
+    n_failed = int((summary["Status"] == "failed").sum())
+    logging.info("== Batch finished: " + str(len(summary) - n_failed) + " slides processed, " + str(n_failed) + " failed ==")
+    for _, failure in summary[summary["Status"] == "failed"].iterrows():
+        logging.info("Failed: " + failure["Slide"] + " (" + failure["Error"] + ")")
+
+    return summary
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+
+
+class TilingCheckpoint:
+    """A checkpoint of the tile extraction of a slide, to resume interrupted runs.
+
+    The checkpoint is a JSON lines file. The first line describes the run
+    (grid geometry, output settings and a hash of the tile selection), and
+    each following line records a band of rows of the tile grid whose tiles
+    were all written, with the predictions and metadata of its tiles. Bands
+    are recorded in row order, so the completed rows are always the first
+    rows of the grid.
+
+    Attributes:
+        path: Path to the checkpoint file.
+        state: Dictionary describing the run. A checkpoint is only resumed
+            by a run with the same state.
+    """
+
+    def __init__(self, path, state):
+        """Inits TilingCheckpoint."""
+        self.path = path
+        self.state = state
+        self.__file = None
+
+
+    @staticmethod
+    def selection_hash(preds_grid):
+        """Hashes the tile selection, to detect checkpoints of a different selection.
+
+        Args:
+            preds_grid: 2-D numpy array with the tile selection predictions.
+
+        Returns:
+            _: String with the hexadecimal hash.
+        """
+        preds_grid = np.ascontiguousarray(preds_grid, dtype=np.uint8)
+        return hashlib.sha256(str(preds_grid.shape).encode() + preds_grid.tobytes()).hexdigest()
+
+
+    def load(self):
+        """Reads the bands recorded in the checkpoint.
+
+        A truncated last line, written when the run was interrupted, is ignored.
+
+        Returns:
+            bands: List with the record of each completed band. Empty if there is
+                no checkpoint, or if it belongs to a run with a different state.
+        """
+
+        if not os.path.isfile(self.path):
+            return []
+
+        with open(self.path) as f:
+            lines = f.read().split("\n")
+
+        try:
+            state = json.loads(lines[0])
+        except ValueError:
+            state = None
+        if state != self.state:
+            logging.warning("The checkpoint in " + self.path + " belongs to a run with different parameters, starting from the first row.")
+            return []
+
+        bands = []
+        for line in lines[1:]:
+            try:
+                bands.append(json.loads(line))
+            except ValueError:
+                break
+
+        return bands
+
+
+    def start(self, bands):
+        """Starts the checkpoint file, keeping the given completed bands.
+
+        Args:
+            bands: List with the records of the completed bands to keep.
+        """
+
+        # Write to a temporary file first, so that the checkpoint keeps the
+        # completed bands if the run is interrupted while rewriting it
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                self.__file = f
+                self.__write(self.state)
+                for band in bands:
+                    self.__write(band)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            self.__file = None
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.__file = open(self.path, "a")
+
+
+    def append(self, band):
+        """Records a completed band.
+
+        Args:
+            band: Dictionary with the record of the band.
+        """
+        self.__write(band)
+
+
+    def remove(self):
+        """Closes and removes the checkpoint file, once all the tiles are written."""
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+    def close(self):
+        """Closes the checkpoint file, keeping it to resume the run."""
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+    def __write(self, record):
+        """Writes a line to the checkpoint file and flushes it to disk."""
+        self.__file.write(json.dumps(record, default=int) + "\n")
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
@@ -48,7 +48,7 @@ static inline float diff(image<float> *r, image<float> *g, image<float> *b,
 /*
  * Segment an image
  *
- * Returns a color image representing the segmentation.
+ * Returns a disjoint-set forest with the components of the segmentation.
  *
  * im: image to segment.
  * sigma: to smooth the image.
@@ -56,8 +56,8 @@ static inline float diff(image<float> *r, image<float> *g, image<float> *b,
  * min_size: minimum component size (enforced by post-processing stage).
  * num_ccs: number of connected components in the segmentation.
  */
-image<rgb> *segment_image(image<rgb> *im, float sigma, float c, int min_size,
-			  int *num_ccs) {
+universe *segment_components(image<rgb> *im, float sigma, float c, int min_size,
+			     int *num_ccs) {
   int width = im->width();
   int height = im->height();
 
@@ -131,6 +131,26 @@ image<rgb> *segment_image(image<rgb> *im, float sigma, float c, int min_size,
   delete [] edges;
   *num_ccs = u->num_sets();
 
+  return u;
+}
+
+/*
+ * Segment an image
+ *
+ * Returns a color image representing the segmentation.
+ *
+ * im: image to segment.
+ * sigma: to smooth the image.
+ * c: constant for treshold function.
+ * min_size: minimum component size (enforced by post-processing stage).
+ * num_ccs: number of connected components in the segmentation.
+ */
+image<rgb> *segment_image(image<rgb> *im, float sigma, float c, int min_size,
+			  int *num_ccs) {
+  int width = im->width();
+  int height = im->height();
+  universe *u = segment_components(im, sigma, c, min_size, num_ccs);
+
   image<rgb> *output = new image<rgb>(width, height);
 
   // pick random colors for each component
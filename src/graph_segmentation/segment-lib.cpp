@@ -0,0 +1,84 @@
+/*
+Shared library interface to the graph-based segmentation algorithm,
+to segment images held in memory without writing them to PPM files.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+*/
+
+#include <cstdlib>
+#include <cstring>
+#include <image.h>
+#include <misc.h>
+#include "segment-image.h"
+
+extern "C" {
+
+/*
+ * Segment an RGB image stored as a contiguous (height, width, 3) array.
+ *
+ * Each pixel is labelled with the index of its segment, numbering the
+ * segments in the order in which they are first found scanning the image
+ * row by row. The color of each segment is the one the segment executable
+ * assigns to it, since the random generator is seeded in the same way.
+ *
+ * input: pointer to the input image.
+ * width, height: dimensions of the image.
+ * sigma: to smooth the image.
+ * k: constant for treshold function.
+ * min_size: minimum component size (enforced by post-processing stage).
+ * labels: pointer to a (height, width) array to store the segment labels.
+ * num_ccs: number of connected components in the segmentation.
+ *
+ * Returns a (num_ccs, 3) array with the RGB color of each segment, which
+ * must be released with free_palette.
+ */
+uchar *segment_labels(const uchar *input, int width, int height, float sigma,
+		      float k, int min_size, int *labels, int *num_ccs) {
+  image<rgb> *im = new image<rgb>(width, height);
+  memcpy(im->data, input, sizeof(rgb) * width * height);
+
+  universe *u = segment_components(im, sigma, k, min_size, num_ccs);
+  delete im;
+
+  // Label of each component, indexed by its representative pixel
+  int *comp_labels = new int[width*height];
+  for (int i = 0; i < width*height; i++)
+    comp_labels[i] = -1;
+
+  int num_labels = 0;
+  for (int i = 0; i < width*height; i++) {
+    int comp = u->find(i);
+    if (comp_labels[comp] < 0)
+      comp_labels[comp] = num_labels++;
+    labels[i] = comp_labels[comp];
+  }
+
+  // A color is drawn for every pixel, as in segment_image, and
+  // each segment takes the color of its representative pixel
+  uchar *palette = (uchar *)malloc(3 * num_labels);
+  srandom(1);
+  for (int i = 0; i < width*height; i++) {
+    rgb c = random_rgb();
+    if (comp_labels[i] >= 0) {
+      palette[3*comp_labels[i]] = c.r;
+      palette[3*comp_labels[i] + 1] = c.g;
+      palette[3*comp_labels[i] + 2] = c.b;
+    }
+  }
+
+  delete [] comp_labels;
+  delete u;
+  return palette;
+}
+
+/*
+ * Release a palette returned by segment_labels.
+ */
+void free_palette(uchar *palette) {
+  free(palette);
+}
+
+}
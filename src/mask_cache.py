@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import tempfile
+
+
+class MaskCache:
+    """An on-disk cache of slide masks.
+
+    Masks are stored as compressed numpy files, keyed by the content of the
+    slide and the parameters used to produce the mask. When the cache grows
+    over its maximum size, the least recently used masks are removed.
+
+    Attributes:
+        cache_dir: Path to the folder holding the cached masks.
+        max_size: Maximum size of the cache in bytes.
+    """
+
+    # Number of bytes at the start of the slide used to identify its content
+    header_bytes = 2**20
+
+    def __init__(self, cache_dir, max_size):
+        """Inits MaskCache, creating the cache folder if needed."""
+        self.cache_dir = os.path.join(cache_dir, '')
+        self.max_size = max_size
+
+        # Concurrent runs may create the folder at the same time
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def key(self, input_slide):
+        """Builds the cache key of the mask of a slide.
+
+        The key identifies the slide by its file size, modification time and
+        a hash of its header, together with the parameters that change the mask
+        for the segmentation method.
+
+        Args:
+            input_slide: A PySlide object.
+
+        Returns:
+            _: String with the hexadecimal cache key.
+        """
+
+        stat = os.stat(input_slide.svs)
+        with open(input_slide.svs, "rb") as f:
+            header_hash = hashlib.sha256(f.read(self.header_bytes)).hexdigest()
+
+        params = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "header": header_hash,
+            "method": input_slide.method,
+            "mask_downsample": input_slide.mask_downsample
+        }
+
+        # Parameters only used by the graph segmentation
+        if input_slide.method == "graph":
+            params.update({
+                "sigma": input_slide.sigma,
+                "k_const": input_slide.k_const,
+                "minimum_segmentsize": input_slide.minimum_segmentsize,
+                "borders": input_slide.borders,
+                "corners": input_slide.corners,
+                "pct_bc": input_slide.pct_bc
+            })
+
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+    def get(self, key):
+        """Retrieves a mask from the cache.
+
+        Args:
+            key: String with the cache key.
+
+        Returns:
+            _: Tuple with the mask and background color numpy arrays and the
+                threshold of the segmentation (None if it was not stored), or
+                None if the mask is not in the cache.
+        """
+
+        path = self.__path(key)
+        try:
+            with np.load(path) as cached:
+                mask, bg_color = cached["mask"], cached["bg_color"]
+                threshold = float(cached["threshold"]) if "threshold" in cached else None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        # Mark the mask as recently used
+        os.utime(path, None)
+        logging.debug("Mask found in cache: " + path)
+
+        return mask, bg_color, threshold
+
+
+    def put(self, key, mask, bg_color, threshold=None):
+        """Stores a mask in the cache and evicts the least recently used masks if needed.
+
+        Args:
+            key: String with the cache key.
+            mask: Numpy array with the mask.
+            bg_color: Numpy array with the background color of the mask.
+            threshold: Threshold of the segmentation (e.g. given by Otsu's method), if any.
+        """
+
+        # Write to a temporary file first, so that concurrent
+        # runs never read an incomplete mask
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                arrays = {"mask": mask, "bg_color": bg_color}
+                if threshold is not None:
+                    arrays["threshold"] = np.array(threshold)
+                np.savez_compressed(f, **arrays)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.__path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        logging.debug("Mask stored in cache: " + self.__path(key))
+        self.__evict()
+
+
+    def __path(self, key):
+        """Path to the file of a cached mask."""
+        return self.cache_dir + key + ".npz"
+
+
+    def __evict(self):
+        """Removes the least recently used masks until the cache fits in its maximum size."""
+
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(self.cache_dir + filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, self.cache_dir + filename))
+
+        total_size = sum(x[1] for x in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                logging.debug("Mask evicted from cache: " + path)
+            except OSError:
+                pass
+            total_size -= size
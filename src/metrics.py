@@ -0,0 +1,147 @@
+import json
+import logging
+import sys
+import time
+
+from contextlib import contextmanager
+
+
+def peak_rss(children=False):
+    """Peak resident set size, in MB.
+
+    Args:
+        children: If True, the largest peak of the terminated child processes
+            is given instead of the peak of the current process.
+
+    Returns:
+        _: Float with the peak resident set size in MB, or 0.0 where it is not
+            available (the resource module only exists on Unix).
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+
+    # ru_maxrss is given in bytes in macOS and in kilobytes in Linux
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+class PipelineMetrics:
+    """Timing, counters and memory usage of the stages of the pipeline.
+
+    Each stage records its wall and CPU time, the number of times it was
+    executed and the peak resident set size of the process when it last
+    finished. Stages executed several times (e.g. reading each tile) are
+    accumulated. Metrics of worker processes can be merged, in which case
+    their times are summed over all the workers.
+
+    Attributes:
+        stages: Dictionary with the metrics of each stage, in execution order.
+        counters: Dictionary with the counters of the pipeline.
+    """
+
+    counter_names = ["bytes_read", "bytes_written", "tiles_evaluated", "tiles_kept", "tiles_saved", "tiles_refined"]
+
+    def __init__(self):
+        """Inits PipelineMetrics, starting the total time."""
+        self.stages = {}
+        self.counters = {name: 0 for name in self.counter_names}
+        self.__wall_start = time.perf_counter()
+        self.__cpu_start = time.process_time()
+
+
+    @contextmanager
+    def stage(self, name, log=False):
+        """Measures a stage of the pipeline.
+
+        Args:
+            name: String with the name of the stage.
+            log: If True, log the elapsed time of the stage.
+        """
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            self.add_stage(name, wall, time.process_time() - cpu_start)
+            if log:
+                logging.debug("Elapsed time: " + str(round(wall, ndigits = 3)) + "s")
+
+
+    def add_stage(self, name, wall, cpu, calls=1, rss=None):
+        """Adds the time of an execution of a stage.
+
+        Args:
+            name: String with the name of the stage.
+            wall: Wall time in seconds.
+            cpu: CPU time in seconds.
+            calls: Number of executions of the stage.
+            rss: Peak resident set size in MB, or None to measure the one of the current process.
+        """
+
+        stage = self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0, "peak_rss_mb": 0.0})
+        stage["wall_s"] += wall
+        stage["cpu_s"] += cpu
+        stage["calls"] += calls
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"], peak_rss() if rss is None else rss)
+
+
+    def count(self, name, value):
+        """Increases a counter.
+
+        Args:
+            name: String with the name of the counter.
+            value: Number to add to the counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+
+    def merge(self, other):
+        """Adds the stages and counters of another PipelineMetrics object (e.g. from a worker process).
+
+        Args:
+            other: A PipelineMetrics object.
+        """
+
+        for name, stage in other.stages.items():
+            self.add_stage(name, stage["wall_s"], stage["cpu_s"], stage["calls"], stage["peak_rss_mb"])
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+
+    def report(self, info=None):
+        """Builds the metrics report.
+
+        Args:
+            info: Dictionary with additional information to include in the report.
+
+        Returns:
+            report: Dictionary with the metrics.
+        """
+
+        report = dict(info or {})
+        report["total"] = {
+            "wall_s": round(time.perf_counter() - self.__wall_start, 4),
+            "cpu_s": round(time.process_time() - self.__cpu_start, 4)
+        }
+        report["stages"] = {name: {key: round(value, 4) for key, value in stage.items()} for name, stage in self.stages.items()}
+        report["counters"] = dict(self.counters)
+        report["peak_rss_mb"] = round(peak_rss(), 2)
+        report["peak_rss_workers_mb"] = round(peak_rss(children=True), 2)
+
+        return report
+
+
+    def write(self, path, info=None):
+        """Writes the metrics report as JSON.
+
+        Args:
+            path: Path to the output file.
+            info: Dictionary with additional information to include in the report.
+        """
+
+        with open(path, "w") as f:
+            json.dump(self.report(info), f, indent=2)
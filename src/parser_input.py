@@ -1,8 +1,10 @@
+import importlib.util
 import itertools as it
 import logging
 import warnings
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from PIL import features
 from src import utility_functions
 
 
@@ -10,15 +12,24 @@ description_str = '''
     PyHIST is a semi-automatic pipeline to produce tiles from a high resolution histopathological image.
 '''
 
+batch_description_str = '''
+    Batch mode of PyHIST: runs the pipeline over many whole slide images with the same parameters.
+'''
+
+serve_description_str = '''
+    Server mode of PyHIST: keeps a pool of worker processes running and processes the
+    jobs received over a UNIX socket or a spool directory, each with the arguments of PyHIST.
+'''
+
 epilog_str = '''
     Examples: See the documentation at https://pyhist.readthedocs.io/
     '''
 
 
-def build_parser():
+def build_parser(batch=False):
 
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
-                            description=description_str,
+                            description=batch_description_str if batch else description_str,
                             epilog=epilog_str)
 
     # Calculate 4-bit permutations for options that need it
@@ -29,10 +40,18 @@ def build_parser():
         combs.append(''.join(perm))
 
     # Mandatory arguments
-    parser.add_argument("svs",
-                        type=str,
-                        help='The whole slide image input file',
-                        metavar='input_image')
+    if batch:
+        parser.add_argument("svs",
+                            type=str,
+                            help='''A directory with the whole slide images, a manifest file
+                            with one whole slide image path per line, or a glob pattern
+                            (quoted to prevent shell expansion).''',
+                            metavar='input_slides')
+    else:
+        parser.add_argument("svs",
+                            type=str,
+                            help='The whole slide image input file',
+                            metavar='input_image')
 
     # Optional argument group: execution settings
     group_exec = parser.add_argument_group('Execution')
@@ -43,14 +62,19 @@ def build_parser():
         help='Integer indicating the size of the produced tiles. A value of P will produce tiles of size P x P.')
     group_exec.add_argument(
         '--method',
-        help='Method to perform the segmentation.',
-        choices=['randomsampling', 'graph', 'graphtestmode', 'otsu', 'adaptive'],
+        help='''Method to perform the segmentation. With tilecross, no segmentation is
+        performed: the tilecrossed image is drawn from the tile_selection.tsv of a
+        previous run with the same output folder, patch size and output downsampling.
+        With merge, the tile selections written by the shards of a slide (see --shard)
+        are merged into a single one.''',
+        choices=['randomsampling', 'graph', 'graphtestmode', 'otsu', 'adaptive', 'tilecross', 'merge'],
         default='graph'
     )
     group_exec.add_argument(
         "--format",
-        help='Format to save the tiles.',
-        choices=["png", "jpg"],
+        help='''Format to save the tiles. With npy, tiles are saved as raw numpy arrays,
+        and the other images (mask, tilecrossed image) are saved as png.''',
+        choices=["png", "jpg", "webp", "npy"],
         default="png")
     group_exec.add_argument(
         '--content-threshold',
@@ -62,6 +86,76 @@ def build_parser():
         metavar='CONTENT_THRESHOLD',
         dest='thres')
 
+    group_exec.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='''Number of processes used to extract the tiles. The rows of the
+        tile grid are split in bands that are distributed across the processes.''')
+
+    group_exec.add_argument(
+        '--tile-reader',
+        help='''Method to read the tiles from the slide. With deepzoom, tiles are read
+        through OpenSlide's DeepZoomGenerator. With native, each tile is read with a
+        single region read at the native slide level used by DeepZoomGenerator, and it
+        is resized only when that level does not match the output downsampling, with the
+        same filter, so the tiles are identical to the deepzoom ones (tolerance of 0).
+        With region, the slide is read in regions spanning whole bands of rows of the
+        tile grid (see --band-height), which are then sliced into tiles, identical to the
+        deepzoom ones.''',
+        choices=["deepzoom", "native", "region"],
+        default="deepzoom")
+
+    group_exec.add_argument(
+        '--band-height',
+        type=int,
+        help='''Height in pixels, at the output downsampling, of the regions read with
+        the region tile reader. It is rounded to a whole number of tile rows, and
+        extended to align with the internal tiles of the slide when possible. Larger
+        values use more memory, but require fewer reads.''',
+        default=1024)
+
+    group_exec.add_argument(
+        '--queue-depth',
+        type=int,
+        default=0,
+        help='''If greater than zero, tile files are written through a pipeline in which
+        reading, encoding and writing the tiles overlap. The stages are connected by
+        queues that hold at most QUEUE_DEPTH tiles, which bounds the memory used.
+        With 0, each tile is read, encoded and written in sequence.''')
+
+    group_exec.add_argument(
+        '--encoder-threads',
+        type=int,
+        default=2,
+        help='''Number of threads encoding the tiles in the pipeline enabled with --queue-depth.
+        When using several workers, each worker starts its own encoder threads.''')
+
+    group_exec.add_argument(
+        '--checkpoint-rows',
+        type=int,
+        default=0,
+        help='''If greater than zero, record the progress of the tile extraction in a
+        checkpoint file in the output folder every CHECKPOINT_ROWS rows of the tile
+        grid (or more often when using several workers), so that an interrupted run
+        can be continued with --resume. The checkpoint is removed when the run finishes.''')
+
+    group_exec.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='''Continue an interrupted run from its checkpoint (see --checkpoint-rows),
+        keeping the rows whose tiles are all on disk. Without a checkpoint from a run
+        with the same parameters, the tiles are extracted from the first row.''')
+    group_exec.add_argument(
+        '--shard',
+        type=str,
+        default=None,
+        metavar='I/N',
+        help='''Extract only the I-th of N shards of the tile grid (I from 0 to N-1), each one
+        a range of consecutive rows, so that a slide can be split across independent jobs.
+        The tile selections of the shards are merged afterwards with --method merge.''')
+
     group_exec.add_argument(
         "--info",
         help='Show status messages at each step of the pipeline.',
@@ -80,6 +174,22 @@ def build_parser():
         action='store_true',
         default=False,
         help='Save the tiles with an amount of foreground above the content threshold.')
+    group_output.add_argument(
+        '--output-store',
+        help='''Container for the saved tiles. With "files", each tile is saved as an image
+        file in the tile folder. With "hdf5", all the tiles of the slide are appended to
+        a single chunked and compressed HDF5 file, together with their coordinates and
+        selection flag (requires the h5py package).''',
+        choices=["files", "hdf5"],
+        default="files")
+    group_output.add_argument(
+        '--metadata-format',
+        help='''Formats of the metadata of the saved tiles. "tsv" is the tile_selection.tsv file.
+        "parquet" and "arrow" are columnar files that also hold the level 0 coordinates,
+        the foreground content and the output path of each tile (require the pyarrow package).''',
+        nargs="+",
+        choices=["tsv", "parquet", "arrow"],
+        default=["tsv"])
     group_output.add_argument(
         '--save-blank',
         action='store_true',
@@ -97,26 +207,108 @@ def build_parser():
         action='store_true',
         default=False,
         help='Produce a thumbnail of the original image, in which the selected tiles are marked with a cross.')
+    group_output.add_argument(
+        '--mask-cache',
+        type=str,
+        default=None,
+        help='''Directory to cache the masks produced by the graph, otsu and adaptive methods.
+        A slide processed again with the same mask parameters reuses the cached mask
+        instead of segmenting the slide. Disabled by default.''')
+    group_output.add_argument(
+        '--mask-cache-size',
+        type=int,
+        default=2048,
+        help='''Maximum size (in MB) of the mask cache. The least recently used masks are
+        removed when the cache grows over this size.''')
     group_output.add_argument(
         '--save-mask',
         action='store_true',
         default=False,
         help='Keep the mask used to perform tile selection.')
+    group_output.add_argument(
+        '--save-metrics',
+        action='store_true',
+        default=False,
+        help='''Save the wall and CPU time, memory usage and counters (bytes read and
+        written, tiles evaluated, kept and saved) of each stage of the pipeline
+        in metrics.json.''')
+    group_output.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help='''Profile the execution with cProfile, and save the profile in the output
+        folder. Only the main process is profiled.''')
+
+
+    # Optional argument group: tile encoding
+    group_encoding = parser.add_argument_group('Tile encoding')
+    group_encoding.add_argument(
+        '--png-compression',
+        type=int,
+        default=None,
+        help='''zlib compression level [0-9] of png tiles. Lower levels are faster to
+        encode but produce larger files. If not set, the Pillow default is used.''')
+    group_encoding.add_argument(
+        '--jpeg-quality',
+        type=int,
+        default=None,
+        help='''Quality [1-95] of jpg tiles. If not set, the Pillow default is used.''')
+    group_encoding.add_argument(
+        '--jpeg-subsampling',
+        choices=["444", "422", "420"],
+        default=None,
+        help='''Chroma subsampling of jpg tiles. If not set, the Pillow default is used.''')
+    group_encoding.add_argument(
+        '--webp-quality',
+        type=int,
+        default=80,
+        help='''Quality [0-100] of lossy webp tiles, or compression effort of lossless webp tiles.''')
+    group_encoding.add_argument(
+        '--webp-lossless',
+        action='store_true',
+        default=False,
+        help='Use lossless encoding for webp tiles.')
+    group_encoding.add_argument(
+        '--codec-benchmark',
+        type=int,
+        default=0,
+        help='''If greater than zero, instead of extracting tiles, encode this number of
+        tiles sampled from the slide with different codecs and settings, and report the
+        encoding time and size of each one in codec_benchmark.tsv.''',
+        metavar='NTILES')
 
 
     # Optional argument group: downsampling
     group_downsampling = parser.add_argument_group('Downsampling')
     group_downsampling.add_argument(
         '--output-downsample',
-        help='Downsampling factor for the output image. Must be a power of 2.',
+        help='''Downsampling factor for the output image. Must be a power of 2. Several
+        factors can be given to save each selected tile at all of them: the tiles are
+        selected at the coarsest factor, and the finer factors produce the aligned
+        tiles covering each selected tile.''',
         type=int,
-        default=16)
+        nargs='+',
+        default=[16])
     group_downsampling.add_argument(
         "--mask-downsample",
         help='''Downsampling factor to calculate the image mask. A higher number will speed up the tiling evaluation process at the expense of
         tile evaluation quality. Must be a power of 2.''',
         type=int,
         default=16)
+    group_downsampling.add_argument(
+        "--refine-downsample",
+        help='''Downsampling factor to evaluate again the tiles whose selection is ambiguous
+        in the mask (see --refine-margin). Only the windows of the slide covered by these
+        tiles are read at this factor. Must be a power of 2 smaller than --mask-downsample.
+        Only available with the otsu and adaptive methods. If not set, the tile selection is not refined.''',
+        type=int,
+        default=None)
+    group_downsampling.add_argument(
+        "--refine-margin",
+        help='''Tiles whose foreground content in the mask differs from the content
+        threshold by at most this value are evaluated again at --refine-downsample.''',
+        type=float,
+        default=0.1)
     group_downsampling.add_argument(
         "--tilecross-downsample",
         help='''Downsampling factor to generate the tilecrossed overview image. Must be a power of 2.''',
@@ -127,6 +319,18 @@ def build_parser():
         help='''Downsampling factor to generate the test image in graph test mode. Must be a power of 2.''',
         type=int,
         default=16)
+    group_downsampling.add_argument(
+        "--downsample-memory",
+        help='''Approximate memory budget (in MB) to read the image level used to produce
+        a downsampled image. The level is read in strips that fit in this budget.''',
+        type=int,
+        default=512)
+    group_downsampling.add_argument(
+        "--thumbnail-cache-size",
+        help='''Maximum size (in MB) of the downsampled images of the slide kept in memory, so that
+        the mask and the tilecrossed image reuse them instead of reading the slide again.''',
+        type=int,
+        default=1024)
 
 
     # Optional argument group: sampling settings
@@ -136,6 +340,19 @@ def build_parser():
         help='Number of tiles to extract in random sampling mode.',
         type=int,
         default=100)
+    group_sampling.add_argument(
+        '--tissue-sampling',
+        action='store_true',
+        default=False,
+        help='''Sample the tiles only over the tissue. An Otsu mask is computed at the mask
+        downsampling, and tiles are drawn from the positions whose foreground content
+        is above zero and at least the content threshold.''')
+    group_sampling.add_argument(
+        '--sampling-weights',
+        help='''With --tissue-sampling, draw the positions uniformly, or with a probability
+        proportional to their tissue content.''',
+        choices=["uniform", "tissue"],
+        default="uniform")
 
 
     # Optional argument group: segmentation
@@ -213,9 +430,68 @@ def build_parser():
         help='''Parameter required by the segmentation algorithm.
         Used to smooth the input image with a Gaussian kernel before segmenting it.''')
 
+    # Optional argument group: batch processing
+    if batch:
+        group_batch = parser.add_argument_group('Batch')
+        group_batch.add_argument(
+            '--batch-workers',
+            type=int,
+            default=1,
+            help='''Maximum number of slides processed concurrently. Each slide is
+            processed in its own worker process, and a failing slide does not stop the batch.''')
+
     return parser
 
 
+def build_serve_parser():
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter,
+                            description=serve_description_str,
+                            epilog=epilog_str)
+
+    group_serve = parser.add_argument_group('Server')
+    group_serve.add_argument(
+        '--socket',
+        type=str,
+        default=None,
+        help='''Path of a UNIX socket to receive the jobs on. Each job is a line with a JSON
+        object, answered with a line with the status and metrics of the job.''')
+    group_serve.add_argument(
+        '--spool',
+        type=str,
+        default=None,
+        help='''Directory to receive the jobs as JSON files. The jobs are moved to its running/
+        folder while they are processed, and their status and metrics are written to its done/ folder.''')
+    group_serve.add_argument(
+        '--serve-workers',
+        type=int,
+        default=1,
+        help='''Maximum number of jobs processed concurrently. Each job is processed in one
+        of the worker processes of the server, and a failing job does not stop the server.''')
+    group_serve.add_argument(
+        '--poll-interval',
+        type=float,
+        default=1.0,
+        help='Time (in seconds) between checks of the spool directory for new jobs.')
+    group_serve.add_argument(
+        "--info",
+        help='Show status messages of the server and the jobs.',
+        choices=["silent", "default", "verbose"],
+        default="default")
+
+    return parser
+
+
+def check_serve_arguments(args):
+
+    if args.socket is None and args.spool is None:
+        raise ValueError("A UNIX socket (--socket) or a spool directory (--spool) is required to receive the jobs.")
+    if args.serve_workers < 1:
+        raise ValueError("The number of server workers must be at least 1.")
+    if args.poll_interval <= 0:
+        raise ValueError("The poll interval must be greater than zero.")
+
+
 def check_arguments(args):
 
     # Argument checking for graph segmentation
@@ -223,12 +499,86 @@ def check_arguments(args):
         raise ValueError("Invalid borders and corners parameters. Only one of either should be specified.")
     if args.thres > 1 or args.thres < 0:
         raise ValueError("CONTENT_THRESHOLD should be a floating point number between 0 and 1.")
+    if args.downsample_memory <= 0:
+        raise ValueError("The memory budget for downsampling must be greater than zero.")
+    if args.thumbnail_cache_size <= 0:
+        raise ValueError("The maximum size of the thumbnail cache must be greater than zero.")
+    if args.mask_cache_size <= 0:
+        raise ValueError("The maximum size of the mask cache must be greater than zero.")
+    if args.output_store == "hdf5" and importlib.util.find_spec("h5py") is None:
+        raise ImportError("The h5py package is required to store the tiles in HDF5 format.")
+    if ("parquet" in args.metadata_format or "arrow" in args.metadata_format) and importlib.util.find_spec("pyarrow") is None:
+        raise ImportError("The pyarrow package is required to save the tile metadata in Parquet or Arrow format.")
+    if args.band_height < 1:
+        raise ValueError("The band height must be at least 1 pixel.")
+    if args.queue_depth < 0:
+        raise ValueError("The queue depth must be zero or greater.")
+    if args.checkpoint_rows < 0:
+        raise ValueError("The number of rows between checkpoints must be zero or greater.")
+    if args.checkpoint_rows > 0 and args.output_store != "files":
+        raise ValueError("Checkpoints are only supported with --output-store files.")
+    if args.checkpoint_rows > 0 and args.method not in ["graph", "otsu", "adaptive"]:
+        raise ValueError("Checkpoints are only supported with the graph, otsu and adaptive methods.")
+    if args.resume and args.checkpoint_rows == 0:
+        raise ValueError("--resume requires checkpoints to be enabled with --checkpoint-rows.")
+    if args.shard is not None:
+        try:
+            shard, n_shards = [int(x) for x in args.shard.split("/")] if isinstance(args.shard, str) else args.shard
+        except ValueError:
+            raise ValueError("The shard should be given as I/N, e.g. 0/4 for the first of four shards.")
+        if n_shards < 1 or not 0 <= shard < n_shards:
+            raise ValueError("The shard index I should be between 0 and N-1.")
+        if args.method not in ["graph", "otsu", "adaptive"]:
+            raise ValueError("Shards are only supported with the graph, otsu and adaptive methods.")
+        if args.output_store != "files":
+            raise ValueError("Shards are only supported with --output-store files.")
+        args.shard = (shard, n_shards)
+
+        # The overview needs the tile selection of all the shards
+        if args.save_tilecrossed_image:
+            logging.info("The tilecrossed image is not saved by the shards. It is saved when the shards are merged with --method merge.")
+            args.save_tilecrossed_image = False
+    if args.encoder_threads < 1:
+        raise ValueError("The number of encoder threads must be at least 1.")
+    if args.png_compression is not None and (args.png_compression < 0 or args.png_compression > 9):
+        raise ValueError("The png compression level should be an integer between 0 and 9.")
+    if args.jpeg_quality is not None and (args.jpeg_quality < 1 or args.jpeg_quality > 95):
+        raise ValueError("The jpg quality should be an integer between 1 and 95.")
+    if args.webp_quality < 0 or args.webp_quality > 100:
+        raise ValueError("The webp quality should be an integer between 0 and 100.")
+    if args.format == "webp" and not features.check("webp"):
+        raise ValueError("WebP support is not available in the installed Pillow library.")
+    if args.codec_benchmark < 0:
+        raise ValueError("The number of tiles for the codec benchmark must be zero or greater.")
+    if args.workers < 1:
+        raise ValueError("The number of workers must be at least 1.")
+    if getattr(args, "batch_workers", 1) < 1:
+        raise ValueError("The number of batch workers must be at least 1.")
     if args.pct_bc < 0 or args.pct_bc > 100:
         raise ValueError("PERCENTAGE_BC should be an integer number between 0 and 100.")
-    if not utility_functions.isPowerOfTwo(args.output_downsample):
+    if not all(utility_functions.isPowerOfTwo(x) for x in args.output_downsample):
         raise ValueError("Downsampling factor for output image must be a power of two.")
+
+    # Output downsampling factors are sorted from the coarsest to the finest.
+    # Tiles are selected at the coarsest factor
+    args.output_downsamples = sorted(set(args.output_downsample), reverse=True)
+    args.output_downsample = args.output_downsamples[0]
+    if len(args.output_downsamples) > 1:
+        if args.method == "randomsampling":
+            raise ValueError("Several output downsampling factors are not supported in random sampling mode.")
+        if args.output_store != "files":
+            raise ValueError("Several output downsampling factors are only supported with --output-store files.")
     if not utility_functions.isPowerOfTwo(args.mask_downsample):
         raise ValueError("Downsampling factor for the mask must be a power of two.")
+    if args.refine_downsample is not None:
+        if args.method not in ["otsu", "adaptive"]:
+            raise ValueError("Refining the tile selection is only supported with the otsu and adaptive methods.")
+        if args.refine_downsample <= 0 or not utility_functions.isPowerOfTwo(args.refine_downsample):
+            raise ValueError("Downsampling factor to refine the tile selection must be a power of two.")
+        if args.refine_downsample >= args.mask_downsample:
+            raise ValueError("Downsampling factor to refine the tile selection must be smaller than the one for the mask.")
+    if not 0 <= args.refine_margin <= 1:
+        raise ValueError("REFINE_MARGIN should be a floating point number between 0 and 1.")
     if not utility_functions.isPowerOfTwo(args.tilecross_downsample):
         raise ValueError("Downsampling factor for the tilecrossed image must be a power of two.")
 
@@ -238,9 +588,9 @@ def check_arguments(args):
             raise ValueError("Number of patches to extract must be greater than zero.")
 
         x = [args.save_blank, args.save_nonsquare, args.save_tilecrossed_image,
-        args.save_mask, args.save_edges]
+        args.save_mask and not args.tissue_sampling, args.save_edges, args.resume]
         strs = ["--save-blank", "--save-nonsquare", "--save-tilecrossed-image",
-                 "--save-mask", "--save-edges"]
+                 "--save-mask", "--save-edges", "--resume"]
 
         if sum(x) >= 1:
             invalid_flags = str([strs[x] for x in [i for i, y in enumerate(x) if y]])
@@ -255,3 +605,38 @@ def check_arguments(args):
             invalid_flags = str([strs[x] for x in [i for i, y in enumerate(x) if y]])
             logging.info('The following flags and their group parameters will be ignored' \
                 ' since they are not used in thresholding modes: ' + invalid_flags)
+
+
+def build_config(svs, **options):
+    """Builds the configuration of PyHIST for a slide without the command line.
+
+    The configuration starts from the default value of each argument, which
+    is replaced by the given options. Options are named as the attributes of
+    the parsed arguments (e.g. patch_size for --patch-size, thres for
+    --content-threshold).
+
+    Args:
+        svs: Path to the slide.
+        **options: Values of the arguments to replace.
+
+    Returns:
+        _: Dictionary with the checked configuration, as given to PySlide.
+
+    Raises:
+        ValueError: If an option is not a PyHIST argument or has an invalid value.
+    """
+
+    args = build_parser().parse_args([svs])
+
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise ValueError("Unknown PyHIST argument: " + key)
+        setattr(args, key, value)
+
+    # A single output downsampling factor can be given as an integer
+    if isinstance(args.output_downsample, int):
+        args.output_downsample = [args.output_downsample]
+
+    check_arguments(args)
+
+    return vars(args)
@@ -0,0 +1,408 @@
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from src import batch, parser_input, utility_functions
+
+
+# Arguments of a job with paths, which are relative to the working directory of the job
+path_arguments = ["svs", "output", "mask_cache"]
+
+
+def _argument_error(message):
+    """Raises the errors of the argument parser of a job, instead of exiting."""
+    raise ValueError("Invalid arguments: " + message)
+
+
+def _init_worker():
+    """Initializes a worker process of the server.
+
+    Running jobs are finished when the server is stopped, so the workers
+    ignore the signals that stop the server.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def parse_job(job, parser):
+    """Builds the arguments of a job.
+
+    Args:
+        job: Dictionary with the job. "args" is the list of PyHIST arguments,
+            as given in the command line, and "cwd" (optional) is the directory
+            that relative paths are relative to. By default, paths are relative
+            to the working directory of the server.
+        parser: ArgumentParser of PyHIST.
+
+    Returns:
+        args: Dictionary with the checked arguments, as given to batch.process_slide.
+
+    Raises:
+        ValueError: If the job or its arguments are not valid.
+    """
+
+    if not isinstance(job, dict) or not isinstance(job.get("args"), list):
+        raise ValueError("A job must be a JSON object with the list of PyHIST arguments in \"args\".")
+
+    try:
+        args = parser.parse_args([str(x) for x in job["args"]])
+    except SystemExit:
+        # Raised by --help
+        raise ValueError("Invalid arguments: " + " ".join(str(x) for x in job["args"]))
+    parser_input.check_arguments(args)
+
+    cwd = job.get("cwd", os.getcwd())
+    for key in path_arguments:
+        if getattr(args, key) is not None:
+            setattr(args, key, os.path.join(cwd, getattr(args, key)))
+
+    return vars(args)
+
+
+def submit(socket_path, argv, cwd=None):
+    """Sends a job to a PyHIST server over its UNIX socket and waits for the result.
+
+    Args:
+        socket_path: Path of the UNIX socket of the server.
+        argv: List with the PyHIST arguments, as given in the command line.
+        cwd: Directory that relative paths are relative to. (default: working directory)
+
+    Returns:
+        result: Dictionary with the result of the job (see batch.process_slide).
+    """
+
+    job = {"args": list(argv), "cwd": os.getcwd() if cwd is None else cwd}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(job) + "\n").encode())
+        with sock.makefile() as f:
+            return json.loads(f.readline())
+
+
+class _SocketHandler(socketserver.StreamRequestHandler):
+    """Processes the jobs sent over a connection to the socket, one per line."""
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.add(self.request)
+
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() == b"":
+                continue
+
+            try:
+                job = json.loads(line)
+            except ValueError:
+                job = None
+
+            result = self.server.job_server.run(job)
+            self.wfile.write((json.dumps(result, default=int) + "\n").encode())
+
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.request)
+        super().finish()
+
+
+class _SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """UNIX socket server with a thread per connection."""
+
+    def __init__(self, socket_path, job_server):
+        self.job_server = job_server
+        self.connections = set()
+        self.lock = threading.Lock()
+        super().__init__(socket_path, _SocketHandler)
+
+
+    def close_connections(self):
+        """Stops reading new jobs from the open connections."""
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+
+class JobServer:
+    """A server that processes PyHIST jobs with a pool of worker processes.
+
+    The modules of PyHIST are imported and the segmentation executable is
+    checked once, when the server starts, and the worker processes are kept
+    running to process all the jobs. Jobs are received over a UNIX socket,
+    a spool directory, or both:
+
+        - Socket: each line sent to the socket is a job, as a JSON object
+          (see parse_job), and is answered with a line with its result.
+        - Spool directory: each .json file in the directory is a job. The file
+          is moved to the running/ folder while the job is processed, and the
+          result is written to a file with the same name in the done/ folder.
+          Several servers can share a spool directory, each taking at most
+          as many jobs as workers it has.
+
+    The result of a job is the dictionary returned by batch.process_slide,
+    with its status and the metrics of the pipeline.
+
+    Attributes:
+        workers: Maximum number of jobs processed concurrently.
+        socket_path: Path of the UNIX socket, or None.
+        spool_dir: Path of the spool directory, or None.
+        poll_interval: Time in seconds between checks of the spool directory.
+    """
+
+    def __init__(self, workers, socket_path=None, spool_dir=None, poll_interval=1.0):
+        """Inits JobServer."""
+        self.workers = workers
+        self.socket_path = socket_path
+        self.spool_dir = None if spool_dir is None else os.path.join(spool_dir, '')
+        self.poll_interval = poll_interval
+
+        self.__parser = parser_input.build_parser()
+        self.__parser.error = _argument_error
+        self.__executor = None
+        self.__executor_lock = threading.Lock()
+        self.__futures = set()
+        self.__stop = threading.Event()
+        self.__spool_slots = threading.BoundedSemaphore(workers)
+
+
+    def submit(self, job):
+        """Queues a job to be processed by a worker.
+
+        Args:
+            job: Dictionary with the job (see parse_job).
+
+        Returns:
+            future: Future with the result of the job. Invalid jobs are failed
+                without being queued.
+        """
+
+        try:
+            args = parse_job(job, self.__parser)
+        except Exception as e:
+            future = concurrent.futures.Future()
+            future.set_result({"Slide": "", "Status": "failed", "Error": type(e).__name__ + ": " + str(e), "Elapsed": 0.0})
+            return future
+
+        logging.info("Received job for " + args["svs"])
+
+        with self.__executor_lock:
+            try:
+                # Jobs received after the server is stopped are not queued
+                if self.__stop.is_set():
+                    raise RuntimeError("The server is stopping")
+                future = self.__executor.submit(batch.process_slide, args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker process died, so the pool is started again
+                logging.warning("A worker process of the server died. Restarting the workers.")
+                self.__executor = self.__start_executor()
+                future = self.__executor.submit(batch.process_slide, args)
+            except RuntimeError:
+                # The server is stopping
+                future = concurrent.futures.Future()
+                future.cancel()
+                return future
+
+            # Queued jobs are tracked to cancel them when the server stops
+            self.__futures.add(future)
+
+        future.add_done_callback(self.__futures.discard)
+        return future
+
+
+    def run(self, job):
+        """Processes a job and waits for its result.
+
+        Args:
+            job: Dictionary with the job (see parse_job).
+
+        Returns:
+            result: Dictionary with the result of the job.
+        """
+        return self.__result(self.submit(job))
+
+
+    def serve(self):
+        """Starts the workers and processes jobs until the server receives SIGINT or SIGTERM.
+
+        Running jobs are finished before the server stops. Jobs still waiting for
+        a worker are failed as cancelled, except spool jobs, which are left in the
+        spool directory.
+        """
+
+        # The segmentation executable is checked once for all the jobs. Graph
+        # jobs fail if it is not available, but the server keeps running
+        try:
+            utility_functions.check_compilation()
+        except SystemExit:
+            logging.warning("The graph segmentation is not available. Jobs with the graph method will fail.")
+
+        self.__executor = self.__start_executor()
+
+        threads = []
+        socket_server = None
+        if self.socket_path is not None:
+            socket_server = self.__start_socket_server()
+            threads.append(threading.Thread(target=socket_server.serve_forever))
+        if self.spool_dir is not None:
+            for folder in ["running", "done"]:
+                os.makedirs(self.spool_dir + folder, exist_ok=True)
+            threads.append(threading.Thread(target=self.__watch_spool))
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        for thread in threads:
+            thread.start()
+
+        logging.info("== PyHIST server started with " + str(self.workers) + " workers ==")
+        try:
+            self.__stop.wait()
+        except KeyboardInterrupt:
+            self.stop()
+
+        logging.info("== Stopping the PyHIST server ==")
+        if socket_server is not None:
+            socket_server.shutdown()
+        for thread in threads:
+            thread.join()
+
+        # Jobs waiting for a worker are cancelled, and running jobs are finished.
+        # No job is queued after the stop event, so the tracked jobs are all
+        # the queued ones
+        if socket_server is not None:
+            socket_server.close_connections()
+        with self.__executor_lock:
+            futures = list(self.__futures)
+        for future in futures:
+            future.cancel()
+        self.__executor.shutdown(wait=True)
+
+        if socket_server is not None:
+            socket_server.server_close()
+            os.remove(self.socket_path)
+
+
+    def stop(self):
+        """Stops the server."""
+        self.__stop.set()
+
+
+    def __start_executor(self):
+        """Starts the pool of worker processes."""
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+        # Start the workers before the first job arrives
+        executor.submit(int).result()
+
+        return executor
+
+
+    def __start_socket_server(self):
+        """Creates the UNIX socket, replacing a socket file left by a server that is not running.
+
+        Raises:
+            RuntimeError: If another server is listening on the socket.
+        """
+
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.socket_path)
+                except OSError:
+                    os.remove(self.socket_path)
+                else:
+                    raise RuntimeError("Another server is listening on " + self.socket_path + ".")
+
+        return _SocketServer(self.socket_path, self)
+
+
+    def __result(self, future):
+        """Gets the result of a job, failing it if it was cancelled or its worker died."""
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            return {"Slide": "", "Status": "failed", "Error": "Cancelled: the server was stopped", "Elapsed": 0.0}
+        except Exception as e:
+            return {"Slide": "", "Status": "failed", "Error": type(e).__name__ + ": " + str(e), "Elapsed": 0.0}
+
+
+    def __watch_spool(self):
+        """Takes the jobs of the spool directory, in name order, while there are free workers."""
+
+        while not self.__stop.is_set():
+            names = sorted(x for x in os.listdir(self.spool_dir) if x.endswith(".json"))
+            for name in names:
+
+                # Wait for a free worker, so that other servers sharing the
+                # spool directory can take the remaining jobs
+                while not self.__spool_slots.acquire(timeout=self.poll_interval):
+                    if self.__stop.is_set():
+                        return
+                if self.__stop.is_set():
+                    self.__spool_slots.release()
+                    return
+
+                # The job may have been taken by another server
+                try:
+                    os.rename(self.spool_dir + name, self.spool_dir + "running/" + name)
+                except FileNotFoundError:
+                    self.__spool_slots.release()
+                    continue
+
+                self.__start_spool_job(name)
+
+            self.__stop.wait(self.poll_interval)
+
+
+    def __start_spool_job(self, name):
+        """Queues a job taken from the spool directory."""
+
+        try:
+            with open(self.spool_dir + "running/" + name) as f:
+                job = json.load(f)
+        except ValueError:
+            job = None
+
+        future = self.submit(job)
+        future.add_done_callback(lambda x: self.__finish_spool_job(name, x))
+
+
+    def __finish_spool_job(self, name, future):
+        """Writes the result of a spool job to the done/ folder."""
+
+        try:
+            # Jobs that did not start are left for the next run of the server
+            if future.cancelled():
+                os.rename(self.spool_dir + "running/" + name, self.spool_dir + name)
+                return
+
+            result = self.__result(future)
+            result_path = self.spool_dir + "done/" + name
+            with open(result_path + ".tmp", "w") as f:
+                json.dump(result, f, default=int)
+            os.replace(result_path + ".tmp", result_path)
+            os.remove(self.spool_dir + "running/" + name)
+        except Exception:
+            logging.exception("Could not write the result of the spool job " + name)
+        finally:
+            self.__spool_slots.release()
+
+
+def serve(args):
+    """Runs PyHIST in server mode.
+
+    Args:
+        args: Namespace with the parsed arguments of the server.
+    """
+
+    job_server = JobServer(args.serve_workers, socket_path=args.socket, spool_dir=args.spool,
+                           poll_interval=args.poll_interval)
+    job_server.serve()
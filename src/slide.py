@@ -1,5 +1,9 @@
+import cProfile
+import collections
 import cv2
+import itertools
 import logging
+import multiprocessing
 import numpy as np
 import os
 import openslide
@@ -11,8 +15,13 @@ import time
 import warnings
 
 from openslide import deepzoom
-from PIL import Image, ImageDraw
-from src import utility_functions
+from PIL import Image
+from src import tile_codecs, tile_metadata, tile_reader, utility_functions
+from src.checkpoint import TilingCheckpoint
+from src.mask_cache import MaskCache
+from src.metrics import PipelineMetrics
+from src.tile_pipeline import TileWriterPipeline
+from src.tile_store import TileStore
 
 
 class PySlide:
@@ -22,8 +31,12 @@ class PySlide:
         initial_args: See parser for all the segmentation arguments.
 
         sample_id: Input filename, removing the path and extension.
-        img_outpath: Path to store all the image output
+        image_format: Format to save the images other than the tiles.
+        shard_suffix: Suffix of the output files of a shard of the tile grid, or an empty string.
+        img_outpath: Path to store all the image output, or None if no output folder is created.
         tile_folder: Path to store the output tiles.
+        level_tile_folders: Dictionary with the path to store the tiles of each
+            output downsampling factor, when several are requested.
         slide: OpenSlide object with the input slide.
     """
 
@@ -41,11 +54,86 @@ class PySlide:
         # The slide sample ID is the filename without the extension
         self.sample_id = os.path.splitext(os.path.basename(self.svs))[0]
 
-        # Create the output folder for the slide
-        self._create_output_folder()
+        # The outputs of a shard of the tile grid are named after the shard (see --shard)
+        shard = getattr(self, "shard", None)
+        self.shard_suffix = "" if shard is None else ".shard-" + str(shard[0]) + "-of-" + str(shard[1])
 
-        # Open the slide
-        self.slide = openslide.OpenSlide(self.svs)
+        # Images other than the tiles (masks, overviews) are saved
+        # as PNG when the tiles are saved as numpy arrays
+        self.image_format = "png" if self.format == "npy" else self.format
+
+        # Create the output folder for the slide, unless
+        # the tiles are only streamed (see src/streaming.py)
+        if self.output is None:
+            self.img_outpath = None
+        else:
+            self._create_output_folder()
+
+        # Open the slide, unless it was already opened (see utility_functions.check_image)
+        if getattr(self, "slide", None) is None:
+            self.slide = openslide.OpenSlide(self.svs)
+
+        # Downsampled images of the slide, by downsampling factor,
+        # in least recently used order (see thumbnail)
+        self.__thumbnails = collections.OrderedDict()
+
+
+    def thumbnail(self, downsampling_factor):
+        """Downsamples the slide at a factor, reusing the downsampled images of previous calls.
+
+        The thumbnails are kept in memory up to thumbnail_cache_size MB, removing
+        the least recently used ones. A thumbnail that is not cached is read from
+        the slide (see utility_functions.downsample_image), unless a cached
+        thumbnail holds the whole slide level that the read would use, without
+        resizing it. The thumbnail is then derived from the cached level in the
+        same strips and with the same interpolation as the read, so it is the
+        same image, except for the pixels next to transparent areas of the
+        level, if any, since the read resizes the level with its alpha channel.
+
+        The returned image is shared with the cache, so it is read-only.
+
+        Args:
+            downsampling_factor: Power of 2 to downsample the slide.
+
+        Returns:
+            img: Read-only RGB numpy array at the requested downsampling_factor.
+            level: The slide level used to produce the image.
+            bytes_read: Number of bytes of RGBA pixel data read from the slide, 0 if
+                the image was cached or derived from a cached one.
+        """
+
+        if downsampling_factor in self.__thumbnails:
+            self.__thumbnails.move_to_end(downsampling_factor)
+            img, level = self.__thumbnails[downsampling_factor]
+            return img, level, 0
+
+        # Cached thumbnails holding the level used to read the requested factor
+        level = self.slide.get_best_level_for_downsample(downsampling_factor + 0.1)
+        level_dims = self.slide.level_dimensions[level]
+        cached_levels = [f for f, (t, l) in self.__thumbnails.items() if l == level and (t.shape[1], t.shape[0]) == level_dims]
+
+        if cached_levels:
+            level_img = self.__thumbnails[cached_levels[0]][0]
+            self.__thumbnails.move_to_end(cached_levels[0])
+            img = utility_functions.resize_level(level_dims, lambda start, end: Image.fromarray(level_img[start:end], mode="RGB"),
+                self.slide, downsampling_factor, max_memory=self.downsample_memory * 2**20)
+            bytes_read = 0
+        else:
+            img, level = utility_functions.downsample_image(self.slide, downsampling_factor,
+                max_memory=self.downsample_memory * 2**20)
+            # The whole level is read from the slide
+            bytes_read = np.prod(self.slide.level_dimensions[level]) * 4
+
+        img.setflags(write=False)
+
+        # Keep the thumbnail if it fits, removing the least recently used ones
+        max_size = self.thumbnail_cache_size * 2**20
+        if img.nbytes <= max_size:
+            self.__thumbnails[downsampling_factor] = (img, level)
+            while sum(t.nbytes for t, _ in self.__thumbnails.values()) > max_size:
+                self.__thumbnails.popitem(last=False)
+
+        return img, level, bytes_read
 
 
     def _create_output_folder(self):
@@ -53,22 +141,30 @@ class PySlide:
         # Ensure output folder has a trailing slash
         self.output = os.path.join(self.output, '')
 
-        # Create the output folder
-        if not os.path.exists(self.output):
-            os.makedirs(self.output)
+        # Create the output folder. The shards of a slide may create it at the same time
+        os.makedirs(self.output, exist_ok=True)
 
         # Create a folder for the sample
         self.img_outpath = os.path.join(self.output + self.sample_id, '')
-        if not os.path.exists(self.img_outpath):
-            os.makedirs(self.img_outpath)
+        os.makedirs(self.img_outpath, exist_ok=True)
 
 
     def _create_tile_folder(self):
         """Creates a subfolder in the output folder to hold individual tiles."""
 
         self.tile_folder = os.path.join(self.img_outpath + self.sample_id + "_tiles", '')
-        if not os.path.exists(self.tile_folder):
-            os.makedirs(self.tile_folder)
+        os.makedirs(self.tile_folder, exist_ok=True)
+
+        # With several output downsampling factors, the tiles
+        # of each factor are saved in their own subfolder
+        output_downsamples = getattr(self, "output_downsamples", [self.output_downsample])
+        if len(output_downsamples) > 1:
+            self.level_tile_folders = {}
+            for downsample in output_downsamples:
+                folder = os.path.join(self.tile_folder + "downsample_" + str(downsample), '')
+                os.makedirs(folder, exist_ok=True)
+                self.level_tile_folders[downsample] = folder
+            self.tile_folder = self.level_tile_folders[self.output_downsample]
 
 
 class TileGenerator:
@@ -77,40 +173,224 @@ class TileGenerator:
     Attributes:
         method: The requested method to generate tiles.
         input_slide: A PySlide object.
+        metrics: PipelineMetrics object with the timing and counters of each stage.
     """
 
     def __init__(self, input_slide):
         """Init using PySlide and its properties."""
         self.method = input_slide.method
         self.input_slide = input_slide
+        self.metrics = PipelineMetrics()
+
+        # Threshold of the Otsu segmentation, to refine the tile selection
+        self.__mask_threshold = None
 
 
     def execute(self):
-        """Executes a tile-generating process."""
-        if self.method == "randomsampling":
+        """Executes a tile-generating process.
+
+        If requested, the process is profiled with cProfile, and the metrics
+        of each stage are written to metrics.json in the output folder.
+        """
+
+        profiler = None
+        if self.input_slide.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            self.__run()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profile_path = self.input_slide.img_outpath + "profile_" + self.input_slide.sample_id + self.input_slide.shard_suffix + ".prof"
+                profiler.dump_stats(profile_path)
+                logging.debug("Profile written to " + profile_path)
+
+        if self.input_slide.save_metrics:
+            self.metrics.write(self.input_slide.img_outpath + "metrics" + self.input_slide.shard_suffix + ".json", {
+                "sample_id": self.input_slide.sample_id,
+                "slide": self.input_slide.svs,
+                "method": self.method,
+                "dimensions": list(self.input_slide.slide.dimensions),
+                "patch_size": self.input_slide.patch_size,
+                "output_downsample": self.input_slide.output_downsample,
+                "mask_downsample": self.input_slide.mask_downsample,
+                "workers": self.input_slide.workers
+            })
+
+
+    def __run(self):
+        """Runs the requested tile-generating method."""
+        if self.input_slide.codec_benchmark > 0:
+            self.__benchmark_codecs()
+        elif self.method == "randomsampling":
             self.__randomsampler()
         elif self.method == "graphtestmode":
             self.__graphtestmode()
+        elif self.method == "tilecross":
+            self.__tilecross_from_selection()
+        elif self.method == "merge":
+            self.__merge_shards()
         elif self.method == "graph":
-            mask, bg_color = self.__graph()
+            mask, bg_color = self.__cached_mask(self.__graph)
             self.__create_tiles(mask, bg_color)
         elif self.method == "otsu":
-            mask, bg_color = self.__otsu()
+            mask, bg_color = self.__cached_mask(self.__otsu)
             self.__create_tiles(mask, bg_color)
         elif self.method == "adaptive":
-            mask, bg_color = self.__adaptive()
+            mask, bg_color = self.__cached_mask(self.__adaptive)
             self.__create_tiles(mask, bg_color)
         else:
             raise NotImplementedError
 
 
-    def __randomsampler(self):
-        """Extracts tiles randomly from a slide. No content thresholding is performed."""
+    def iter_tiles(self):
+        """Generates the selected tiles of the slide, without saving them.
 
-        logging.info("== Performing random tile sampling ==")
+        Tiles are read in row-major order with the requested tile reader. With
+        random sampling, the row and column of the tiles are -1.
+
+        Yields:
+            row: Row of the tile in the tile grid.
+            col: Column of the tile in the tile grid.
+            level0_xy: Tuple with the level 0 coordinates of the top left corner of the tile.
+            tile: RGB numpy array with the tile.
+
+        Raises:
+            NotImplementedError: If the method does not select tiles (e.g. graphtestmode).
+        """
+
+        if self.method == "randomsampling":
+            for k, level0_xy, img in self.__random_tiles():
+                yield -1, -1, level0_xy, np.asarray(img)
+            return
+        elif self.method == "graph":
+            mask, bg_color = self.__cached_mask(self.__graph)
+        elif self.method == "otsu":
+            mask, bg_color = self.__cached_mask(self.__otsu)
+        elif self.method == "adaptive":
+            mask, bg_color = self.__cached_mask(self.__adaptive)
+        else:
+            raise NotImplementedError
+
+        grid = self.__tile_grid(mask, bg_color)
+        patch_size = self.input_slide.patch_size
+        downsample = self.input_slide.output_downsample
+        level_w, level_h = grid["level_dims"]
+        reader = tile_reader.build_tile_reader(self.input_slide.slide, {
+            "tile_reader": self.input_slide.tile_reader,
+            "patch_size": patch_size,
+            "dzg_level": grid["dzg_level"],
+            "output_downsample": downsample,
+            "level_dims": grid["level_dims"],
+            "band_height": self.input_slide.band_height
+        })
+
+        # Only the rows of the shard are streamed, if requested
+        row_start, row_end = self.__shard_rows(grid["grid_coord"][1])
+        shard_grid = grid["preds_grid"][row_start:row_end]
+
+        rows, cols = np.nonzero(shard_grid)
+        self.metrics.count("tiles_evaluated", shard_grid.size)
+        for row, col in zip((rows + row_start).tolist(), cols.tolist()):
+
+            # Skip the non-square tiles of the last row and column, if requested
+            tile_w = min(patch_size, level_w - col * patch_size)
+            tile_h = min(patch_size, level_h - row * patch_size)
+            if not self.input_slide.save_nonsquare and tile_w != tile_h:
+                continue
+
+            bytes_read = reader.bytes_read
+            with self.metrics.stage("read"):
+                tile = np.asarray(reader.get_tile(col, row))
+            self.metrics.count("bytes_read", reader.bytes_read - bytes_read)
+            self.metrics.count("tiles_kept", 1)
+
+            yield row, col, (col * patch_size * downsample, row * patch_size * downsample), tile
+
+
+    def __cached_mask(self, segmentation):
+        """Obtains the mask from the mask cache, or computes it and stores it in the cache.
 
-        # Find best layer for downsampling
-        level0_dimensions = self.input_slide.slide.dimensions
+        Arguments:
+            segmentation: Method that computes the mask and the background color.
+
+        Returns:
+            mask: Numpy array with the mask.
+            bg_color: Numpy array indicating the background color.
+        """
+
+        if self.input_slide.mask_cache is None:
+            return segmentation()
+
+        # The intermediate images of the graph segmentation are not cached,
+        # so the segmentation is performed again if they are requested
+        need_intermediate = self.method == "graph" and (self.input_slide.save_mask or self.input_slide.save_edges)
+
+        with self.metrics.stage("mask_cache"):
+            cache = MaskCache(self.input_slide.mask_cache, self.input_slide.mask_cache_size * 2**20)
+            key = cache.key(self.input_slide)
+            cached = None if need_intermediate else cache.get(key)
+        if cached is not None:
+            logging.info("== Using cached mask ==")
+            mask, bg_color, self.__mask_threshold = cached
+
+            if self.input_slide.save_mask:
+                out_filename = self.input_slide.img_outpath + "mask_" + self.input_slide.sample_id + "." + self.input_slide.image_format
+                cv2.imwrite(out_filename, mask)
+        else:
+            mask, bg_color = segmentation()
+            with self.metrics.stage("mask_cache"):
+                cache.put(key, mask, bg_color, self.__mask_threshold)
+
+        return mask, bg_color
+
+
+    def __benchmark_codecs(self):
+        """Compares the encoding time and size of the tile codecs on a sample of tiles from the slide.
+
+        The results are written to codec_benchmark.tsv in the output folder.
+        """
+
+        logging.info("== Benchmarking tile codecs ==")
+
+        # Sample tiles of the requested size at the output downsampling
+        dzg = deepzoom.DeepZoomGenerator(self.input_slide.slide, tile_size=self.input_slide.patch_size, overlap=0)
+        dzg_levels = [2**i for i in range(0, dzg.level_count)][::-1]
+        dzg_level = dzg_levels.index(self.input_slide.output_downsample)
+        n_cols, n_rows = dzg.level_tiles[dzg_level]
+        positions = [(col, row) for row in range(n_rows) for col in range(n_cols)]
+        positions = random.sample(positions, min(len(positions), self.input_slide.codec_benchmark))
+        tiles = [dzg.get_tile(dzg_level, position) for position in positions]
+        raw_size = sum(np.asarray(tile).nbytes for tile in tiles)
+
+        results = []
+        for codec in tile_codecs.benchmark_codecs():
+            ts = time.time()
+            encoded_size = sum(len(codec.encode(tile)) for tile in tiles)
+            te = time.time()
+
+            results.append((codec.description(), round((te - ts) / len(tiles) * 1000, ndigits = 3),
+                            round(encoded_size / len(tiles) / 1024, ndigits = 2), round(raw_size / encoded_size, ndigits = 2)))
+
+        results = pd.DataFrame.from_records(results, columns=["Codec", "EncodeTime_ms", "Size_KB", "CompressionRatio"])
+        results.to_csv(self.input_slide.img_outpath + "codec_benchmark.tsv", index=False, sep="\t")
+        logging.info("Encoded " + str(len(tiles)) + " tiles of " + str(self.input_slide.patch_size) + "x" + str(self.input_slide.patch_size) + " pixels:\n" + results.to_string(index=False))
+
+
+    def __random_tiles(self):
+        """Reads tiles sampled at random positions of the slide.
+
+        The positions are sampled over the whole slide or, with tissue sampling,
+        over the foreground of a low resolution Otsu mask. Tiles are read in
+        batches, which are distributed across worker processes if requested.
+
+        Yields:
+            k: Sample number of the tile.
+            level0_xy: Tuple with the level 0 coordinates of the top left corner of the tile.
+            img: RGB PIL image with the tile.
+        """
 
         # At the optimal downsampling level, we need to calculate
         # a correction factor for the patch size
@@ -118,45 +398,157 @@ class TileGenerator:
         bestlevel_downsample = self.input_slide.slide.level_downsamples[level]
         bestlevel_patchsize = int(round(self.input_slide.output_downsample/bestlevel_downsample, ndigits = 1)*self.input_slide.patch_size)
 
-        # Calculate boundary pixel (top left pixel in
-        # lower right corner) at the best level for downsampling
-        boundary_pixel = [x - bestlevel_patchsize for x in self.input_slide.slide.level_dimensions[level]]
+        if self.input_slide.tissue_sampling:
+            positions = self.__tissue_positions()
+        else:
+            # Calculate boundary pixel (top left pixel in
+            # lower right corner) at the best level for downsampling
+            boundary_pixel = [x - bestlevel_patchsize for x in self.input_slide.slide.level_dimensions[level]]
+
+            # Subsample pixels at the best level, and scale them to level 0
+            pixel_pairs = zip(random.sample(range(0, boundary_pixel[0]), self.input_slide.npatches),
+                random.sample(range(0, boundary_pixel[1]), self.input_slide.npatches))
+            upscale_factor = round(bestlevel_downsample, ndigits = 1)
+            positions = [(int(w*upscale_factor), int(h*upscale_factor)) for w, h in pixel_pairs]
+
+        # Read the tiles in batches, either serially or across worker processes
+        read_args = {"level": level, "read_size": bestlevel_patchsize, "patch_size": self.input_slide.patch_size}
+        batch_size = int(np.ceil(len(positions) / (self.input_slide.workers * 4)))
+        batches = [positions[i:i + batch_size] for i in range(0, len(positions), batch_size)]
+
+        pool = None
+        if self.input_slide.workers > 1:
+            logging.debug("Distributing " + str(len(batches)) + " batches of tiles across " + str(self.input_slide.workers) + " workers.")
+            pool = multiprocessing.Pool(self.input_slide.workers, initializer=_init_random_worker, initargs=(self.input_slide.svs, read_args))
+            batch_results = pool.imap(_read_random_batch_worker, batches)
+        else:
+            batch_results = (_read_random_batch(self.input_slide.slide, read_args, batch) for batch in batches)
+
+        k = 0
+        try:
+            for batch_tiles, batch_metrics in batch_results:
+                self.metrics.merge(batch_metrics)
+                for level0_xy, img in batch_tiles:
+                    yield k, level0_xy, img
+                    k += 1
+        finally:
+            # All the batches have been read, unless the tiles stopped being requested
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        self.metrics.count("tiles_evaluated", len(positions))
+        self.metrics.count("tiles_kept", len(positions))
+
+
+    def __tissue_positions(self):
+        """Samples random tile positions over the foreground of the slide.
+
+        An Otsu mask of the slide is computed at the mask downsampling, and the
+        tissue fraction of a tile is evaluated at regularly spaced positions of
+        the mask. Positions are drawn from the ones with some tissue and at least
+        the content threshold, either uniformly or weighted by their tissue
+        fraction, and they are shifted by a random offset of whole mask pixels
+        within their spacing. A shifted tile is evaluated again on the mask, and
+        the position is not shifted if the shifted tile has less tissue than the
+        content threshold, so that every sampled tile meets it.
+
+        Returns:
+            positions: List of (x, y) level 0 coordinates of the top left corner
+                of the tiles, sorted in reading order.
+
+        Raises:
+            ValueError: If there are fewer foreground positions than requested tiles.
+        """
+
+        mask, bg_color = self.__cached_mask(self.__otsu)
+
+        with self.metrics.stage("sampling"):
+
+            # Size of a tile in the mask, and spacing of the evaluated positions
+            mask_downsample = self.input_slide.mask_downsample
+            window = max(1, int(round(self.input_slide.patch_size * self.input_slide.output_downsample / mask_downsample)))
+            stride = max(1, window // 4)
+
+            integral = utility_functions.foreground_integral(mask, bg_color)
+            index, fractions = utility_functions.foreground_index(integral, window, stride, self.input_slide.thres)
+            logging.debug("Foreground index: " + str(len(index)) + " positions with tissue out of " +
+                          str(int(np.ceil((mask.shape[0] - window + 1) / stride) * np.ceil((mask.shape[1] - window + 1) / stride))) + ".")
+            if len(index) < self.input_slide.npatches:
+                raise ValueError("Only " + str(len(index)) + " foreground positions were found to sample " +
+                                 str(self.input_slide.npatches) + " tiles. Reduce the number of tiles or the content threshold.")
+
+            # Draw the positions. The generator is seeded from the random module,
+            # so that seeding it makes the sampling reproducible
+            rng = np.random.default_rng(random.getrandbits(64))
+            weights = fractions / fractions.sum() if self.input_slide.sampling_weights == "tissue" else None
+            chosen = rng.choice(len(index), self.input_slide.npatches, replace=False, p=weights)
+
+            # Random offset within the spacing of the positions, keeping the tiles
+            # inside the mask. Shifted tiles without enough tissue are not shifted
+            positions = index[chosen]
+            max_position = np.array([mask.shape[1] - window, mask.shape[0] - window])
+            shifted = np.minimum(positions + rng.integers(0, stride, (len(chosen), 2)), max_position)
+            shifted_fractions = utility_functions.window_fractions(integral, shifted[:, 0], shifted[:, 1], window)
+            keep_shift = (shifted_fractions > 0) & (shifted_fractions >= self.input_slide.thres)
+            positions = np.where(keep_shift[:, np.newaxis], shifted, positions)
+
+            # Level 0 coordinates
+            level0_patchsize = self.input_slide.patch_size * self.input_slide.output_downsample
+            positions = positions * mask_downsample
+            positions = np.minimum(positions, np.subtract(self.input_slide.slide.dimensions, level0_patchsize))
+            positions = np.maximum(positions, 0)
 
-        # Subsample pixels at level 0
-        pixel_pairs = zip(random.sample(range(0, boundary_pixel[0]), self.input_slide.npatches),
-            random.sample(range(0, boundary_pixel[1]), self.input_slide.npatches))
+            # Reading the tiles in order improves the locality of the reads
+            positions = positions[np.lexsort((positions[:, 0], positions[:, 1]))]
 
-        # The specified self.patch_size is at self.output_downsample level.
-        # Need to calculate the patch size at level 0
-        upsample_patchsize = self.input_slide.patch_size * self.input_slide.output_downsample
-        upscale_factor = round(bestlevel_downsample, ndigits = 1)
+        return [(int(x), int(y)) for x, y in positions]
 
-        # Create folder to save the tiles
+
+    def __randomsampler(self):
+        """Extracts tiles randomly from a slide. Content thresholding is only performed with tissue sampling."""
+
+        logging.info("== Performing random tile sampling ==")
+
+        # Sample the positions of the tiles
+        random_tiles = self.__random_tiles()
+
+        # Create folder or tile store to save the tiles
+        codec = tile_codecs.get_codec(self.input_slide)
+        tile_store = None
+        pipeline = None
         if self.input_slide.save_patches:
-            self.input_slide._create_tile_folder()
+            if self.input_slide.output_store == "files":
+                self.input_slide._create_tile_folder()
+                if self.input_slide.queue_depth > 0:
+                    pipeline = TileWriterPipeline(codec, self.input_slide.queue_depth, self.input_slide.encoder_threads)
+            else:
+                tile_store = self.__open_tile_store({})
 
         # Start patch extraction
         digits_padding = len(str(self.input_slide.npatches))
-        k = 0
 
-        for w, h in list(pixel_pairs):
-            w_upscale, h_upscale = int(w*upscale_factor), int(h*upscale_factor)
-            img = self.input_slide.slide.read_region((w_upscale, h_upscale), level, (bestlevel_patchsize, bestlevel_patchsize))
-
-            # Resize if necessary. This condition will be true
-            # when downsampling is not required.
-            if bestlevel_patchsize != self.input_slide.patch_size:
-                img = img.resize((self.input_slide.patch_size, self.input_slide.patch_size))
+        for k, (w_upscale, h_upscale), img in random_tiles:
 
             # Save patch
-            if self.input_slide.save_patches:
-                output_filename = self.input_slide.tile_folder + self.input_slide.sample_id + "_" + str(k).zfill(digits_padding) + "." + self.input_slide.format
-                img.save(output_filename)
+            if tile_store is not None:
+                with self.metrics.stage("write"):
+                    tile_store.append(img, k, -1, -1, w_upscale, h_upscale, 1)
+                self.metrics.count("tiles_saved", 1)
+            elif self.input_slide.save_patches:
+                output_filename = self.input_slide.tile_folder + self.input_slide.sample_id + "_" + str(k).zfill(digits_padding) + "." + codec.extension
+                _save_tile(codec, pipeline, img, output_filename, self.metrics)
 
             # Print progress
             if (k+1) % 25 == 0 and self.input_slide.info != "silent":
                 sys.stdout.write(str(int((k+1)/self.input_slide.npatches*100)) + "%" + "\r")
-            k += 1
+
+        if tile_store is not None:
+            with self.metrics.stage("write"):
+                tile_store.close()
+            self.metrics.count("bytes_written", os.path.getsize(tile_store.path))
+        if pipeline is not None:
+            _close_pipeline(pipeline, self.metrics)
 
 
     def __graphtestmode(self):
@@ -171,18 +563,18 @@ class TileGenerator:
 
         logging.info("== Test mode for graph segmentation ==")
         logging.info("== Producing edge image ==")
-        self.__produce_edges()
+        edges = self.__produce_edges()
 
         logging.info("== Segmentation over the mask ==")
-        self.__segment_felzenszwalb()
+        labels, palette = self.__segment_felzenszwalb(edges)
+        mask = palette[labels]
 
         # Get information about arguments and image
         image_dims = self.input_slide.slide.dimensions  # (x, y) # UNPACK
         border_pct = self.input_slide.pct_bc / 100
         border_thickness = 2
 
-        # Since we read an numpy array, we need to change BGR -> RGB
-        mask = cv2.imread(self.input_slide.img_outpath + "segmented_" + self.input_slide.sample_id + ".ppm")  # (y, x)
+        # The mask is a BGR numpy array (y, x)
         resized_mask = cv2.resize(mask, (image_dims[0]//self.input_slide.test_downsample,
                                         image_dims[1]//self.input_slide.test_downsample))
 
@@ -208,7 +600,7 @@ class TileGenerator:
         resized_mask[height_range, (resized_mask.shape[1] - wpct - border_thickness):(resized_mask.shape[1] - wpct), :] = gcol
 
         # Write output image
-        outfile = self.input_slide.img_outpath + "test_" + self.input_slide.sample_id + "." + self.input_slide.format
+        outfile = self.input_slide.img_outpath + "test_" + self.input_slide.sample_id + "." + self.input_slide.image_format
         cv2.imwrite(outfile, resized_mask)
 
 
@@ -216,31 +608,26 @@ class TileGenerator:
         """Performs Felzenszwalb's efficient graph segmentation to obtain an image mask.
 
         Returns:
-            mask: PIL RGB image.
+            mask: Numpy array with the mask.
             bg_color: Numpy array indicating the background color.
         """
 
         utility_functions.check_compilation()
 
         logging.info("== Producing edge image ==")
-        self.__produce_edges()
+        edges = self.__produce_edges()
 
         logging.info("== Segmentation over the mask ==")
-        self.__segment_felzenszwalb()
+        labels, palette = self.__segment_felzenszwalb(edges)
 
-        ts = time.time()
-        mask = cv2.imread(self.input_slide.img_outpath + "segmented_" + self.input_slide.sample_id + ".ppm")
+        with self.metrics.stage("background"):
 
-        # Identify background colors from the mask
-        bg_color, bord = utility_functions.bg_color_identifier(mask, self.input_slide.pct_bc, self.input_slide.borders, self.input_slide.corners)
+            # Identify the background segments from the borders or corners of the image
+            bg_labels = utility_functions.bg_label_identifier(labels, self.input_slide.pct_bc, self.input_slide.borders, self.input_slide.corners)
 
-        # If we detect more than one background color, then we replace them all with the first detected background color
-        if bord.shape[0] > 1:
-            for i in range(1, bord.shape[0]):
-                mask[np.where((mask == bord[i]).all(axis=2))] = bg_color
+            # All the background segments take the first detected background color
+            mask, bg_color = utility_functions.graph_background(labels, palette, bg_labels)
 
-        # Convert to PIL
-        mask = Image.fromarray(mask)
         return mask, bg_color
 
 
@@ -248,12 +635,12 @@ class TileGenerator:
         """Performs Otsu thresholding to obtain an image mask.
 
         Returns:
-            mask: PIL RGB image.
+            mask: Numpy array with the mask.
             bg_color: Numpy array indicating the background color.
         """
 
         # Get downsampled version of the image
-        img, bdl = utility_functions.downsample_image(self.input_slide.slide, self.input_slide.mask_downsample)
+        img, bdl = self.__downsample_mask_image()
 
         # Information
         logging.debug("Otsu thresholding will be performed with mask downsampling of " + str(self.input_slide.mask_downsample) + "x.")
@@ -261,23 +648,17 @@ class TileGenerator:
         logging.debug("Using level " + str(bdl) + " to downsample.")
         logging.debug("Downsampled size: " + str(img.shape[::-1][1:3]))
 
-        # Reverse the image to BGR and convert to grayscale
-        img = img[:, :, ::-1]
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        with self.metrics.stage("segmentation"):
 
-        # Remove noise using a Gaussian filter
-        img = cv2.GaussianBlur(img, (5,5), 0)
-
-        # Otsu thresholding and mask generation
-        ret, thresh_otsu = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            # Otsu thresholding and mask generation
+            thresh_otsu, self.__mask_threshold = utility_functions.threshold_mask(img, "otsu")
 
         # Save mask if requested
         if self.input_slide.save_mask:
-            out_filename = self.input_slide.img_outpath + "mask_" + self.input_slide.sample_id + "." + self.input_slide.format
+            out_filename = self.input_slide.img_outpath + "mask_" + self.input_slide.sample_id + "." + self.input_slide.image_format
             cv2.imwrite(out_filename, thresh_otsu)
 
-        # Convert to PIL
-        mask = Image.fromarray(thresh_otsu)
+        mask = thresh_otsu
         bg_color = np.array([255, 255, 255])
 
         return mask, bg_color
@@ -289,12 +670,12 @@ class TileGenerator:
         Here the size of the neighbourhood is equal to 11 and the constant is equal to 2
 
         Returns:
-            mask: PIL RGB image.
+            mask: Numpy array with the mask.
             bg_color: Numpy array indicating the background color.
         """
 
         # Get downsampled version of the image
-        img, bdl = utility_functions.downsample_image(self.input_slide.slide, self.input_slide.mask_downsample)
+        img, bdl = self.__downsample_mask_image()
 
         # Information
         logging.debug("Adaptive thresholding will be performed with mask downsampling of " + str(self.input_slide.mask_downsample) + "x.")
@@ -302,35 +683,49 @@ class TileGenerator:
         logging.debug("Using level " + str(bdl) + " to downsample.")
         logging.debug("Downsampled size: " + str(img.shape[::-1][1:3]))
 
-        # Reverse the image to BGR and convert to grayscale
-        img = img[:, :, ::-1]
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        with self.metrics.stage("segmentation"):
 
-        # Adaptive thresholding and mask generation
-        thresh_adapt = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+            # Adaptive thresholding and mask generation
+            thresh_adapt, _ = utility_functions.threshold_mask(img, "adaptive")
 
         # Save mask if requested
         if self.input_slide.save_mask:
-            out_filename = self.input_slide.img_outpath + "mask_" + self.input_slide.sample_id + "." + self.input_slide.format
+            out_filename = self.input_slide.img_outpath + "mask_" + self.input_slide.sample_id + "." + self.input_slide.image_format
             cv2.imwrite(out_filename, thresh_adapt)
 
-        # Convert to PIL
-        mask = Image.fromarray(thresh_adapt)
+        mask = thresh_adapt
         bg_color = np.array([255, 255, 255])
 
         return mask, bg_color
 
 
     # --- Auxiliary functions ---
+    def __downsample_mask_image(self):
+        """Downsamples the slide to the mask downsampling factor.
+
+        Returns:
+            img: Read-only RGB numpy array with the downsampled slide (see PySlide.thumbnail).
+            bdl: Level of the slide used to downsample.
+        """
+
+        with self.metrics.stage("downsample"):
+            img, bdl, bytes_read = self.input_slide.thumbnail(self.input_slide.mask_downsample)
+
+        self.metrics.count("bytes_read", bytes_read)
+
+        return img, bdl
+
+
     def __produce_edges(self):
         """
         Detects edges of an image using cv2's Canny edge detector.
-        """
 
-        ts = time.time()
+        Returns:
+            edges: Numpy array with the edge image.
+        """
 
         # Read the image
-        img, bdl = utility_functions.downsample_image(self.input_slide.slide, self.input_slide.mask_downsample)
+        img, bdl = self.__downsample_mask_image()
 
         # Logging info
         logging.debug("Requested " + str(self.input_slide.mask_downsample) + "x downsampling for edge detection.")
@@ -338,61 +733,113 @@ class TileGenerator:
         logging.debug("Using level " + str(bdl) + " to downsample.")
         logging.debug("Downsampled size: " + str(img.shape[::-1][1:3]))
 
-        # Run Canny edge detector
-        edges = cv2.Canny(img, 100, 200)
+        with self.metrics.stage("edges", log=True):
 
-        # Save the produced image in PPM format to give to the segmentation algorithm
-        edges = Image.fromarray(edges)
-        warnings.filterwarnings("ignore")
+            # Run Canny edge detector
+            edges = cv2.Canny(img, 100, 200)
 
-        edges = edges.convert('RGB')
-        edges.save(self.input_slide.img_outpath + "edges_" + self.input_slide.sample_id + ".ppm", 'PPM')
-        warnings.filterwarnings("default")
-        te = time.time()
+            # Save the produced image in PPM format if requested, or to give it to
+            # the segmentation executable when the segmentation library is not available
+            if self.input_slide.save_edges or utility_functions.load_segmentation_library() is None:
+                edges_img = Image.fromarray(edges)
+                warnings.filterwarnings("ignore")
+
+                edges_img = edges_img.convert('RGB')
+                edges_img.save(self.input_slide.img_outpath + "edges_" + self.input_slide.sample_id + ".ppm", 'PPM')
+                warnings.filterwarnings("default")
 
-        logging.debug("Elapsed time: " + str(round(te-ts, ndigits = 3)) + "s")
+        return edges
 
 
-    def __segment_felzenszwalb(self):
+    def __segment_felzenszwalb(self, edges):
         '''
-        Invokes a shell process to run the graph-based segmentation algorithm
-        with a PPM image containing the edges from the Canny detector.
+        Runs the graph-based segmentation algorithm over the edges from the
+        Canny detector. The segmentation library is used to segment the image
+        in memory; if it is not available, a shell process is invoked to run
+        the segmentation executable with the PPM image containing the edges.
+
+        Arguments:
+            edges: Numpy array with the edge image.
+
+        Returns:
+            labels: int32 numpy array with the segment label of each pixel.
+            palette: Numpy array with the BGR color of each segment.
 
         Raises:
             SystemError: If an error ocurred during segmentation.
         '''
 
-        # Launch segmentation subprocess
-        ts = time.time()
-        edge_file = self.input_slide.img_outpath + "edges_" + self.input_slide.sample_id + ".ppm"
-        ppm_file = self.input_slide.img_outpath + "segmented_" + self.input_slide.sample_id + ".ppm"
-        command = ["src/graph_segmentation/segment", str(self.input_slide.sigma), str(self.input_slide.k_const), 
-        str(self.input_slide.minimum_segmentsize), edge_file, ppm_file]
-        
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
-        output, error = process.communicate()
-        te = time.time()
+        with self.metrics.stage("segmentation", log=True):
 
-        # Logging information
-        logging.debug("Elapsed time: " + str(round(te-ts, ndigits = 3)) + "s")
+            # The edges are given to the segmentation algorithm as an RGB image
+            edges = np.repeat(edges[:, :, np.newaxis], 3, axis=2)
+            labels, palette = utility_functions.segment_labels(edges, self.input_slide.sigma,
+                self.input_slide.k_const, self.input_slide.minimum_segmentsize)
 
-        if error is not None:
-            raise RuntimeError(error)
+            if labels is not None:
+                # Reverse the colors to BGR, as if the image was read with cv2
+                palette = np.ascontiguousarray(palette[:, ::-1])
 
+                # Keep the PPM image if the mask has to be saved
+                if self.input_slide.save_mask:
+                    cv2.imwrite(self.input_slide.img_outpath + "segmented_" + self.input_slide.sample_id + ".ppm", palette[labels])
+            else:
+                edge_file = self.input_slide.img_outpath + "edges_" + self.input_slide.sample_id + ".ppm"
+                ppm_file = self.input_slide.img_outpath + "segmented_" + self.input_slide.sample_id + ".ppm"
 
-    def __create_tiles(self, mask, bg_color):
-        """Create tiles given a PySlide and a mask.
+                # Launch segmentation subprocess
+                logging.debug("Segmentation library not available, using the segmentation executable.")
+                command = [utility_functions.segmentation_dir + "segment", str(self.input_slide.sigma), str(self.input_slide.k_const),
+                str(self.input_slide.minimum_segmentsize), edge_file, ppm_file]
+
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+                output, error = process.communicate()
+
+                if error is not None:
+                    raise RuntimeError(error)
+
+                labels, palette = utility_functions.image_labels(cv2.imread(ppm_file))
+
+        return labels, palette
+
+
+    def __open_tile_store(self, attrs):
+        """Opens the tile store to save the tiles of the slide.
 
         Arguments:
-            mask: PIL Image containing the mask for the slide.
-            bg_color: Numpy array indicating the color used for the background in the mask.
+            attrs: Dictionary with additional attributes to store in the file.
+
+        Returns:
+            tile_store: A TileStore object.
         """
 
-        ts = time.time()
+        store_attrs = {
+            "sample_id": self.input_slide.sample_id,
+            "method": self.method,
+            "patch_size": self.input_slide.patch_size,
+            "output_downsample": self.input_slide.output_downsample
+        }
+        store_attrs.update(attrs)
+
+        store_path = self.input_slide.img_outpath + self.input_slide.sample_id + "_tiles.h5"
+        return TileStore(store_path, self.input_slide.patch_size, store_attrs)
 
-        # Create folder for the patches
-        if self.input_slide.save_patches:
-            self.input_slide._create_tile_folder()
+
+    def __tile_grid(self, mask, bg_color):
+        """Builds the grid of tiles at the output downsampling and selects the tiles to keep.
+
+        Arguments:
+            mask: Numpy array containing the mask for the slide.
+            bg_color: Numpy array indicating the color used for the background in the mask.
+
+        Returns:
+            grid: Dictionary with the DeepZoomGenerator of the slide ("dzg"), its levels
+                ("dzg_levels"), the deep zoom level of the output downsampling ("dzg_level"),
+                its dimensions ("level_dims"), the number of columns and rows of the grid
+                ("grid_coord"), the number of digits of the tile indexes ("digits_padding"),
+                and the 2-D arrays with the prediction ("preds_grid") and the foreground
+                content ("foreground_grid") of each tile.
+        """
 
         # Initialize deep zoom generator for the slide
         image_dims = self.input_slide.slide.dimensions
@@ -411,38 +858,11 @@ class TileGenerator:
         # Calculate patch size in the mask
         mask_patch_size = int(np.ceil(self.input_slide.patch_size * (self.input_slide.output_downsample/self.input_slide.mask_downsample)))
 
-        # Deep zoom generator for the mask
-        dzgmask = deepzoom.DeepZoomGenerator(openslide.ImageSlide(mask), tile_size=mask_patch_size, overlap=0)
-        dzgmask_dims = dzgmask.level_dimensions[dzgmask.level_count - 1]
-        dzgmask_maxtilecoords = dzgmask.level_tiles[dzgmask.level_count - 1]
+        # Grid of tiles over the mask
+        dzgmask_dims = (mask.shape[1], mask.shape[0])
+        dzgmask_maxtilecoords = tuple(int(np.ceil(x / mask_patch_size)) for x in dzgmask_dims)
         dzgmask_ntiles = np.prod(dzgmask_maxtilecoords)
 
-        # If needed, generate an image to store tile-crossed output, at the requested tilecross downsample level
-        if self.input_slide.save_tilecrossed_image:
-
-            # Get a downsampled numpy array for the image
-            tilecrossed_img = utility_functions.downsample_image(self.input_slide.slide,
-                self.input_slide.tilecross_downsample, mode="numpy")[0]
-
-            # Calculate patch size in the mask
-            tilecross_patchsize = int(np.ceil(self.input_slide.patch_size * (self.input_slide.output_downsample/self.input_slide.tilecross_downsample)))
-
-            # Draw the grid at the scaled patchsize
-            x_shift, y_shift = tilecross_patchsize, tilecross_patchsize
-            gcol = [255, 0, 0]
-            tilecrossed_img[:, ::y_shift, :] = gcol
-            tilecrossed_img[::x_shift, :, :] = gcol
-
-            # Convert numpy array to PIL image
-            tilecrossed_img = Image.fromarray(tilecrossed_img, mode="RGB")
-
-            # Create object to draw the crosses for each tile
-            draw = ImageDraw.Draw(tilecrossed_img)
-
-            # Counters for iterating through the tile-crossed image tiles
-            tc_w = 0
-            tc_h = 0
-
         # Debug information
         logging.debug("** Original image information **")
         logging.debug("-Dimensions: " + str(image_dims))
@@ -475,106 +895,502 @@ class TileGenerator:
         else:
             grid_coord = dzg_selectedlevel_maxtilecoords
 
-        # Counters
-        preds = [0] * n_tiles
-        row, col, i = 0, 0, 0
-        tile_names = []
-        tile_dims_w = []
-        tile_dims_h = []
-        tile_rows = []
-        tile_cols = []
-
-        # Evaluate tiles using the selector function
-        while row < grid_coord[1]:
-
-            # Extract the tile from the mask (the last level is used
-            # since the mask is already rescaled)
-            mask_tile = dzgmask.get_tile(dzgmask.level_count - 1, (col, row))
-
-            # Tile converted to BGR
-            mask_tile = np.array(mask_tile)
-
-            # Predict if the tile will be kept (1) or not (0)
-            preds[i] = utility_functions.selector(mask_tile, self.input_slide.thres, bg_color, self.input_slide.method)
-
-            # Save patches if requested
-            if self.input_slide.save_patches:
-                tile = dzg.get_tile(dzg_selectedlevel_idx, (col, row))
-
-                # If we need square patches only, we set the prediction to zero if the tile is not square
-                if not self.input_slide.save_nonsquare:
-                    if tile.size[0] != tile.size[1]:
-                        preds[i] = 0
-
-                # Prepare metadata
-                tile_names.append(self.input_slide.sample_id + "_" + str(i).zfill(digits_padding))
-                tile_dims_w.append(tile.size[0])
-                tile_dims_h.append(tile.size[1])
-                tile_rows.append(row)
-                tile_cols.append(col)
-
-                # Save tile
-                imgtile_out = self.input_slide.tile_folder + tile_names[i] + "." + self.input_slide.format
-                if self.input_slide.save_blank:
-                    tile.save(imgtile_out)
-                else:
-                    if preds[i] == 1:
-                        tile.save(imgtile_out)
-
-            # Draw cross over corresponding patch section on tilecrossed image
-            if self.input_slide.save_tilecrossed_image:
-                start_w = col * (tilecross_patchsize)
-                start_h = row * (tilecross_patchsize)
-
-                # If we reach the edge of the image, we only can draw until the edge pixel
-                if (start_w + tilecross_patchsize) >= tilecrossed_img.size[0]:
-                    cl_w = tilecrossed_img.size[0] - start_w
-                else:
-                    cl_w = tilecross_patchsize
-
-                if (start_h + tilecross_patchsize) >= tilecrossed_img.size[1]:
-                    cl_h = tilecrossed_img.size[1] - start_h
-                else:
-                    cl_h = tilecross_patchsize
-
-                # Draw the cross only if the tile has to be kept
-                if preds[i] == 1:
-
-                    # From top left to bottom right
-                    draw.line([(start_w, start_h), (start_w + cl_w, start_h + cl_h)], fill=(0, 0, 255), width=3)
-
-                    # From bottom left to top right
-                    draw.line([(start_w, start_h + cl_h), (start_w + cl_w, start_h)], fill=(0, 0, 255), width=3)
-
-                # Jump to the next tilecross tile
-                tc_w = tc_w + tilecross_patchsize + 1
-
-            # Jump to the next column tile
-            col += 1
-
-            # If we reach the right edge of the image, jump to the next row
-            if col == grid_coord[0]:
-                col = 0
-                row += 1
-
-                if self.input_slide.save_tilecrossed_image:
-                    tc_w = 0
-                    tc_h = tc_h + tilecross_patchsize + 1
-
-            # Increase counter for metadata
-            i += 1
-
-        # Saving tilecrossed image
+        # Predict if each tile of the grid will be kept (1) or not (0)
+        with self.metrics.stage("selection"):
+            preds_grid, foreground_grid = utility_functions.selector_grid(mask, mask_patch_size, self.input_slide.thres, bg_color,
+                                                                          self.input_slide.method, return_foreground=True)
+            preds_grid = preds_grid[:grid_coord[1], :grid_coord[0]]
+            foreground_grid = foreground_grid[:grid_coord[1], :grid_coord[0]]
+        logging.debug("Tile selection time: " + str(round(self.metrics.stages["selection"]["wall_s"], ndigits = 3)) + "s")
+
+        # Evaluate the tiles close to the content threshold again on a finer mask
+        if self.input_slide.refine_downsample is not None:
+            with self.metrics.stage("refine", log=True):
+                self.__refine_selection(preds_grid, foreground_grid)
+
+        return {
+            "dzg": dzg,
+            "dzg_levels": dzg_levels,
+            "dzg_level": dzg_selectedlevel_idx,
+            "level_dims": dzg_selectedlevel_dims,
+            "grid_coord": grid_coord,
+            "digits_padding": digits_padding,
+            "preds_grid": preds_grid,
+            "foreground_grid": foreground_grid
+        }
+
+
+    def __refine_selection(self, preds_grid, foreground_grid):
+        """Evaluates the ambiguous tiles of the grid again at the refine downsampling factor.
+
+        The tiles at the tissue borders (those with both tissue and background
+        in the mask of the tile and its neighbours) whose foreground content is
+        within --refine-margin of the content threshold are ambiguous, since the
+        coarse mask pixels at the borders mix tissue and background, and thin
+        tissue can be lost in them. Only the windows of the slide covered by
+        these tiles (one per run of consecutive tiles of a row) are downsampled
+        to the refine factor and thresholded as the whole slide was, with the
+        same threshold for Otsu thresholding, and the tiles are selected from
+        this finer mask. The other tiles keep the selection of the mask. The
+        grids are updated in place.
+
+        Arguments:
+            preds_grid: 2-D numpy array with the prediction of each tile.
+            foreground_grid: 2-D numpy array with the foreground content of each tile.
+        """
+
+        slide = self.input_slide.slide
+        refine_downsample = self.input_slide.refine_downsample
+        thres = self.input_slide.thres
+
+        # Largest and smallest foreground content of each tile and its neighbours
+        kernel = np.ones((3, 3), dtype=np.uint8)
+        neighbours_max = cv2.dilate(foreground_grid.astype(np.float32), kernel, borderType=cv2.BORDER_REPLICATE)
+        neighbours_min = cv2.erode(foreground_grid.astype(np.float32), kernel, borderType=cv2.BORDER_REPLICATE)
+        ambiguous = (neighbours_max > 0) & (neighbours_min < 1) & (np.abs(foreground_grid - thres) <= self.input_slide.refine_margin)
+        rows, cols = np.nonzero(ambiguous)
+        logging.debug("Refining the selection of " + str(len(rows)) + " of " + str(preds_grid.size) +
+                      " tiles at " + str(refine_downsample) + "x downsampling.")
+
+        # The Otsu threshold of the slide is not stored in old mask cache entries
+        if self.method == "otsu" and self.__mask_threshold is None:
+            img, bdl = self.__downsample_mask_image()
+            _, self.__mask_threshold = utility_functions.threshold_mask(img, "otsu")
+
+        # Size of a tile and of the whole slide at the refine downsampling factor
+        window_size = int(np.ceil(self.input_slide.patch_size * (self.input_slide.output_downsample / refine_downsample)))
+        fine_w, fine_h = [int(x // refine_downsample) for x in slide.dimensions]
+        padding = utility_functions.threshold_mask_padding[self.method]
+
+        bytes_read = 0
+        for row in np.unique(rows).tolist():
+
+            # Consecutive ambiguous tiles of a row are read in a single window
+            row_cols = cols[rows == row]
+            for run in np.split(row_cols, np.nonzero(np.diff(row_cols) > 1)[0] + 1):
+                x0, y0 = int(run[0]) * window_size, row * window_size
+                x1, y1 = min(fine_w, (int(run[-1]) + 1) * window_size), min(fine_h, y0 + window_size)
+                if x1 <= x0 or y1 <= y0:
+                    continue
+
+                # The window is read with the pixels around it that change its mask
+                px0, py0 = max(0, x0 - padding), max(0, y0 - padding)
+                px1, py1 = min(fine_w, x1 + padding), min(fine_h, y1 + padding)
+                img, window_bytes = utility_functions.downsample_window(slide, refine_downsample, (px0, py0, px1, py1))
+                bytes_read += window_bytes
+
+                window_mask, _ = utility_functions.threshold_mask(img, self.method, self.__mask_threshold)
+                window_mask = window_mask[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+                for col in run.tolist():
+                    tile_mask = window_mask[:, col * window_size - x0:(col + 1) * window_size - x0]
+                    if tile_mask.size == 0:
+                        continue
+                    bg_proportion = np.mean(tile_mask == 255)
+                    preds_grid[row, col] = int(bg_proportion <= (1 - thres))
+                    foreground_grid[row, col] = 1 - bg_proportion
+
+        self.metrics.count("bytes_read", bytes_read)
+        self.metrics.count("tiles_refined", len(rows))
+
+
+    def __save_tilecrossed_image(self, preds_grid):
+        """Saves a thumbnail of the slide at the tilecross downsampling, with a cross over each selected tile.
+
+        Arguments:
+            preds_grid: 2-D numpy array with the prediction [0/1] of each tile of the grid.
+        """
+
+        with self.metrics.stage("tilecross"):
+
+            # Get a downsampled numpy array for the image, copied
+            # from the cached thumbnail to draw over it
+            tilecrossed_img, _, bytes_read = self.input_slide.thumbnail(self.input_slide.tilecross_downsample)
+            tilecrossed_img = tilecrossed_img.copy()
+
+            # Calculate patch size in the tilecrossed image
+            tilecross_patchsize = int(np.ceil(self.input_slide.patch_size * (self.input_slide.output_downsample/self.input_slide.tilecross_downsample)))
+
+            # Draw the grid at the scaled patchsize
+            x_shift, y_shift = tilecross_patchsize, tilecross_patchsize
+            gcol = [255, 0, 0]
+            tilecrossed_img[:, ::y_shift, :] = gcol
+            tilecrossed_img[::x_shift, :, :] = gcol
+
+            # Draw a cross over the tiles that have to be kept
+            utility_functions.draw_tile_crosses(tilecrossed_img, preds_grid, tilecross_patchsize)
+
+            # Saving tilecrossed image
+            tilecrossed_outpath = self.input_slide.img_outpath + "/tilecrossed_" + self.input_slide.sample_id + "." + self.input_slide.image_format
+            Image.fromarray(tilecrossed_img, mode="RGB").save(tilecrossed_outpath)
+
+        self.metrics.count("bytes_read", bytes_read)
+
+
+    def __tilecross_from_selection(self):
+        """Saves the tilecrossed image of a previous run from its tile selection, without selecting the tiles again.
+
+        Raises:
+            FileNotFoundError: If the tile selection of the slide is not in the output folder.
+            ValueError: If the tile selection does not match the patch size and output downsampling.
+        """
+
+        logging.info("== Drawing the tilecrossed image from the tile selection ==")
+
+        # The tile selection can be saved in any of the metadata formats
+        selection_path = self.input_slide.img_outpath + "tile_selection"
+        if os.path.isfile(selection_path + ".tsv"):
+            selection = pd.read_csv(selection_path + ".tsv", sep="\t")
+        elif os.path.isfile(selection_path + ".parquet"):
+            selection = pd.read_parquet(selection_path + ".parquet", columns=["Row", "Column", "Keep", "Downsample"])
+        elif os.path.isfile(selection_path + ".arrow"):
+            selection = pd.read_feather(selection_path + ".arrow", columns=["Row", "Column", "Keep", "Downsample"])
+        else:
+            raise FileNotFoundError("The tile selection " + selection_path + ".tsv does not exist. It is saved with --save-patches.")
+
+        # With several output downsampling factors, the tiles are selected at the coarsest one
+        if "Downsample" in selection.columns:
+            selection = selection[selection["Downsample"] == selection["Downsample"].max()]
+
+        preds_grid = np.zeros((selection["Row"].max() + 1, selection["Column"].max() + 1), dtype=int)
+        preds_grid[selection["Row"].values, selection["Column"].values] = selection["Keep"].values
+
+        # The grid can only lose its last row or column, when the mask does not cover it
+        level0_tilesize = self.input_slide.patch_size * self.input_slide.output_downsample
+        n_cols, n_rows = [int(np.ceil(x / level0_tilesize)) for x in self.input_slide.slide.dimensions]
+        if not (0 <= n_rows - preds_grid.shape[0] <= 1 and 0 <= n_cols - preds_grid.shape[1] <= 1):
+            raise ValueError("The tile selection does not match the patch size and output downsampling of the slide.")
+
+        self.__save_tilecrossed_image(preds_grid)
+
+
+    def __shard_rows(self, n_rows):
+        """Range of rows of the tile grid extracted by this run.
+
+        With --shard I/N, the rows of the grid are split in N ranges of
+        consecutive rows of the same size (up to one row), and the I-th
+        range is extracted. Otherwise, all the rows are extracted.
+
+        Arguments:
+            n_rows: Number of rows of the tile grid.
+
+        Returns:
+            row_start: First row of the range (inclusive).
+            row_end: Last row of the range (exclusive).
+        """
+
+        if self.input_slide.shard is None:
+            return 0, n_rows
+
+        shard, n_shards = self.input_slide.shard
+        shard_edges = np.linspace(0, n_rows, n_shards + 1).astype(int)
+        logging.info("Extracting the rows " + str(shard_edges[shard]) + " to " + str(shard_edges[shard + 1] - 1) +
+                     " of the tile grid (shard " + str(shard) + " of " + str(n_shards) + ").")
+
+        return int(shard_edges[shard]), int(shard_edges[shard + 1])
+
+
+    def __merge_shards(self):
+        """Merges the tile selections written by the shards of a slide (see --shard) into a single one.
+
+        The tilecrossed image of the merged tile selection is saved, if requested.
+        """
+
+        logging.info("== Merging the tile selections of the shards ==")
+
+        with self.metrics.stage("metadata"):
+            n_shards = tile_metadata.merge_shards(self.input_slide.img_outpath + "tile_selection", self.input_slide.metadata_format)
+        logging.info("Merged the tile selections of " + str(n_shards) + " shards.")
+
         if self.input_slide.save_tilecrossed_image:
-            tilecrossed_outpath = self.input_slide.img_outpath + "/tilecrossed_" + self.input_slide.sample_id + "." + self.input_slide.format
-            tilecrossed_img.save(tilecrossed_outpath)
+            self.__tilecross_from_selection()
+
+
+    def __resumable_bands(self, checkpoint, band_args):
+        """Finds the bands of an interrupted run that do not need to be extracted again.
+
+        The bands recorded in the checkpoint are kept up to the first one with
+        a missing or empty tile file.
+
+        Arguments:
+            checkpoint: A TilingCheckpoint object.
+            band_args: Dictionary with the tile extraction arguments.
+
+        Returns:
+            bands: List with the records of the completed bands, in row order.
+        """
+
+        with self.metrics.stage("checkpoint"):
+            extension = band_args["codec"].extension
+            level_tile_folders = {level_args["downsample"]: level_args["tile_folder"] for level_args in band_args["child_levels"]}
+
+            bands = []
+            next_row = 0
+            for band in checkpoint.load():
+                if band["rows"][0] != next_row:
+                    break
+
+                # Tile files that should have been written for the band
+                paths = []
+                if band_args["save_patches"]:
+                    for (name, w, h, row, col), pred in zip(band["metadata"], band["preds"]):
+                        if band_args["save_blank"] or pred == 1:
+                            paths.append(band_args["tile_folder"] + name + "." + extension)
+                    for name, w, h, pred, row, col, downsample, parent in band["children"]:
+                        if band_args["save_blank"] or pred == 1:
+                            paths.append(level_tile_folders[downsample] + name + "." + extension)
+
+                if not all(os.path.isfile(path) and os.path.getsize(path) > 0 for path in paths):
+                    logging.debug("Missing tiles in rows " + str(band["rows"][0]) + "-" + str(band["rows"][1]) + ", extracting them again.")
+                    break
+
+                bands.append(band)
+                next_row = band["rows"][1]
+
+        logging.info("Resuming tile extraction from row " + str(next_row) + " of " + str(band_args["grid_coord"][1]) + ".")
+
+        return bands
+
+
+    def __metadata_rows(self, band_args, grid, band_preds, band_metadata, band_children):
+        """Builds the rows of the tile metadata of a band (see TileMetadataWriter).
+
+        Arguments:
+            band_args: Dictionary with the tile extraction arguments.
+            grid: Dictionary with the tile grid (see __tile_grid).
+            band_preds: List with the predictions of the tiles of the band.
+            band_metadata: List of (name, width, height, row, column) tuples of the tiles of the band.
+            band_children: List of (name, width, height, prediction, row, column, downsampling,
+                parent) tuples of the tiles of the band at the finer output downsampling factors.
+
+        Returns:
+            rows: List with the metadata rows of the tiles of the band, where each tile
+                is followed by the tiles it contains at the finer factors. The foreground
+                content of the tiles at the finer factors is not evaluated, so it is None.
+        """
+
+        patch_size = self.input_slide.patch_size
+        downsample = self.input_slide.output_downsample
+        extension = "." + band_args["codec"].extension
+        store_path = self.input_slide.img_outpath + self.input_slide.sample_id + "_tiles.h5"
+
+        # The children of a tile are listed after it, each one followed by its own
+        # children, so each child at the first finer factor starts a group of
+        # consecutive children of the same tile of the band
+        child_groups = {}
+        for child in band_children:
+            if child[6] == band_args["child_levels"][0]["downsample"]:
+                group = child_groups.setdefault(child[7], [])
+            group.append(child)
+
+        rows = []
+        for (name, w, h, row, col), pred in zip(band_metadata, band_preds):
+            if not (band_args["save_blank"] or pred == 1):
+                path = None
+            elif band_args["output_store"] == "files":
+                path = band_args["tile_folder"] + name + extension
+            else:
+                path = store_path
+            rows.append((name, w, h, pred, row, col, downsample, None, col * patch_size * downsample,
+                         row * patch_size * downsample, float(grid["foreground_grid"][row, col]), path))
+
+            for child_name, w, h, pred, row, col, child_downsample, parent in child_groups.get(name, []):
+                path = self.input_slide.level_tile_folders[child_downsample] + child_name + extension if band_args["save_blank"] or pred == 1 else None
+                rows.append((child_name, w, h, pred, row, col, child_downsample, parent, col * patch_size * child_downsample,
+                             row * patch_size * child_downsample, None, path))
+
+        return rows
+
+
+    def __create_tiles(self, mask, bg_color):
+        """Create tiles given a PySlide and a mask.
 
-        # Save predictions for each tile
+        Arguments:
+            mask: Numpy array containing the mask for the slide.
+            bg_color: Numpy array indicating the color used for the background in the mask.
+        """
+
+        ts = time.time()
+
+        # Create folder for the patches
+        if self.input_slide.save_patches and self.input_slide.output_store == "files":
+            self.input_slide._create_tile_folder()
+
+        grid = self.__tile_grid(mask, bg_color)
+        dzg = grid["dzg"]
+        dzg_levels = grid["dzg_levels"]
+        dzg_selectedlevel_idx = grid["dzg_level"]
+        dzg_selectedlevel_dims = grid["level_dims"]
+        grid_coord = grid["grid_coord"]
+        digits_padding = grid["digits_padding"]
+        preds_grid = grid["preds_grid"]
+
+        # Arguments needed to extract a band of rows from the grid
+        band_args = {
+            "svs": self.input_slide.svs,
+            "patch_size": self.input_slide.patch_size,
+            "dzg_level": dzg_selectedlevel_idx,
+            "output_downsample": self.input_slide.output_downsample,
+            "tile_reader": self.input_slide.tile_reader,
+            "band_height": self.input_slide.band_height,
+            "level_dims": dzg_selectedlevel_dims,
+            "grid_coord": grid_coord,
+            "digits_padding": digits_padding,
+            "save_patches": self.input_slide.save_patches,
+            "save_blank": self.input_slide.save_blank,
+            "save_nonsquare": self.input_slide.save_nonsquare,
+            "sample_id": self.input_slide.sample_id,
+            "tile_folder": getattr(self.input_slide, "tile_folder", None),
+            "codec": tile_codecs.get_codec(self.input_slide),
+            "output_store": self.input_slide.output_store,
+            "queue_depth": self.input_slide.queue_depth,
+            "encoder_threads": self.input_slide.encoder_threads
+        }
+
+        # Finer output downsampling factors, whose tiles are extracted below each selected tile
+        band_args["child_levels"] = []
+        output_downsamples = getattr(self.input_slide, "output_downsamples", [self.input_slide.output_downsample])
         if self.input_slide.save_patches:
-            patch_results = []
-            patch_results.extend(list(zip(tile_names, tile_dims_w, tile_dims_h, preds, tile_rows, tile_cols)))
-            patch_results_df = pd.DataFrame.from_records(patch_results, columns=["Tile", "Width", "Height", "Keep", "Row", "Column"])
-            patch_results_df.to_csv(self.input_slide.img_outpath + "tile_selection.tsv", index=False, sep="\t")
+            for parent_downsample, downsample in zip(output_downsamples[:-1], output_downsamples[1:]):
+                level_idx = dzg_levels.index(downsample)
+                band_args["child_levels"].append({
+                    "downsample": downsample,
+                    "factor": parent_downsample // downsample,
+                    "patch_size": self.input_slide.patch_size,
+                    "dzg_level": level_idx,
+                    "output_downsample": downsample,
+                    "level_dims": dzg.level_dimensions[level_idx],
+                    "grid_coord": dzg.level_tiles[level_idx],
+                    "digits_padding": len(str(np.prod(dzg.level_tiles[level_idx]))),
+                    "tile_folder": self.input_slide.level_tile_folders[downsample],
+                    # Children are requested tile by tile, so they are not read in regions
+                    "tile_reader": "native" if self.input_slide.tile_reader == "region" else self.input_slide.tile_reader,
+                    "band_height": self.input_slide.band_height
+                })
+                logging.debug("Tiles will also be saved at " + str(downsample) + "x downsampling, " +
+                              str(dzg.level_tiles[level_idx]) + " max tile coordinates.")
+
+        # Rows of the grid extracted by this run: all of them, or those of its shard
+        row_start, row_end = self.__shard_rows(grid_coord[1])
+        n_rows = row_end - row_start
+
+        # Split the rows of the grid in bands. When the tiles are written to a
+        # tile store, they are returned with each band, so bands are kept to a single row
+        if self.input_slide.save_patches and self.input_slide.output_store != "files":
+            n_bands = n_rows
+            tile_store = self.__open_tile_store({"grid_rows": grid_coord[1], "grid_cols": grid_coord[0]})
+        else:
+            n_bands = min(n_rows, self.input_slide.workers * 4)
+            tile_store = None
+
+            # With checkpoints, bands are small enough to record the progress every few rows
+            if self.input_slide.checkpoint_rows > 0:
+                n_bands = max(n_bands, int(np.ceil(n_rows / self.input_slide.checkpoint_rows)))
+        band_edges = np.linspace(row_start, row_end, n_bands + 1).astype(int)
+
+        # With the region reader, bands are aligned to the regions it reads,
+        # so that no region is read by more than one band
+        if self.input_slide.tile_reader == "region":
+            n_region_rows = tile_reader.region_rows(self.input_slide.slide, self.input_slide.patch_size,
+                                                    self.input_slide.output_downsample, self.input_slide.band_height)
+            band_edges = np.unique(np.concatenate([[row_start], np.round(band_edges / n_region_rows).astype(int) * n_region_rows, [row_end]]))
+            band_edges = band_edges[(band_edges >= row_start) & (band_edges <= row_end)]
+
+        # Resume after the last band recorded in the checkpoint of an interrupted run
+        checkpoint = None
+        resumed_bands = []
+        if self.input_slide.checkpoint_rows > 0:
+            checkpoint = TilingCheckpoint(self.input_slide.img_outpath + "tiling_checkpoint" + self.input_slide.shard_suffix + ".jsonl", {
+                "selection": TilingCheckpoint.selection_hash(preds_grid),
+                "grid_coord": [int(x) for x in grid_coord],
+                "rows": [int(row_start), int(row_end)],
+                "patch_size": self.input_slide.patch_size,
+                "output_downsamples": output_downsamples,
+                "save_patches": self.input_slide.save_patches,
+                "save_blank": self.input_slide.save_blank,
+                "save_nonsquare": self.input_slide.save_nonsquare,
+                "extension": band_args["codec"].extension
+            })
+            if self.input_slide.resume:
+                resumed_bands = self.__resumable_bands(checkpoint, band_args)
+            checkpoint.start(resumed_bands)
+
+            if resumed_bands:
+                resume_row = resumed_bands[-1]["rows"][1]
+                band_edges = np.unique(np.append(resume_row, band_edges[band_edges > resume_row]))
+        bands = list(zip(band_edges[:-1], band_edges[1:]))
+
+        # Extract the tiles, either serially or distributing the bands across worker processes
+        pool = None
+        if self.input_slide.workers > 1:
+            logging.debug("Distributing " + str(len(bands)) + " row bands across " + str(self.input_slide.workers) + " workers.")
+            pool = multiprocessing.Pool(self.input_slide.workers, initializer=_init_tile_worker, initargs=(band_args, preds_grid))
+            band_results = pool.imap(_extract_row_band_worker, bands)
+        else:
+            readers = _build_tile_readers(self.input_slide.slide, band_args)
+            band_results = (_extract_row_band(band_args, readers, preds_grid, start, end) for start, end in bands)
+
+        # The metadata of the tiles is written while the bands are gathered
+        metadata_writer = None
+        if self.input_slide.save_patches:
+            metadata_writer = tile_metadata.TileMetadataWriter(self.input_slide.img_outpath + "tile_selection" + self.input_slide.shard_suffix,
+                                                               self.input_slide.metadata_format, bool(band_args["child_levels"]))
+
+        # Gather the results of each band, which are returned in row order,
+        # starting with the bands completed before the run was interrupted
+        resumed_results = [(band["preds"], band["metadata"], [], band["children"], PipelineMetrics()) for band in resumed_bands]
+        preds = []
+        try:
+            for band_idx, band_result in enumerate(itertools.chain(resumed_results, band_results)):
+                band_preds, band_metadata, band_tiles, band_children, band_metrics = band_result
+                self.metrics.merge(band_metrics)
+                preds.extend(band_preds)
+
+                if metadata_writer is not None:
+                    with self.metrics.stage("metadata"):
+                        metadata_writer.append(self.__metadata_rows(band_args, grid, band_preds, band_metadata, band_children))
+
+                # Level 0 coordinates of the tile are given by its position in the grid
+                for i, row, col, pred, tile in band_tiles:
+                    l0_patch_size = self.input_slide.patch_size * self.input_slide.output_downsample
+                    with self.metrics.stage("write"):
+                        tile_store.append(tile, i, row, col, col * l0_patch_size, row * l0_patch_size, pred)
+
+                # All the tiles of the band are written once it is returned
+                if checkpoint is not None and band_idx >= len(resumed_results):
+                    row_start, row_end = bands[band_idx - len(resumed_results)]
+                    with self.metrics.stage("checkpoint"):
+                        checkpoint.append({"rows": [row_start, row_end], "preds": band_preds,
+                                           "metadata": band_metadata, "children": band_children})
+
+            if metadata_writer is not None:
+                with self.metrics.stage("metadata"):
+                    metadata_writer.close()
+        except BaseException:
+            if metadata_writer is not None:
+                metadata_writer.abort()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if tile_store is not None:
+                with self.metrics.stage("write"):
+                    tile_store.close()
+                self.metrics.count("bytes_written", os.path.getsize(tile_store.path))
+            if checkpoint is not None:
+                checkpoint.close()
+
+        self.metrics.count("tiles_evaluated", len(preds))
+        self.metrics.count("tiles_kept", sum(preds))
+
+        # Draw the selected tiles over an overview of the slide
+        if self.input_slide.save_tilecrossed_image:
+            self.__save_tilecrossed_image(np.array(preds).reshape(grid_coord[1], grid_coord[0]))
+
+        # The checkpoint is no longer needed once all the output is written
+        if checkpoint is not None:
+            checkpoint.remove()
 
         # Finishing
         te = time.time()
@@ -583,4 +1399,292 @@ class TileGenerator:
         if self.input_slide.save_blank:
             logging.debug("Selected " + str(len(preds)) + " tiles")
         else:
-            logging.debug("Selected " + str(sum(preds)) + " tiles")
\ No newline at end of file
+            logging.debug("Selected " + str(sum(preds)) + " tiles")
+
+# --- Row band extraction ---
+# State of a tile extraction worker process, set up once by
+# _init_tile_worker (or _init_random_worker in random sampling)
+_worker_state = {}
+
+
+def _init_tile_worker(band_args, preds_grid):
+    """Initializes a worker process for tile extraction.
+
+    Each worker opens its own handle to the slide, since OpenSlide objects
+    cannot be shared across processes.
+
+    Args:
+        band_args: Dictionary with the tile extraction arguments.
+        preds_grid: 2-D numpy array with the tile selection predictions.
+    """
+
+    slide = openslide.OpenSlide(band_args["svs"])
+    _worker_state["band_args"] = band_args
+    _worker_state["readers"] = _build_tile_readers(slide, band_args)
+    _worker_state["preds_grid"] = preds_grid
+
+
+def _extract_row_band_worker(band):
+    """Extracts a band of rows using the state of the current worker process.
+
+    Args:
+        band: Tuple with the first (inclusive) and last (exclusive) rows of the band.
+
+    Returns:
+        See _extract_row_band.
+    """
+
+    return _extract_row_band(_worker_state["band_args"], _worker_state["readers"], _worker_state["preds_grid"], band[0], band[1])
+
+
+def _init_random_worker(svs, read_args):
+    """Initializes a worker process for random sampling.
+
+    Args:
+        svs: Path to the slide.
+        read_args: Dictionary with the arguments to read the tiles (see _read_random_batch).
+    """
+
+    _worker_state["slide"] = openslide.OpenSlide(svs)
+    _worker_state["read_args"] = read_args
+
+
+def _read_random_batch_worker(positions):
+    """Reads a batch of random tiles using the state of the current worker process.
+
+    Args:
+        positions: List of (x, y) level 0 coordinates of the tiles.
+
+    Returns:
+        See _read_random_batch.
+    """
+
+    return _read_random_batch(_worker_state["slide"], _worker_state["read_args"], positions)
+
+
+def _read_random_batch(slide, read_args, positions):
+    """Reads a batch of tiles sampled at random positions.
+
+    Args:
+        slide: OpenSlide object.
+        read_args: Dictionary with the slide level to read ("level"), the size of the
+            tiles at that level ("read_size") and at the output downsampling ("patch_size").
+        positions: List of (x, y) level 0 coordinates of the tiles.
+
+    Returns:
+        tiles: List of (level0_xy, img) tuples, where img is an RGB PIL image with the tile.
+        metrics: PipelineMetrics object with the reading of the batch.
+    """
+
+    read_size = read_args["read_size"]
+    patch_size = read_args["patch_size"]
+    metrics = PipelineMetrics()
+    tiles = []
+
+    for position in positions:
+        with metrics.stage("read"):
+            img = slide.read_region(position, read_args["level"], (read_size, read_size))
+
+            # Resize if necessary. This condition will be true
+            # when downsampling is not required.
+            if read_size != patch_size:
+                img = img.resize((patch_size, patch_size))
+
+            # Remove the alpha channel, as in the tiles of the grid
+            img = img.convert("RGB")
+        metrics.count("bytes_read", read_size**2 * 4)
+        tiles.append((position, img))
+
+    return tiles, metrics
+
+
+def _build_tile_readers(slide, band_args):
+    """Builds the tile readers of each output downsampling factor.
+
+    Args:
+        slide: OpenSlide object.
+        band_args: Dictionary with the tile extraction arguments.
+
+    Returns:
+        readers: List of tile readers, from the coarsest to the finest downsampling factor.
+    """
+
+    readers = [tile_reader.build_tile_reader(slide, band_args)]
+    for level_args in band_args["child_levels"]:
+        readers.append(tile_reader.build_tile_reader(slide, level_args))
+
+    return readers
+
+
+def _save_tile(codec, pipeline, tile, path, metrics):
+    """Writes a tile file, through the pipeline if there is one.
+
+    Args:
+        codec: TileCodec used to encode the tile.
+        pipeline: TileWriterPipeline object, or None.
+        tile: PIL image or RGB numpy array with the tile.
+        path: String with the path of the output file.
+        metrics: PipelineMetrics object to record the encoding and writing.
+    """
+
+    if pipeline is not None:
+        with metrics.stage("pipeline"):
+            pipeline.submit(path, tile)
+    else:
+        with metrics.stage("encode"):
+            data = codec.encode(tile)
+        with metrics.stage("write"):
+            with open(path, "wb") as f:
+                f.write(data)
+        metrics.count("bytes_written", len(data))
+
+    metrics.count("tiles_saved", 1)
+
+
+def _close_pipeline(pipeline, metrics):
+    """Waits until the pipeline writes all its tiles, and records the bytes it wrote.
+
+    Args:
+        pipeline: TileWriterPipeline object.
+        metrics: PipelineMetrics object.
+    """
+
+    with metrics.stage("pipeline"):
+        pipeline.close()
+    metrics.count("bytes_written", pipeline.bytes_written)
+
+
+def _extract_child_tiles(band_args, readers, pipeline, metrics, parent_level, parent_col, parent_row, parent_name, parent_pred, children):
+    """Saves the tiles at the finer output downsampling factors covering a saved tile.
+
+    The tiles at the next finer factor that fall within the parent tile are
+    saved, and this is repeated for each of them down to the finest factor.
+    Children inherit the prediction of their parent, except non-square
+    tiles when these are not requested.
+
+    Args:
+        band_args: Dictionary with the tile extraction arguments.
+        readers: List of tile readers, from the coarsest to the finest downsampling factor.
+        pipeline: TileWriterPipeline object, or None.
+        metrics: PipelineMetrics object of the band.
+        parent_level: Index of the downsampling factor of the parent tile.
+        parent_col, parent_row: Position of the parent tile in its grid.
+        parent_name: Name of the parent tile.
+        parent_pred: Prediction [0/1] of the parent tile.
+        children: List where the (name, width, height, prediction, row, column,
+            downsampling, parent) tuples of the children are appended.
+    """
+
+    if parent_level >= len(band_args["child_levels"]):
+        return
+
+    level_args = band_args["child_levels"][parent_level]
+    factor = level_args["factor"]
+    n_cols, n_rows = level_args["grid_coord"]
+    level_w, level_h = level_args["level_dims"]
+    patch_size = level_args["patch_size"]
+
+    for row in range(parent_row * factor, min((parent_row + 1) * factor, n_rows)):
+        for col in range(parent_col * factor, min((parent_col + 1) * factor, n_cols)):
+            tile_w = min(patch_size, level_w - col * patch_size)
+            tile_h = min(patch_size, level_h - row * patch_size)
+
+            pred = parent_pred
+            if not band_args["save_nonsquare"] and tile_w != tile_h:
+                pred = 0
+
+            tile_name = band_args["sample_id"] + "_" + str(row * n_cols + col).zfill(level_args["digits_padding"])
+            children.append((tile_name, tile_w, tile_h, pred, row, col, level_args["downsample"], parent_name))
+
+            if band_args["save_blank"] or pred == 1:
+                imgtile_out = level_args["tile_folder"] + tile_name + "." + band_args["codec"].extension
+                with metrics.stage("read"):
+                    tile = readers[parent_level + 1].get_tile(col, row)
+                _save_tile(band_args["codec"], pipeline, tile, imgtile_out, metrics)
+                _extract_child_tiles(band_args, readers, pipeline, metrics, parent_level + 1, col, row, tile_name, pred, children)
+
+
+def _extract_row_band(band_args, readers, preds_grid, row_start, row_end):
+    """Saves the tiles of a band of rows of the tile grid.
+
+    Only the tiles that are going to be saved are read from the slide.
+
+    Args:
+        band_args: Dictionary with the tile extraction arguments.
+        readers: List of tile readers (DeepZoomTileReader, NativeTileReader or RegionTileReader)
+            for each output downsampling factor, from the coarsest to the finest.
+        preds_grid: 2-D numpy array with the tile selection predictions.
+        row_start: First row of the band (inclusive).
+        row_end: Last row of the band (exclusive).
+
+    Returns:
+        preds: List with the predictions [0/1] for each tile in the band, in row-major order.
+        metadata: List of (name, width, height, row, column) tuples for each
+            tile in the band. Empty if the patches are not saved.
+        stored_tiles: List of (index, row, column, prediction, tile) tuples with the
+            tiles to write to the tile store. Empty if the tiles are saved as files.
+        children: List of (name, width, height, prediction, row, column, downsampling,
+            parent) tuples for the tiles at the finer output downsampling factors.
+        metrics: PipelineMetrics object with the reading, encoding and writing of the band.
+    """
+
+    n_cols = band_args["grid_coord"][0]
+    patch_size = band_args["patch_size"]
+    level_w, level_h = band_args["level_dims"]
+    preds = []
+    metadata = []
+    stored_tiles = []
+    children = []
+    metrics = PipelineMetrics()
+    bytes_read_start = sum(reader.bytes_read for reader in readers)
+
+    # Encode and write the tile files in a pipeline, if requested
+    pipeline = None
+    if band_args["save_patches"] and band_args["output_store"] == "files" and band_args["queue_depth"] > 0:
+        pipeline = TileWriterPipeline(band_args["codec"], band_args["queue_depth"], band_args["encoder_threads"])
+
+    try:
+        for row in range(row_start, row_end):
+            for col in range(n_cols):
+                i = row * n_cols + col
+
+                pred = int(preds_grid[row, col])
+
+                # Save patches if requested
+                if band_args["save_patches"]:
+
+                    # Tile dimensions are given by the grid geometry: only the
+                    # tiles in the last row and column can be smaller
+                    tile_w = min(patch_size, level_w - col * patch_size)
+                    tile_h = min(patch_size, level_h - row * patch_size)
+
+                    # If we need square patches only, we set the prediction to zero if the tile is not square
+                    if not band_args["save_nonsquare"]:
+                        if tile_w != tile_h:
+                            pred = 0
+
+                    # Prepare metadata
+                    tile_name = band_args["sample_id"] + "_" + str(i).zfill(band_args["digits_padding"])
+                    metadata.append((tile_name, tile_w, tile_h, row, col))
+
+                    # Read and save the tile only if it is going to be kept
+                    if band_args["save_blank"] or pred == 1:
+                        with metrics.stage("read"):
+                            tile = readers[0].get_tile(col, row)
+
+                        if band_args["output_store"] != "files":
+                            stored_tiles.append((i, row, col, pred, np.asarray(tile)))
+                            metrics.count("tiles_saved", 1)
+                        else:
+                            imgtile_out = band_args["tile_folder"] + tile_name + "." + band_args["codec"].extension
+                            _save_tile(band_args["codec"], pipeline, tile, imgtile_out, metrics)
+                            _extract_child_tiles(band_args, readers, pipeline, metrics, 0, col, row, tile_name, pred, children)
+
+                preds.append(pred)
+    finally:
+        if pipeline is not None:
+            _close_pipeline(pipeline, metrics)
+
+    metrics.count("bytes_read", sum(reader.bytes_read for reader in readers) - bytes_read_start)
+
+    return preds, metadata, stored_tiles, children, metrics
@@ -0,0 +1,54 @@
+import tempfile
+
+from src import parser_input, utility_functions
+from src.slide import PySlide, TileGenerator
+
+
+def stream_tiles(svs, **options):
+    """Generates the selected tiles of a slide as numpy arrays, without writing any output.
+
+    The tiles are selected as in the command line pipeline, with the same
+    arguments given as keyword options (see parser_input.build_config), e.g.:
+
+        for row, col, (x, y), tile in stream_tiles("slide.svs", method="otsu", patch_size=256):
+            ...
+
+    Options that produce output files (e.g. save_patches, save_mask) are
+    ignored. If the graph segmentation library is not available, the
+    intermediate images of the segmentation executable are written to a
+    temporary folder that is removed afterwards.
+
+    Args:
+        svs: Path to the slide.
+        **options: PyHIST arguments.
+
+    Yields:
+        row: Row of the tile in the tile grid (-1 with random sampling).
+        col: Column of the tile in the tile grid (-1 with random sampling).
+        level0_xy: Tuple with the level 0 coordinates of the top left corner of the tile.
+        tile: RGB numpy array with the tile.
+
+    Raises:
+        ValueError: If an option is not a PyHIST argument or has an invalid value.
+    """
+
+    config = parser_input.build_config(svs, **options)
+    if len(config["output_downsamples"]) > 1:
+        raise ValueError("Several output downsampling factors are not supported when streaming tiles.")
+
+    config.update({"output": None, "save_patches": False, "save_tilecrossed_image": False, "save_mask": False,
+                   "save_edges": False, "save_metrics": False, "profile": False, "codec_benchmark": 0})
+
+    # The segmentation executable exchanges the images through files
+    tmpdir = None
+    if config["method"] == "graph" and utility_functions.load_segmentation_library() is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="pyhist_")
+        config["output"] = tmpdir.name
+
+    slide = PySlide(config)
+    try:
+        yield from TileGenerator(slide).iter_tiles()
+    finally:
+        slide.slide.close()
+        if tmpdir is not None:
+            tmpdir.cleanup()
@@ -0,0 +1,187 @@
+import io
+import numpy as np
+
+from PIL import features, Image
+
+
+class TileCodec:
+    """Base class of the encoders used to save the tiles.
+
+    Attributes:
+        extension: String with the file extension of the encoded tiles.
+    """
+
+    extension = None
+
+    def encode(self, tile):
+        """Encodes a tile in memory.
+
+        Args:
+            tile: PIL image or RGB numpy array with the tile.
+
+        Returns:
+            _: Bytes with the encoded tile.
+        """
+        raise NotImplementedError
+
+
+    def description(self):
+        """Short description of the codec settings."""
+        return self.extension
+
+
+    @staticmethod
+    def as_image(tile):
+        """Wraps a tile given as a numpy array in a PIL image."""
+        if isinstance(tile, np.ndarray):
+            return Image.fromarray(tile)
+        return tile
+
+
+class PNGCodec(TileCodec):
+    """PNG encoder.
+
+    Attributes:
+        compress_level: Integer [0-9] with the zlib compression level, or None to use PIL's default.
+    """
+
+    extension = "png"
+
+    def __init__(self, compress_level=None):
+        self.compress_level = compress_level
+
+
+    def encode(self, tile):
+        params = {}
+        if self.compress_level is not None:
+            params["compress_level"] = self.compress_level
+
+        buffer = io.BytesIO()
+        self.as_image(tile).save(buffer, format="PNG", **params)
+        return buffer.getvalue()
+
+
+    def description(self):
+        level = "default" if self.compress_level is None else str(self.compress_level)
+        return "png (compression " + level + ")"
+
+
+class JPEGCodec(TileCodec):
+    """JPEG encoder. The alpha channel, if any, is removed before encoding.
+
+    Attributes:
+        quality: Integer [1-95] with the JPEG quality, or None to use PIL's default.
+        subsampling: String with the chroma subsampling (444, 422 or 420), or None to use PIL's default.
+    """
+
+    extension = "jpg"
+    subsampling_modes = {"444": "4:4:4", "422": "4:2:2", "420": "4:2:0"}
+
+    def __init__(self, quality=None, subsampling=None):
+        self.quality = quality
+        self.subsampling = subsampling
+
+
+    def encode(self, tile):
+        params = {}
+        if self.quality is not None:
+            params["quality"] = self.quality
+        if self.subsampling is not None:
+            params["subsampling"] = self.subsampling_modes[self.subsampling]
+
+        tile = self.as_image(tile)
+        if tile.mode != "RGB":
+            tile = tile.convert("RGB")
+
+        buffer = io.BytesIO()
+        tile.save(buffer, format="JPEG", **params)
+        return buffer.getvalue()
+
+
+    def description(self):
+        quality = "default" if self.quality is None else str(self.quality)
+        subsampling = "default" if self.subsampling is None else self.subsampling_modes[self.subsampling]
+        return "jpg (quality " + quality + ", subsampling " + subsampling + ")"
+
+
+class WebPCodec(TileCodec):
+    """WebP encoder.
+
+    Attributes:
+        quality: Integer [0-100] with the quality of lossy encoding, or the
+            compression effort of lossless encoding.
+        lossless: If True, use lossless encoding.
+    """
+
+    extension = "webp"
+
+    def __init__(self, quality=80, lossless=False):
+        if not features.check("webp"):
+            raise RuntimeError("WebP support is not available in the installed Pillow library.")
+
+        self.quality = quality
+        self.lossless = lossless
+
+
+    def encode(self, tile):
+        buffer = io.BytesIO()
+        self.as_image(tile).save(buffer, format="WEBP", quality=self.quality, lossless=self.lossless)
+        return buffer.getvalue()
+
+
+    def description(self):
+        mode = "lossless" if self.lossless else "lossy"
+        return "webp (" + mode + ", quality " + str(self.quality) + ")"
+
+
+class NPYCodec(TileCodec):
+    """Raw numpy array (.npy) encoder, without compression."""
+
+    extension = "npy"
+
+    def encode(self, tile):
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(tile))
+        return buffer.getvalue()
+
+
+    def description(self):
+        return "npy (raw)"
+
+
+def get_codec(args):
+    """Builds the codec requested in the arguments.
+
+    Args:
+        args: PySlide or argument namespace with the format and codec settings.
+
+    Returns:
+        _: A TileCodec object.
+    """
+
+    if args.format == "png":
+        return PNGCodec(args.png_compression)
+    elif args.format == "jpg":
+        return JPEGCodec(args.jpeg_quality, args.jpeg_subsampling)
+    elif args.format == "webp":
+        return WebPCodec(args.webp_quality, args.webp_lossless)
+    elif args.format == "npy":
+        return NPYCodec()
+    else:
+        raise NotImplementedError
+
+
+def benchmark_codecs():
+    """Codecs and settings compared by the codec benchmark.
+
+    Returns:
+        codecs: List of TileCodec objects.
+    """
+
+    codecs = [PNGCodec(1), PNGCodec(), PNGCodec(9),
+              JPEGCodec(75, "420"), JPEGCodec(90, "420"), JPEGCodec(90, "444"), JPEGCodec(95, "444")]
+    if features.check("webp"):
+        codecs += [WebPCodec(80), WebPCodec(90), WebPCodec(80, lossless=True)]
+    codecs.append(NPYCodec())
+
+    return codecs
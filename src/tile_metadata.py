@@ -0,0 +1,241 @@
+import os
+import pandas as pd
+import re
+
+
+class TileMetadataWriter:
+    """Writes the metadata of the tiles of a slide while they are extracted.
+
+    Rows are buffered and written in batches, so that the memory used does
+    not grow with the size of the tile grid. The metadata is written in one
+    or more of the following formats:
+        tsv: tile_selection.tsv, with the columns of the tile selection of
+            previous versions (Tile, Width, Height, Keep, Row and Column, and
+            Downsample and Parent with several output downsampling factors).
+            The tiles at the finer downsampling factors are listed after all
+            the tiles of the coarsest one.
+        parquet: tile_selection.parquet, a Parquet file with all the columns.
+        arrow: tile_selection.arrow, an Arrow IPC (Feather) file with all the columns.
+    The Parquet and Arrow files list each tile of the coarsest factor, in
+    row-major order, followed by the tiles it contains at the finer factors.
+    They require the pyarrow package.
+
+    Files are written with a .part suffix, which is removed once all the
+    tiles are written, so that an interrupted run does not leave an
+    incomplete tile selection.
+
+    Attributes:
+        path: Path to the output files, without the extension.
+        formats: List with the output formats.
+        multilevel: If True, the Downsample and Parent columns are included in the TSV file.
+    """
+
+    # Number of rows buffered in memory before they are written
+    batch_size = 65536
+
+    columns = ["Tile", "Width", "Height", "Keep", "Row", "Column", "Downsample", "Parent", "X", "Y", "Foreground", "Path"]
+
+    def __init__(self, path, formats, multilevel):
+        """Inits TileMetadataWriter.
+
+        Raises:
+            ImportError: If a columnar format is requested and pyarrow is not installed.
+        """
+
+        self.path = path
+        self.formats = formats
+        self.multilevel = multilevel
+
+        self.__tsv_columns = self.columns[:8] if multilevel else self.columns[:6]
+        self.__rows = []
+        self.__tsv_started = {"tiles": False, "children": False}
+        self.__arrow_writers = {}
+
+        if "parquet" in formats or "arrow" in formats:
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("The pyarrow package is required to save the tile metadata in Parquet or Arrow format.")
+
+            self.__schema = pyarrow.schema([
+                ("Tile", pyarrow.string()), ("Width", pyarrow.int32()), ("Height", pyarrow.int32()),
+                ("Keep", pyarrow.int8()), ("Row", pyarrow.int32()), ("Column", pyarrow.int32()),
+                ("Downsample", pyarrow.int32()), ("Parent", pyarrow.string()), ("X", pyarrow.int64()),
+                ("Y", pyarrow.int64()), ("Foreground", pyarrow.float32()), ("Path", pyarrow.string())
+            ])
+            if "parquet" in formats:
+                import pyarrow.parquet
+                self.__arrow_writers["parquet"] = pyarrow.parquet.ParquetWriter(self.__part("parquet"), self.__schema)
+            if "arrow" in formats:
+                import pyarrow.ipc
+                self.__arrow_writers["arrow"] = pyarrow.ipc.new_file(self.__part("arrow"), self.__schema)
+
+
+    def append(self, rows):
+        """Adds the metadata of tiles.
+
+        Args:
+            rows: List of tuples with the values of each column (see columns),
+                where each tile of the coarsest output downsampling factor is
+                followed by the tiles it contains at the finer factors.
+        """
+
+        self.__rows.extend(rows)
+        if len(self.__rows) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """Writes the buffered rows."""
+
+        if not self.__rows:
+            return
+        batch = pd.DataFrame.from_records(self.__rows, columns=self.columns)
+        self.__rows = []
+
+        if "tsv" in self.formats:
+            # The tiles at finer factors, which have a parent, are kept
+            # apart to be listed after the tiles of the coarsest factor
+            is_child = batch["Parent"].notna()
+            for kind, tsv_path, tsv_rows in [("tiles", self.__part("tsv"), batch[~is_child]),
+                                             ("children", self.__part("children.tsv"), batch[is_child])]:
+                if len(tsv_rows) == 0:
+                    continue
+                tsv_rows[self.__tsv_columns].to_csv(tsv_path, mode="a" if self.__tsv_started[kind] else "w",
+                                                    header=kind == "tiles" and not self.__tsv_started[kind],
+                                                    index=False, sep="\t")
+                self.__tsv_started[kind] = True
+
+        if self.__arrow_writers:
+            import pyarrow
+            table = pyarrow.Table.from_pandas(batch, schema=self.__schema, preserve_index=False)
+            for writer in self.__arrow_writers.values():
+                writer.write_table(table)
+
+
+    def close(self):
+        """Writes the remaining rows and moves the files to their final path."""
+
+        self.flush()
+
+        if "tsv" in self.formats:
+            # Header of an empty tile selection
+            if not self.__tsv_started["tiles"]:
+                pd.DataFrame(columns=self.__tsv_columns).to_csv(self.__part("tsv"), index=False, sep="\t")
+
+            if self.__tsv_started["children"]:
+                with open(self.__part("tsv"), "a") as f, open(self.__part("children.tsv")) as children:
+                    for line in children:
+                        f.write(line)
+                os.remove(self.__part("children.tsv"))
+            os.replace(self.__part("tsv"), self.path + ".tsv")
+
+        for extension, writer in self.__arrow_writers.items():
+            writer.close()
+            os.replace(self.__part(extension), self.path + "." + extension)
+        self.__arrow_writers = {}
+
+
+    def abort(self):
+        """Removes the incomplete files."""
+
+        for writer in self.__arrow_writers.values():
+            writer.close()
+        self.__arrow_writers = {}
+
+        for extension in ["tsv", "children.tsv", "parquet", "arrow"]:
+            if os.path.isfile(self.__part(extension)):
+                os.remove(self.__part(extension))
+
+
+    def __part(self, extension):
+        """Path of an incomplete output file."""
+        return self.path + "." + extension + ".part"
+
+
+def merge_shards(path, formats):
+    """Merges the tile metadata written by the shards of a slide into a single file per format.
+
+    The shards of a slide write their metadata to files named after the shard
+    (e.g. tile_selection.shard-0-of-4.tsv). The merged files list the tiles
+    in the same order as a run without shards. The shard files are kept.
+
+    Args:
+        path: Path to the output files, without the extension (see TileMetadataWriter).
+        formats: List with the formats to merge.
+
+    Returns:
+        n_shards: Number of merged shards.
+
+    Raises:
+        FileNotFoundError: If there are no shard files, or the file of a shard is missing.
+        ValueError: If there are shard files from runs with different numbers of shards.
+    """
+
+    # Number of shards, given by the names of the shard files
+    folder, basename = os.path.split(path)
+    pattern = re.compile(re.escape(basename) + r"\.shard-(\d+)-of-(\d+)\.(" + "|".join(formats) + r")$")
+    shard_counts = set(int(match.group(2)) for match in map(pattern.match, os.listdir(folder or ".")) if match)
+    if not shard_counts:
+        raise FileNotFoundError("No tile selections of shards found in " + os.path.join(folder, "") + ". They are saved with --shard and --save-patches.")
+    if len(shard_counts) > 1:
+        raise ValueError("Found tile selections of runs with different numbers of shards (" +
+                         ", ".join(str(x) for x in sorted(shard_counts)) + ") in " + os.path.join(folder, "") + ".")
+    n_shards = shard_counts.pop()
+
+    for extension in formats:
+        shard_paths = [path + ".shard-" + str(i) + "-of-" + str(n_shards) + "." + extension for i in range(n_shards)]
+        missing = [x for x in shard_paths if not os.path.isfile(x)]
+        if missing:
+            raise FileNotFoundError("Missing the tile selection of " + str(len(missing)) + " of the " + str(n_shards) +
+                                    " shards: " + ", ".join(missing))
+
+        part_path = path + "." + extension + ".part"
+        if extension == "tsv":
+            _merge_tsv(shard_paths, part_path)
+        else:
+            _merge_arrow(shard_paths, part_path, extension)
+        os.replace(part_path, path + "." + extension)
+
+    return n_shards
+
+
+def _merge_tsv(shard_paths, merged_path):
+    """Concatenates the TSV files of the shards, listing the tiles at the finer downsampling factors last."""
+
+    with open(merged_path, "w") as f:
+        for children in [False, True]:
+            for i, shard_path in enumerate(shard_paths):
+                # Tile names are kept as written, even if pandas would read them as missing values
+                shard = pd.read_csv(shard_path, sep="\t", keep_default_na=False)
+                if "Downsample" in shard.columns:
+                    is_child = shard["Downsample"] != shard["Downsample"].max()
+                    shard = shard[is_child if children else ~is_child]
+                elif children:
+                    continue
+                shard.to_csv(f, header=i == 0 and not children, index=False, sep="\t")
+
+
+def _merge_arrow(shard_paths, merged_path, extension):
+    """Concatenates the Parquet or Arrow files of the shards."""
+
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    writer = None
+    try:
+        for shard_path in shard_paths:
+            if extension == "parquet":
+                table = pyarrow.parquet.read_table(shard_path)
+            else:
+                with pyarrow.memory_map(shard_path) as source:
+                    table = pyarrow.ipc.open_file(source).read_all()
+
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(merged_path, table.schema) if extension == "parquet" else \
+                    pyarrow.ipc.new_file(merged_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,111 @@
+import queue
+import threading
+
+
+class TileWriterPipeline:
+    """A staged pipeline to encode and write tiles to disk.
+
+    The thread reading the tiles submits them to a pool of encoder threads,
+    which pass the encoded bytes to a writer thread. The stages are connected
+    by bounded queues, so that reading, encoding and writing overlap while
+    at most queue_depth tiles wait at each stage. When a queue is full, the
+    previous stage blocks until there is room for more tiles.
+
+    Attributes:
+        codec: TileCodec used to encode the tiles.
+        queue_depth: Maximum number of tiles waiting at each stage.
+        n_encoders: Number of encoder threads.
+        bytes_written: Number of bytes written to the tile files.
+    """
+
+    def __init__(self, codec, queue_depth, n_encoders):
+        """Inits TileWriterPipeline and starts its threads."""
+        self.codec = codec
+        self.queue_depth = queue_depth
+        self.n_encoders = n_encoders
+        self.bytes_written = 0
+
+        self.__encode_queue = queue.Queue(maxsize=queue_depth)
+        self.__write_queue = queue.Queue(maxsize=queue_depth)
+        self.__error = None
+
+        self.__encoders = [threading.Thread(target=self.__encode_loop, daemon=True) for _ in range(n_encoders)]
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        for thread in self.__encoders + [self.__writer]:
+            thread.start()
+
+
+    def submit(self, path, tile):
+        """Queues a tile to be encoded and written to a file.
+
+        Blocks while the encoding queue is full.
+
+        Args:
+            path: String with the path of the output file.
+            tile: PIL image or RGB numpy array with the tile.
+        """
+
+        self.__check_error()
+        self.__encode_queue.put((path, tile))
+
+
+    def close(self):
+        """Waits until all the queued tiles are written and stops the threads.
+
+        Raises:
+            Exception: The first error raised while encoding or writing a tile.
+        """
+
+        for _ in self.__encoders:
+            self.__encode_queue.put(None)
+        for thread in self.__encoders:
+            thread.join()
+
+        self.__write_queue.put(None)
+        self.__writer.join()
+
+        self.__check_error()
+
+
+    def __check_error(self):
+        """Raises the error of a failed stage, if any."""
+        if self.__error is not None:
+            raise self.__error
+
+
+    def __encode_loop(self):
+        """Encodes tiles until a stop signal is received."""
+        while True:
+            item = self.__encode_queue.get()
+            if item is None:
+                return
+
+            # After an error, tiles are consumed without encoding them
+            # so that the reading thread does not block
+            if self.__error is not None:
+                continue
+
+            path, tile = item
+            try:
+                self.__write_queue.put((path, self.codec.encode(tile)))
+            except Exception as e:
+                self.__error = e
+
+
+    def __write_loop(self):
+        """Writes encoded tiles until a stop signal is received."""
+        while True:
+            item = self.__write_queue.get()
+            if item is None:
+                return
+
+            if self.__error is not None:
+                continue
+
+            path, data = item
+            try:
+                with open(path, "wb") as f:
+                    f.write(data)
+                self.bytes_written += len(data)
+            except Exception as e:
+                self.__error = e
@@ -0,0 +1,378 @@
+import math
+import numpy as np
+import openslide
+
+from openslide import deepzoom
+from PIL import Image
+
+
+class DeepZoomTileReader:
+    """Reads the tiles of a grid using OpenSlide's DeepZoomGenerator.
+
+    Attributes:
+        dzg: DeepZoomGenerator for the slide.
+        dzg_level: Deep zoom level of the tiles.
+        bytes_read: Number of bytes of RGBA pixel data read from the slide.
+    """
+
+    def __init__(self, slide, patch_size, dzg_level):
+        """Inits DeepZoomTileReader.
+
+        Args:
+            slide: OpenSlide object.
+            patch_size: Integer with the size of the tiles.
+            dzg_level: Deep zoom level of the tiles.
+        """
+        self.dzg = deepzoom.DeepZoomGenerator(slide, tile_size=patch_size, overlap=0)
+        self.dzg_level = dzg_level
+        self.bytes_read = 0
+
+
+    def get_tile(self, col, row):
+        """Reads a tile of the grid.
+
+        Args:
+            col, row: Position of the tile in the grid.
+
+        Returns:
+            _: RGB PIL image with the tile.
+        """
+        l_size = self.dzg.get_tile_coordinates(self.dzg_level, (col, row))[2]
+        self.bytes_read += l_size[0] * l_size[1] * 4
+
+        return self.dzg.get_tile(self.dzg_level, (col, row))
+
+
+class NativeTileReader:
+    """Reads the tiles of a grid directly from the native levels of the slide.
+
+    Produces the same tiles as DeepZoomTileReader without building a
+    DeepZoomGenerator: each tile is read with a single read_region call at
+    the native level that DeepZoomGenerator would use, composited over the
+    background color of the slide only when it has transparent pixels, and
+    resized with the same Lanczos filter only when that level does not match
+    the output downsampling. The tiles are identical to the ones of
+    DeepZoomTileReader (a tolerance of 0 per channel, checked by
+    benchmark/check_tile_readers.py).
+
+    Attributes:
+        slide: OpenSlide object.
+        patch_size: Integer with the size of the tiles.
+        downsample: Downsampling factor of the tiles with respect to level 0.
+        level_dims: Dimensions (width, height) of the slide at the output downsampling.
+        level: Native level used to read the tiles.
+        bytes_read: Number of bytes of RGBA pixel data read from the slide.
+    """
+
+    def __init__(self, slide, patch_size, downsample, level_dims):
+        """Inits NativeTileReader.
+
+        Args:
+            slide: OpenSlide object.
+            patch_size: Integer with the size of the tiles.
+            downsample: Downsampling factor of the tiles with respect to level 0.
+            level_dims: Dimensions (width, height) of the slide at the output downsampling.
+        """
+        self.slide = slide
+        self.patch_size = patch_size
+        self.downsample = downsample
+        self.level_dims = level_dims
+
+        self.level = deepzoom_level(slide, downsample)
+        self.__level_downsample = slide.level_downsamples[self.level]
+        self.__native_dims = slide.level_dimensions[self.level]
+
+        # Native level pixels per output pixel
+        self.__scale = downsample / self.__level_downsample
+        self.__bg_color = background_color(slide)
+        self.bytes_read = 0
+
+
+    def get_tile(self, col, row):
+        """Reads a tile of the grid.
+
+        Args:
+            col, row: Position of the tile in the grid.
+
+        Returns:
+            _: RGB PIL image with the tile.
+        """
+
+        # Size of the tile, which is smaller in the last row and column
+        tile_w = min(self.patch_size, self.level_dims[0] - col * self.patch_size)
+        tile_h = min(self.patch_size, self.level_dims[1] - row * self.patch_size)
+
+        l0_location, l_size = deepzoom_region(self.__level_downsample, self.__native_dims, self.__scale,
+                                              (col * self.patch_size, row * self.patch_size), (tile_w, tile_h))
+        tile = rgb_image(self.slide.read_region(l0_location, self.level, l_size), self.__bg_color)
+        self.bytes_read += l_size[0] * l_size[1] * 4
+
+        # Resize only when the native level does not match the output downsampling
+        if tile.size != (tile_w, tile_h):
+            tile.thumbnail((tile_w, tile_h), Image.LANCZOS)
+
+        return tile
+
+
+class RegionTileReader:
+    """Reads the tiles of a grid from large regions spanning whole rows of tiles.
+
+    Instead of one read per tile, the slide is read one region at a time,
+    where each region covers the full width of the slide and a band of rows
+    of the tile grid. Regions are read at the native level that
+    DeepZoomGenerator would use, and each tile is cut from the region with
+    the same native pixels that NativeTileReader reads for it. When that
+    level matches the output downsampling, tiles are returned as numpy views
+    of the region, without copying them; otherwise, each tile is resized
+    on its own with the same Lanczos filter as DeepZoomGenerator, so that the
+    tiles at the edges of the slide are not stretched with the rest of the
+    region. The tiles are identical to the ones of DeepZoomTileReader (a
+    tolerance of 0 per channel, checked by benchmark/check_tile_readers.py).
+
+    If the native level has a non-integer downsampling factor, the tiles do
+    not start at whole pixels of the level, and OpenSlide interpolates the
+    tiles read by DeepZoomGenerator at subpixel offsets. The tiles are then
+    read one at a time, as with NativeTileReader, to keep them identical.
+
+    The number of rows per region follows the requested band height, and is
+    extended when possible so that regions start and end at the boundaries of
+    the tiles in which the slide is internally stored, so that each stored
+    tile is decoded only once.
+
+    Tiles must be requested in row order: a region is kept in memory until a
+    tile from a different region is requested.
+
+    Attributes:
+        slide: OpenSlide object.
+        patch_size: Integer with the size of the tiles.
+        downsample: Downsampling factor of the tiles with respect to level 0.
+        level_dims: Dimensions (width, height) of the slide at the output downsampling.
+        level: Native level used to read the regions.
+        rows_per_region: Number of rows of the tile grid covered by each region.
+        bytes_read: Number of bytes of RGBA pixel data read from the slide.
+    """
+
+    def __init__(self, slide, patch_size, downsample, level_dims, band_height):
+        """Inits RegionTileReader.
+
+        Args:
+            slide: OpenSlide object.
+            patch_size: Integer with the size of the tiles.
+            downsample: Downsampling factor of the tiles with respect to level 0.
+            level_dims: Dimensions (width, height) of the slide at the output downsampling.
+            band_height: Requested height of the regions, in pixels at the output downsampling.
+        """
+        self.slide = slide
+        self.patch_size = patch_size
+        self.downsample = downsample
+        self.level_dims = level_dims
+
+        self.level = deepzoom_level(slide, downsample)
+        self.__level_downsample = slide.level_downsamples[self.level]
+        self.__native_dims = slide.level_dimensions[self.level]
+        self.__scale = downsample / self.__level_downsample
+        self.__bg_color = background_color(slide)
+
+        self.rows_per_region = region_rows(slide, patch_size, downsample, band_height)
+
+        # Tiles read one at a time, when they cannot be cut from a region
+        self.__tile_reader = None
+        if self.__level_downsample != int(self.__level_downsample):
+            self.__tile_reader = NativeTileReader(slide, patch_size, downsample, level_dims)
+
+        self.__region_idx = None
+        self.__region = None
+        self.__region_y = None
+        self.bytes_read = 0
+
+
+    def get_tile(self, col, row):
+        """Reads a tile of the grid.
+
+        Args:
+            col, row: Position of the tile in the grid.
+
+        Returns:
+            _: RGB numpy array with the tile, which is a view of the current
+                region when it does not need to be resized.
+        """
+
+        if self.__tile_reader is not None:
+            bytes_read = self.__tile_reader.bytes_read
+            tile = np.asarray(self.__tile_reader.get_tile(col, row))
+            self.bytes_read += self.__tile_reader.bytes_read - bytes_read
+            return tile
+
+        region_idx = row // self.rows_per_region
+        if region_idx != self.__region_idx:
+            self.__read_region(region_idx)
+
+        tile_w, tile_h = self.__tile_size(col, row)
+        l_size = self.__tile_region(col, row, tile_w, tile_h)[1]
+
+        # Native pixels of the tile in the region
+        x = int(round(self.__scale * col * self.patch_size))
+        y = int(round(self.__scale * row * self.patch_size - self.__region_y))
+        tile = self.__region[y:y + l_size[1], x:x + l_size[0]]
+
+        # Resize only when the native level does not match the output downsampling
+        if l_size == (tile_w, tile_h):
+            return tile
+
+        tile = Image.fromarray(np.ascontiguousarray(tile))
+        tile.thumbnail((tile_w, tile_h), Image.LANCZOS)
+
+        return np.asarray(tile)
+
+
+    def __tile_size(self, col, row):
+        """Size of a tile, which is smaller in the last row and column."""
+        return (min(self.patch_size, self.level_dims[0] - col * self.patch_size),
+                min(self.patch_size, self.level_dims[1] - row * self.patch_size))
+
+
+    def __tile_region(self, col, row, tile_w, tile_h):
+        """Region of the native level read by DeepZoomGenerator for a tile (see deepzoom_region)."""
+        return deepzoom_region(self.__level_downsample, self.__native_dims, self.__scale,
+                               (col * self.patch_size, row * self.patch_size), (tile_w, tile_h))
+
+
+    def __read_region(self, region_idx):
+        """Reads a region of the slide, covering a band of rows of the tile grid.
+
+        A new array is allocated for each region, since views of the previous
+        region may still be in use (e.g. waiting to be encoded).
+
+        Args:
+            region_idx: Index of the region.
+        """
+
+        first_row = region_idx * self.rows_per_region
+        n_rows = int(math.ceil(self.level_dims[1] / self.patch_size))
+        last_row = min(n_rows, first_row + self.rows_per_region)
+
+        # The region spans the native rows of all the tiles of the band
+        l0_location, l_size = self.__tile_region(0, first_row, *self.__tile_size(0, first_row))
+        region_y = self.__scale * first_row * self.patch_size
+        region_h = max(int(round(self.__scale * row * self.patch_size - region_y)) +
+                       self.__tile_region(0, row, *self.__tile_size(0, row))[1][1]
+                       for row in range(first_row, last_row))
+        l0_location = (0, l0_location[1])
+        l_size = (self.__native_dims[0], region_h)
+
+        region = rgb_image(self.slide.read_region(l0_location, self.level, l_size), self.__bg_color)
+        self.bytes_read += l_size[0] * l_size[1] * 4
+
+        self.__region = np.asarray(region)
+        self.__region_y = region_y
+        self.__region_idx = region_idx
+
+
+def deepzoom_level(slide, downsample):
+    """Native level of the slide that DeepZoomGenerator reads to produce the tiles at a downsampling factor."""
+    return slide.get_best_level_for_downsample(downsample)
+
+
+def deepzoom_region(level_downsample, native_dims, scale, z_location, z_size):
+    """Region of a native level read by DeepZoomGenerator to produce a tile.
+
+    Args:
+        level_downsample: Downsampling factor of the native level.
+        native_dims: Dimensions (width, height) of the native level.
+        scale: Native level pixels per output pixel.
+        z_location: Coordinates (x, y) of the tile at the output downsampling.
+        z_size: Size (width, height) of the tile at the output downsampling.
+
+    Returns:
+        l0_location: Level 0 coordinates of the top left corner of the region.
+        l_size: Size (width, height) of the region at the native level.
+    """
+
+    l_location = [scale * z for z in z_location]
+    l0_location = tuple(int(level_downsample * l) for l in l_location)
+    l_size = tuple(int(min(math.ceil(scale * dz), l_lim - math.ceil(l)))
+                   for l, dz, l_lim in zip(l_location, z_size, native_dims))
+
+    return l0_location, l_size
+
+
+def background_color(slide):
+    """Background color of the slide, over which DeepZoomGenerator composites the transparent pixels."""
+    return "#" + slide.properties.get(openslide.PROPERTY_NAME_BACKGROUND_COLOR, "ffffff")
+
+
+def rgb_image(region, bg_color):
+    """Converts an RGBA region read from the slide to RGB, as DeepZoomGenerator does.
+
+    Args:
+        region: RGBA PIL image returned by read_region.
+        bg_color: Background color of the slide (see background_color).
+
+    Returns:
+        _: RGB PIL image, with the transparent pixels composited over the background color.
+    """
+
+    # Opaque regions, which are the most common, are only converted
+    if region.getchannel("A").getextrema()[0] == 255:
+        return region.convert("RGB")
+
+    bg = Image.new("RGB", region.size, bg_color)
+    return Image.composite(region, bg, region)
+
+
+def region_rows(slide, patch_size, downsample, band_height):
+    """Number of rows of the tile grid covered by each region of a RegionTileReader.
+
+    The requested band height is rounded to a whole number of tile rows. If the
+    slide reports the height of its internal tiles, the number of rows is
+    increased to the nearest value for which the regions are aligned to the
+    internal tiles, unless that more than doubles the requested height.
+
+    Args:
+        slide: OpenSlide object.
+        patch_size: Integer with the size of the tiles.
+        downsample: Downsampling factor of the tiles with respect to level 0.
+        band_height: Requested height of the regions, in pixels at the output downsampling.
+
+    Returns:
+        n_rows: Integer with the number of rows per region.
+    """
+
+    n_rows = max(1, band_height // patch_size)
+
+    level = deepzoom_level(slide, downsample)
+    internal_height = slide.properties.get("openslide.level[" + str(level) + "].tile-height")
+    native_patch_size = patch_size * downsample / slide.level_downsamples[level]
+
+    # Alignment is only possible when tiles span a whole number of native pixels
+    if internal_height is None or native_patch_size != int(native_patch_size):
+        return n_rows
+
+    internal_height = int(internal_height)
+    native_patch_size = int(native_patch_size)
+    aligned_rows = internal_height // math.gcd(internal_height, native_patch_size)
+    aligned_n_rows = int(math.ceil(n_rows / aligned_rows)) * aligned_rows
+    if aligned_n_rows <= 2 * n_rows:
+        n_rows = aligned_n_rows
+
+    return n_rows
+
+
+def build_tile_reader(slide, band_args):
+    """Builds the tile reader requested in the tile extraction arguments.
+
+    Args:
+        slide: OpenSlide object.
+        band_args: Dictionary with the tile extraction arguments.
+
+    Returns:
+        _: A DeepZoomTileReader, NativeTileReader or RegionTileReader object.
+    """
+
+    if band_args["tile_reader"] == "region":
+        return RegionTileReader(slide, band_args["patch_size"], band_args["output_downsample"],
+                                band_args["level_dims"], band_args["band_height"])
+    elif band_args["tile_reader"] == "native":
+        return NativeTileReader(slide, band_args["patch_size"], band_args["output_downsample"], band_args["level_dims"])
+    else:
+        return DeepZoomTileReader(slide, band_args["patch_size"], band_args["dzg_level"])
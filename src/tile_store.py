@@ -0,0 +1,110 @@
+import logging
+import numpy as np
+
+
+class TileStore:
+    """A chunked and compressed HDF5 container for the tiles of a slide.
+
+    Instead of writing one image file per tile, tiles are appended to a
+    single HDF5 file, which holds the following datasets:
+        tiles: (N, patch_size, patch_size, 3) uint8 array with the tiles. Tiles
+            smaller than patch_size (at the borders of the slide) are padded with zeros.
+        index: Index of each tile in the tile grid (the number in the tile name),
+            or the sample number in random sampling.
+        row, col: Position of each tile in the tile grid (-1 in random sampling).
+        x, y: Level 0 coordinates of the top left corner of each tile.
+        width, height: Size of each tile before padding.
+        keep: 1 if the tile met the content threshold, 0 otherwise.
+
+    Each tile is stored in its own chunk, so that data loaders can read any
+    tile by its position in the container (e.g. store["tiles"][k]).
+
+    Attributes:
+        path: Path to the HDF5 file.
+        patch_size: Size of the tiles.
+    """
+
+    # Number of tiles buffered in memory before they are written to the file
+    buffer_size = 64
+
+    metadata_fields = ["index", "row", "col", "x", "y", "width", "height", "keep"]
+
+    def __init__(self, path, patch_size, attrs=None):
+        """Inits TileStore, creating the HDF5 file.
+
+        Args:
+            path: Path to the HDF5 file.
+            patch_size: Size of the tiles.
+            attrs: Dictionary with attributes to store in the file.
+        """
+
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("The h5py package is required to store the tiles in HDF5 format.")
+
+        self.path = path
+        self.patch_size = patch_size
+        self.__file = h5py.File(path, "w")
+        self.__tiles = []
+        self.__metadata = []
+
+        self.__file.create_dataset("tiles", shape=(0, patch_size, patch_size, 3),
+                                   maxshape=(None, patch_size, patch_size, 3), dtype=np.uint8,
+                                   chunks=(1, patch_size, patch_size, 3), compression="gzip", shuffle=True)
+        for field in self.metadata_fields:
+            self.__file.create_dataset(field, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=True)
+
+        for key, value in (attrs or {}).items():
+            self.__file.attrs[key] = value
+
+
+    def append(self, tile, index, row, col, x, y, keep):
+        """Appends a tile to the container.
+
+        Args:
+            tile: RGB numpy array or PIL image with the tile.
+            index: Integer with the index of the tile.
+            row, col: Position of the tile in the tile grid.
+            x, y: Level 0 coordinates of the top left corner of the tile.
+            keep: 1 if the tile met the content threshold, 0 otherwise.
+        """
+
+        tile = np.asarray(tile)[:, :, :3]
+        self.__tiles.append(tile)
+        self.__metadata.append((index, row, col, x, y, tile.shape[1], tile.shape[0], keep))
+
+        if len(self.__tiles) >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        """Writes the buffered tiles to the file."""
+
+        n_buffered = len(self.__tiles)
+        if n_buffered == 0:
+            return
+
+        # Pad the tiles that do not fill a whole patch
+        block = np.zeros((n_buffered, self.patch_size, self.patch_size, 3), dtype=np.uint8)
+        for k, tile in enumerate(self.__tiles):
+            block[k, :tile.shape[0], :tile.shape[1], :] = tile
+
+        n_stored = self.__file["tiles"].shape[0]
+        self.__file["tiles"].resize(n_stored + n_buffered, axis=0)
+        self.__file["tiles"][n_stored:] = block
+
+        metadata = np.array(self.__metadata, dtype=np.int64)
+        for k, field in enumerate(self.metadata_fields):
+            self.__file[field].resize(n_stored + n_buffered, axis=0)
+            self.__file[field][n_stored:] = metadata[:, k]
+
+        self.__tiles = []
+        self.__metadata = []
+
+
+    def close(self):
+        """Writes the remaining tiles and closes the file."""
+        self.flush()
+        logging.debug("Stored " + str(self.__file["tiles"].shape[0]) + " tiles in " + self.path)
+        self.__file.close()
@@ -1,3 +1,4 @@
+import ctypes
 import cv2
 import logging
 import math
@@ -11,20 +12,36 @@ import sys
 import time
 import warnings
 
-from PIL import Image
+from PIL import Image, ImageDraw
+
+
+# Folder with the graph segmentation sources and binaries, so that
+# they are found regardless of the working directory
+segmentation_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "graph_segmentation", "")
+
+
+# Whether the segmentation executable and library were already checked by this process
+_compilation_checked = False
 
 
 def check_compilation():
     """Graph segmentation compilation check.
 
     Validates that the segmentation executable is compiled when using the graph TileGenerator.
-    Compilation will be performed if the binary is not available.
+    Compilation will be performed if the binary is not available. The check is
+    only performed once per process (and its worker processes, when they are
+    started afterwards).
 
     Returns:
         None
     """
 
-    if not os.path.isfile("src/graph_segmentation/segment"):
+    global _compilation_checked
+
+    if _compilation_checked:
+        return
+
+    if not os.path.isfile(segmentation_dir + "segment"):
 
         # If Windows, the user must compile the script manually, otherwise we attempt to compile it
         if platform.system() == "Windows":
@@ -33,11 +50,110 @@ def check_compilation():
         else:
             logging.critical("Compiling the graph segmentation algorithm...")
             try:
-                subprocess.check_call(["make"], stdout=subprocess.PIPE, cwd="src/graph_segmentation/")
+                subprocess.check_call(["make"], stdout=subprocess.PIPE, cwd=segmentation_dir)
             except Exception:
                 print("Compilation of the segmentation algorithm failed. Please compile it before running this script. Exiting.")
                 sys.exit(1)
 
+    # The segmentation library is optional, since the executable
+    # is used instead when it is not available. It is also rebuilt
+    # when it is older than its sources
+    library_path = segmentation_dir + "libsegment.so"
+    sources = [segmentation_dir + "segment-lib.cpp", segmentation_dir + "segment-image.h"]
+    outdated = not os.path.isfile(library_path) or any(
+        os.path.getmtime(source) > os.path.getmtime(library_path) for source in sources if os.path.isfile(source))
+    if outdated and platform.system() != "Windows":
+        try:
+            subprocess.check_call(["make", "libsegment.so"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=segmentation_dir)
+        except Exception:
+            logging.debug("Compilation of the segmentation library failed. The segmentation executable will be used instead.")
+
+    _compilation_checked = True
+
+
+# Handle to the segmentation library, loaded on first use
+_segmentation_library = None
+
+
+def load_segmentation_library():
+    """Loads the shared library with the graph segmentation algorithm.
+
+    Returns:
+        _: ctypes library handle, or None if the library is not available.
+    """
+
+    global _segmentation_library
+
+    if _segmentation_library is None:
+        try:
+            library = ctypes.CDLL(segmentation_dir + "libsegment.so")
+        except OSError:
+            return None
+
+        # A library built from older sources does not provide the label interface
+        if not hasattr(library, "segment_labels"):
+            return None
+
+        library.segment_labels.restype = ctypes.POINTER(ctypes.c_uint8)
+        library.segment_labels.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_float,
+                                           ctypes.c_float, ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+        library.free_palette.restype = None
+        library.free_palette.argtypes = [ctypes.POINTER(ctypes.c_uint8)]
+        _segmentation_library = library
+
+    return _segmentation_library
+
+
+def segment_labels(img, sigma, k_const, minimum_segmentsize):
+    """Performs Felzenszwalb's efficient graph segmentation in memory.
+
+    Gives the same segments and colors as the segmentation executable,
+    without writing the input and output images to disk.
+
+    Args:
+        img: RGB numpy array with the image to segment.
+        sigma: Float used to smooth the image with a Gaussian kernel.
+        k_const: Threshold parameter of the segmentation algorithm.
+        minimum_segmentsize: Minimum segment size enforced by post-processing.
+
+    Returns:
+        labels: int32 numpy array (rows, columns) with the segment of each pixel,
+            or None if the segmentation library is not available.
+        palette: uint8 numpy array (segments, 3) with the RGB color of each segment.
+    """
+
+    library = load_segmentation_library()
+    if library is None:
+        return None, None
+
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    labels = np.empty(img.shape[:2], dtype=np.int32)
+    num_ccs = ctypes.c_int()
+    palette_ptr = library.segment_labels(img.ctypes.data, img.shape[1], img.shape[0], sigma,
+                                         k_const, minimum_segmentsize, labels.ctypes.data, ctypes.byref(num_ccs))
+    try:
+        palette = np.ctypeslib.as_array(palette_ptr, shape=(num_ccs.value, 3)).copy()
+    finally:
+        library.free_palette(palette_ptr)
+
+    return labels, palette
+
+
+def image_labels(segmented):
+    """Labels the segments of a segmented image, in which each segment has a different color.
+
+    Args:
+        segmented: Numpy array (rows, columns, 3) with the segmented image.
+
+    Returns:
+        labels: int32 numpy array (rows, columns) with the segment of each pixel.
+        palette: uint8 numpy array (segments, 3) with the color of each segment,
+            in the channel order of the image.
+    """
+
+    palette, labels = np.unique(segmented.reshape(-1, 3), axis=0, return_inverse=True)
+    return labels.reshape(segmented.shape[:2]).astype(np.int32), palette.astype(np.uint8)
+
 
 def check_image(slidepath):
     """Checks that Openslide can open the input slide file.
@@ -46,12 +162,13 @@ def check_image(slidepath):
         slide: String containing path to a slide.
 
     Returns:
-        None
+        slide: OpenSlide object with the slide, to be reused by PySlide
+            instead of opening the slide again.
     """
 
     # Check if the image can be read
     try:
-        _ = openslide.OpenSlide(slidepath)
+        slide = openslide.OpenSlide(slidepath)
 
         filename, file_extension = os.path.splitext(slidepath)
         file_extension = file_extension.lower()
@@ -62,18 +179,30 @@ def check_image(slidepath):
     except Exception:
         raise TypeError("Unsupported format, or file not found.")
 
+    return slide
+
 
-def downsample_image(slide, downsampling_factor, mode="numpy"):
+def downsample_image(slide, downsampling_factor, mode="numpy", max_memory=512 * 2**20):
     """Downsample an Openslide at a factor.
 
     Takes an OpenSlide SVS object and downsamples the original resolution
     (level 0) by the requested downsampling factor, using the most convenient
     image level. Returns an RGB numpy array or PIL image.
 
+    The image level is read and resized in horizontal strips, which are
+    written into a preallocated output array, so that the memory used to
+    read the level does not exceed max_memory (see resize_level). The result
+    is the same as resizing the whole level at once when the level size is a
+    multiple of the output size, and otherwise differs by one unit in some
+    pixels. If the level downsample is not an integer, OpenSlide interpolates
+    the strips that do not start at an exact level row, which can change some
+    output pixels by a few units.
+
     Args:
         slide: An OpenSlide object.
         downsampling_factor: Power of 2 to downsample the slide.
         mode: String, either "numpy" or "PIL" to define the output type.
+        max_memory: Approximate maximum number of bytes to use when reading a strip of the level.
 
     Returns:
         img: An RGB numpy array or PIL image, depending on the mode,
@@ -85,20 +214,165 @@ def downsample_image(slide, downsampling_factor, mode="numpy"):
     # Add a pseudofactor of 0.1 to ensure getting the next best level
     # (i.e. if 16x is chosen, avoid getting 4x instead of 16x)
     best_downsampling_level = slide.get_best_level_for_downsample(downsampling_factor + 0.1)
+    level_w, level_h = slide.level_dimensions[best_downsampling_level]
+    level_downsample = slide.level_downsamples[best_downsampling_level]
 
-    # Get the image at the requested scale
-    svs_native_levelimg = slide.read_region((0, 0), best_downsampling_level, slide.level_dimensions[best_downsampling_level])
-    target_size = tuple([int(x//downsampling_factor) for x in slide.dimensions])
-    img = svs_native_levelimg.resize(target_size)
+    # Read the level rows from the slide, at the exact level rows when the
+    # level downsample is an integer
+    def read_rows(start, end):
+        return slide.read_region((0, int(round(start * level_downsample))), best_downsampling_level, (level_w, end - start))
+
+    img = resize_level((level_w, level_h), read_rows, slide, downsampling_factor, max_memory)
 
     # By default, return a numpy array as RGB, otherwise, return PIL image
-    if mode == "numpy":
-        # Remove the alpha channel
-        img = np.array(img.convert("RGB"))
+    if mode != "numpy":
+        img = Image.fromarray(img, mode="RGB")
 
     return img, best_downsampling_level
 
 
+def resize_level(level_size, read_rows, slide, downsampling_factor, max_memory=512 * 2**20):
+    """Resize a slide level to a downsampling factor in horizontal strips.
+
+    The strips are written into a preallocated output array, so that the memory
+    used to hold the level rows does not exceed max_memory. Used by
+    downsample_image to resize the level read from the slide, and to resize
+    a level already in memory into the same image.
+
+    Args:
+        level_size: Tuple with the width and height of the level.
+        read_rows: Function that takes the first and end row of the level and
+            returns those rows as an RGB or RGBA PIL image.
+        slide: An OpenSlide object.
+        downsampling_factor: Power of 2 to downsample the slide.
+        max_memory: Approximate maximum number of bytes to use when resizing a strip of the level.
+
+    Returns:
+        img: An RGB numpy array at the requested downsampling_factor.
+    """
+
+    level_w, level_h = level_size
+
+    # Preallocate the image at the requested scale
+    target_size = tuple([int(x//downsampling_factor) for x in slide.dimensions])
+    img = np.empty((target_size[1], target_size[0], 3), dtype=np.uint8)
+
+    # Number of level rows per output row, and number of level rows needed at
+    # each side of a strip by the bicubic filter (plus a safety margin)
+    scale = level_h / target_size[1]
+    support = 2 * max(scale, 1.0) + 2
+
+    # Each level row is held as RGBA by OpenSlide, PIL and the resampling
+    # filter, so the strip height is bounded by the memory budget
+    bytes_per_row = level_w * 4 * 3
+    strip_rows = max(1, int((max_memory / bytes_per_row - 2 * support) / scale))
+
+    for out_start in range(0, target_size[1], strip_rows):
+        out_end = min(target_size[1], out_start + strip_rows)
+
+        # Level rows needed to produce the output rows of the strip
+        src_start = max(0, int(math.floor(out_start * scale - support)))
+        src_end = min(level_h, int(math.ceil(out_end * scale + support)))
+
+        # Resize the strip to the requested scale. The box maps the output rows
+        # to the same level rows as resizing the whole level would
+        strip = read_rows(src_start, src_end).resize((target_size[0], out_end - out_start),
+                                                     box=(0, out_start * scale - src_start, level_w, out_end * scale - src_start))
+
+        # Remove the alpha channel
+        img[out_start:out_end] = np.asarray(strip.convert("RGB"))
+
+    return img
+
+
+def downsample_window(slide, downsampling_factor, window):
+    """Downsample a window of an Openslide at a factor.
+
+    Reads only the pixels of the slide needed to produce a window of the image
+    returned by downsample_image at the same factor, from the same image level
+    and with the same mapping of output pixels to level pixels, so that the
+    window matches the corresponding region of the whole downsampled image
+    (up to the interpolation of OpenSlide at non-integer level downsamples).
+
+    Args:
+        slide: An OpenSlide object.
+        downsampling_factor: Power of 2 to downsample the slide.
+        window: Tuple (x0, y0, x1, y1) with the window in the coordinates of
+            the downsampled image (end exclusive).
+
+    Returns:
+        img: RGB numpy array with the window at the requested downsampling_factor.
+        bytes_read: Number of bytes of RGBA pixel data read from the slide.
+    """
+
+    best_downsampling_level = slide.get_best_level_for_downsample(downsampling_factor + 0.1)
+    level_w, level_h = slide.level_dimensions[best_downsampling_level]
+    level_downsample = slide.level_downsamples[best_downsampling_level]
+
+    # Scale of the level to the whole downsampled image, as in downsample_image
+    target_size = tuple([int(x//downsampling_factor) for x in slide.dimensions])
+    scale_x = level_w / target_size[0]
+    scale_y = level_h / target_size[1]
+    support_x = 2 * max(scale_x, 1.0) + 2
+    support_y = 2 * max(scale_y, 1.0) + 2
+
+    # Level pixels needed to produce the output pixels of the window
+    x0, y0, x1, y1 = window
+    src_x0 = max(0, int(math.floor(x0 * scale_x - support_x)))
+    src_x1 = min(level_w, int(math.ceil(x1 * scale_x + support_x)))
+    src_y0 = max(0, int(math.floor(y0 * scale_y - support_y)))
+    src_y1 = min(level_h, int(math.ceil(y1 * scale_y + support_y)))
+
+    region = slide.read_region((int(round(src_x0 * level_downsample)), int(round(src_y0 * level_downsample))),
+                               best_downsampling_level, (src_x1 - src_x0, src_y1 - src_y0))
+    region = region.resize((x1 - x0, y1 - y0), box=(x0 * scale_x - src_x0, y0 * scale_y - src_y0,
+                                                    x1 * scale_x - src_x0, y1 * scale_y - src_y0))
+
+    return np.asarray(region.convert("RGB")), (src_x1 - src_x0) * (src_y1 - src_y0) * 4
+
+
+# Pixels around a window that change the mask of its pixels, for each thresholding method
+threshold_mask_padding = {"otsu": 2, "adaptive": 5}
+
+
+def threshold_mask(img, method, otsu_threshold=None):
+    """Produces the mask of an RGB image with Otsu or adaptive thresholding.
+
+    Otsu thresholding blurs the grayscale image with a 5x5 Gaussian filter and
+    thresholds it at the value given by Otsu's method. Adaptive thresholding
+    uses a Gaussian-weighted sum of the 11x11 neighbourhood minus a constant
+    of 2 as the threshold of each pixel. Background pixels are set to 255.
+
+    Args:
+        img: RGB numpy array with the image.
+        method: String, either "otsu" or "adaptive".
+        otsu_threshold: Threshold to use instead of the one given by Otsu's
+            method (e.g. the threshold of the whole slide for a window of it).
+
+    Returns:
+        mask: Numpy array with the mask.
+        threshold: Threshold used by Otsu thresholding, or None for adaptive thresholding.
+    """
+
+    # Reverse the image to BGR and convert to grayscale
+    img = img[:, :, ::-1]
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    if method == "otsu":
+        # Remove noise using a Gaussian filter
+        img = cv2.GaussianBlur(img, (5,5), 0)
+
+        if otsu_threshold is None:
+            threshold, mask = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        else:
+            threshold, mask = cv2.threshold(img, otsu_threshold, 255, cv2.THRESH_BINARY)
+    else:
+        mask = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+        threshold = None
+
+    return mask, threshold
+
+
 def isPowerOfTwo(n):
     """Checks if a number is a power of two.
 
@@ -108,11 +382,67 @@ def isPowerOfTwo(n):
     return math.ceil(math.log2(n)) == math.floor(math.log2(n))
 
 
-def bg_color_identifier(mask, lines_pct, borders, corners):
-    """Background color identifier for graph TileGenerator.
+def draw_tile_crosses(img, preds_grid, cell_size, color=(0, 0, 255), width=3):
+    """Draws a cross over each selected cell of a grid, in place.
+
+    The crosses are lines from corner to corner of each cell, clipped to the
+    edges of the image. Since all the cells of the same size have the same
+    cross, each cross shape is rasterized once with PIL, and each of its
+    pixels is set at once on all the cells through a strided view of the
+    image. Drawing each line on the whole image gives the same crosses,
+    except for rounding of single pixels at the edges of the lines at some
+    positions.
 
     Args:
-        mask: A numpy array with the image mask.
+        img: RGB numpy array to draw on.
+        preds_grid: 2-D numpy array (rows, columns) of integers [0/1] indicating
+            the cells to draw a cross on.
+        cell_size: Integer with the size of the cells of the grid in the image.
+        color: RGB color of the crosses.
+        width: Integer with the line width of the crosses.
+    """
+
+    img_h, img_w = img.shape[:2]
+    n_rows, n_cols = preds_grid.shape
+    crosses = np.zeros((img_h, img_w), dtype=bool)
+
+    # If we reach the edge of the image, we only can draw until the edge pixel
+    cross_w = np.minimum(cell_size, img_w - np.arange(n_cols) * cell_size)
+    cross_h = np.minimum(cell_size, img_h - np.arange(n_rows) * cell_size)
+
+    for h in np.unique(cross_h):
+        for w in np.unique(cross_w):
+            cells = (preds_grid == 1) & (cross_h == h)[:, np.newaxis] & (cross_w == w)[np.newaxis, :]
+            if not cells.any():
+                continue
+
+            # Rasterize the cross, from top left to bottom right and from bottom left to top right
+            x0, y0 = width + max(0, -w), width + max(0, -h)
+            stamp = Image.new("L", (abs(w) + 2 * width + 1, abs(h) + 2 * width + 1))
+            draw = ImageDraw.Draw(stamp)
+            draw.line([(x0, y0), (x0 + w, y0 + h)], fill=255, width=width)
+            draw.line([(x0, y0 + h), (x0 + w, y0)], fill=255, width=width)
+
+            # A pixel at (dy, dx) from the corner of a cell falls in the strided view of the
+            # image that starts at (dy, dx) modulo the cell size, shifted by a number of cells
+            for dy, dx in zip(*np.nonzero(np.asarray(stamp))):
+                shift_y, start_y = divmod(int(dy) - y0, cell_size)
+                shift_x, start_x = divmod(int(dx) - x0, cell_size)
+                view = crosses[start_y::cell_size, start_x::cell_size]
+
+                r0, r1 = max(0, -shift_y), min(n_rows, view.shape[0] - shift_y)
+                c0, c1 = max(0, -shift_x), min(n_cols, view.shape[1] - shift_x)
+                if r0 < r1 and c0 < c1:
+                    view[r0 + shift_y:r1 + shift_y, c0 + shift_x:c1 + shift_x] |= cells[r0:r1, c0:c1]
+
+    img[crosses] = color
+
+
+def bg_label_identifier(labels, lines_pct, borders, corners):
+    """Background segment identifier for graph TileGenerator.
+
+    Args:
+        labels: A numpy array (rows, columns) with the segment label of each pixel.
         lines_pct: A percentage [0, 100] indicating the percentage of the
             image (starting from the edges) to consider to define the background.
         borders: A string composed of four numbers [0,1] indicating which
@@ -123,142 +453,201 @@ def bg_color_identifier(mask, lines_pct, borders, corners):
             is top left, bottom left, bottom right, top right.
 
     Returns:
-        bg_color: A numpy array with the background color.
-        bord_unique: Returns other candidate colors for the background.
+        bg_labels: A numpy array with the labels of the background segments.
     """
-    bord = np.empty((1, 3))
-    
+
     # Transform image percentages into number of lines
-    lines_topbottom = round(mask.shape[0] * (lines_pct/100))
-    lines_leftright = round(mask.shape[1] * (lines_pct/100))
+    lines_topbottom = round(labels.shape[0] * (lines_pct/100))
+    lines_leftright = round(labels.shape[1] * (lines_pct/100))
+    rows, cols = labels.shape
 
+    windows = []
     if borders != '0000':
         if borders[0] == '1':
-            top = mask[:lines_topbottom, :, :]
-            a = np.unique(top.reshape(-1, top.shape[2]), axis=0)
-            bord = np.concatenate((bord, a), axis=0)
+            windows.append(labels[:lines_topbottom, :])
         if borders[2] == '1':
-            bottom = mask[(mask.shape[0] - lines_topbottom):mask.shape[0], :, :]
-            c = np.unique(bottom.reshape(-1, bottom.shape[2]), axis=0)
-            bord = np.concatenate((bord, c), axis=0)
+            windows.append(labels[(rows - lines_topbottom):rows, :])
         if borders[1] == '1':
-            left = mask[:, :lines_leftright, :]
-            b = np.unique(left.reshape(-1, left.shape[2]), axis=0)
-            bord = np.concatenate((bord, b), axis=0)
+            windows.append(labels[:, :lines_leftright])
         if borders[3] == '1':
-            right = mask[:, (mask.shape[1] - lines_leftright):mask.shape[1], :]
-            d = np.unique(right.reshape(-1, right.shape[2]), axis=0)
-            bord = np.concatenate((bord, d), axis=0)
-
-        bord = bord[1:, :]
-        bord_unique = np.unique(bord.reshape(-1, bord.shape[1]), axis=0)
-        bg_color = bord_unique[0]
+            windows.append(labels[:, (cols - lines_leftright):cols])
 
     if corners != '0000':
         if corners[0] == '1':
-            top_left = mask[:lines_topbottom, :lines_leftright, :]
-            a = np.unique(top_left.reshape(-1, top_left.shape[2]), axis=0)
-            bord = np.concatenate((bord, a), axis=0)
+            windows.append(labels[:lines_topbottom, :lines_leftright])
         if corners[1] == '1':
-            bottom_left = mask[(mask.shape[0] -
-                                lines_topbottom):mask.shape[0], :lines_leftright, :]
-            b = np.unique(bottom_left.reshape(-1, bottom_left.shape[2]),
-                            axis=0)
-            bord = np.concatenate((bord, b), axis=0)
+            windows.append(labels[(rows - lines_topbottom):rows, :lines_leftright])
         if corners[2] == '1':
-            bottom_right = mask[(mask.shape[0] - lines_topbottom):mask.shape[0], (
-                mask.shape[1] - lines_leftright):mask.shape[1], :]
-            c = np.unique(bottom_right.reshape(-1, bottom_right.shape[2]),
-                            axis=0)
-            bord = np.concatenate((bord, c), axis=0)
+            windows.append(labels[(rows - lines_topbottom):rows, (cols - lines_leftright):cols])
         if corners[3] == '1':
-            top_right = mask[:lines_topbottom, (mask.shape[1] -
-                                                lines_leftright):mask.shape[1], :]
-            d = np.unique(top_right.reshape(-1, top_right.shape[2]),
-                            axis=0)
-            bord = np.concatenate((bord, d), axis=0)
+            windows.append(labels[:lines_topbottom, (cols - lines_leftright):cols])
+
+    return np.unique(np.concatenate([window.ravel() for window in windows]))
+
+
+def graph_background(labels, palette, bg_labels):
+    """Builds the mask of the graph TileGenerator from the segment labels.
+
+    The color of the background is the smallest color of the background
+    segments, and every background segment takes that color. The mask holds
+    the number of channels [0-3] of each pixel that match the background
+    color, as a color mask is evaluated by the graph selector, and is built
+    with a single lookup of the label of each pixel.
+
+    Args:
+        labels: A numpy array (rows, columns) with the segment label of each pixel.
+        palette: A numpy array (segments, 3) with the color of each segment.
+        bg_labels: A numpy array with the labels of the background segments.
+
+    Returns:
+        mask: uint8 numpy array (rows, columns) with the number of background channels of each pixel.
+        bg_color: A numpy array with the background color.
+    """
+
+    bg_colors = np.unique(palette[bg_labels], axis=0)
+    bg_color = bg_colors[0]
+
+    # Segments with a background color are background, even if they do not touch the borders
+    def packed(colors):
+        colors = colors.astype(np.int64)
+        return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+
+    lut = np.sum(palette == bg_color, axis=1).astype(np.uint8)
+    lut[np.isin(packed(palette), packed(bg_colors))] = 3
 
-        bord = bord[1:, :]
-        bord_unique = np.unique(bord.reshape(-1, bord.shape[1]), axis=0)
-        bg_color = bord_unique[0]
+    return lut[labels], bg_color
 
-    return bg_color, bord_unique
 
+def selector_grid(mask, mask_patch_size, thres, bg_color, method, return_foreground=False):
+    """Vectorized tile selector for a whole grid of mask tiles.
 
-def selector(mask_patch, thres, bg_color, method):
-    """Generic method to redirect a mask patch to a specialized tile selector.
+    Splits the mask in a grid of mask_patch_size x mask_patch_size cells
+    (the cells in the last row and column may be smaller) and evaluates the
+    foreground content of all of them at once. A tile is selected when the
+    proportion of background in its cell is at most 1 - thres.
 
     Args:
-        mask_patch: Numpy array for the current mask tile.
+        mask: Numpy array (grayscale or RGB) with the mask for the slide. For
+            the graph method, it can also hold the number of background channels
+            of each pixel (see graph_background).
+        mask_patch_size: Integer indicating the size of a tile in the mask.
         thres: Float indicating the minimum foreground content [0, 1] in
             the patch to select the tile.
         bg_color: Numpy array with the background color for the mask.
         method: String indicating the TileGenerator method
+        return_foreground: If True, also return the foreground content of each tile.
 
     Returns:
-        _: Integer [0/1] indicating if the tile has been selected or not.
+        preds: 2-D numpy array (rows, columns) of integers [0/1] indicating
+            if each tile has been selected or not.
+        foreground: 2-D numpy array (rows, columns) with the foreground content
+            [0, 1] of each tile. Only returned if return_foreground is True.
     """
 
-    if method == "graph":
-        return selector_graph(mask_patch, thres, bg_color)
-    elif method in ["otsu", "adaptive"]:
-        return selector_otsu(mask_patch, thres, bg_color)
-    else: # Otsu selector will be the default for non-implemented TileGenerators
-        return selector_otsu(mask_patch, thres, bg_color)
+    # Count the background matches per pixel: the graph selector counts
+    # every channel separately, while the otsu selector requires all of them.
+    # Graph masks built from the segment labels already hold the count
+    if method == "graph" and mask.ndim == 2:
+        bg = mask
+        n_channels = 3
+    elif method == "graph":
+        bg = np.sum(mask == bg_color, axis=2, dtype=np.uint8)
+        n_channels = 3
+    else:
+        # Grayscale masks are compared against every channel of the background color
+        if mask.ndim == 2:
+            mask = mask[:, :, np.newaxis]
+        bg = np.all(mask == bg_color, axis=2).astype(np.uint8)
+        n_channels = 1
+
+    # Sum the background counts of each grid cell with a segmented reduction
+    row_starts = np.arange(0, bg.shape[0], mask_patch_size)
+    col_starts = np.arange(0, bg.shape[1], mask_patch_size)
+    bg_counts = np.add.reduceat(bg, row_starts, axis=0, dtype=np.int64)
+    bg_counts = np.add.reduceat(bg_counts, col_starts, axis=1, dtype=np.int64)
+
+    # Number of pixels of each cell, taking into account the ragged edges
+    cell_h = np.diff(np.append(row_starts, bg.shape[0]))
+    cell_w = np.diff(np.append(col_starts, bg.shape[1]))
+    cell_sizes = np.outer(cell_h, cell_w) * n_channels
 
+    bg_proportion = bg_counts / cell_sizes
+    preds = (bg_proportion <= (1 - thres)).astype(int)
 
-def selector_graph(mask_patch, thres, bg_color):
-    """Specialized selector for graph TileGenerator.
+    if return_foreground:
+        return preds, 1 - bg_proportion
+    return preds
 
-    Determines if a mask tile contains a certain percentage of foreground.
+
+def foreground_integral(mask, bg_color):
+    """Integral image of the foreground of a mask.
 
     Args:
-        mask_patch: Numpy array for the current mask tile.
-        thres: Float indicating the minimum foreground content [0, 1] in
-            the patch to select the tile.
+        mask: Numpy array (grayscale or RGB) with the mask for the slide.
         bg_color: Numpy array with the background color for the mask.
 
     Returns:
-        _: Integer [0/1] indicating if the tile has been selected or not.
+        integral: Numpy array with the number of foreground pixels above and to
+            the left of each pixel, with one more row and column than the mask.
     """
 
-    bg = mask_patch == bg_color
+    if mask.ndim == 2:
+        mask = mask[:, :, np.newaxis]
+    fg = np.logical_not(np.all(mask == bg_color, axis=2)).astype(np.uint8)
 
-    # Flatten the check across the three channels
-    bg_proportion = np.sum(bg) / bg.size
+    return cv2.integral(fg, sdepth=cv2.CV_32S)
 
-    if bg_proportion <= (1 - thres):
-        output = 1
-    else:
-        output = 0
 
-    return output
+def window_fractions(integral, xs, ys, window):
+    """Foreground fraction of window x window tiles of a mask.
+
+    Args:
+        integral: Integral image of the foreground of the mask (see foreground_integral).
+        xs, ys: Numpy arrays with the mask coordinates of the top left corner of
+            the tiles, which are broadcast against each other.
+        window: Integer indicating the size of a tile in the mask.
+
+    Returns:
+        _: Numpy array with the foreground fraction [0, 1] of each tile.
+    """
 
+    counts = (integral[ys + window, xs + window] - integral[ys, xs + window] -
+              integral[ys + window, xs] + integral[ys, xs])
+    return counts.astype(np.float32) / window**2
 
-def selector_otsu(mask_patch, thres, bg_color):
-    """Specialized selector for otsu or adaptive TileGenerator.
 
-    Determines if a mask tile contains a certain percentage of foreground.
+def foreground_index(integral, window, stride, thres):
+    """Index of the positions of a mask where a tile has enough foreground.
+
+    The foreground fraction of a window x window tile is evaluated with an
+    integral image at every stride pixels of the mask, as selector_grid
+    does for the tiles of a grid.
 
     Args:
-        mask_patch: Numpy array for the current mask tile.
-        thres: Float indicating the minimum foreground content [0, 1] in
-            the patch to select the tile.
-        bg_color: Numpy array with the background color for the mask.
+        integral: Integral image of the foreground of the mask (see foreground_integral).
+        window: Integer indicating the size of a tile in the mask.
+        stride: Integer indicating the spacing of the evaluated positions in the mask.
+        thres: Float indicating the minimum foreground content [0, 1] of a tile.
 
     Returns:
-        _: Integer [0/1] indicating if the tile has been selected or not.
+        positions: (N, 2) numpy array with the (x, y) mask coordinates of the top left
+            corner of the tiles with some foreground and at least thres of it.
+        fractions: (N,) numpy array with the foreground fraction of each tile.
     """
 
-    bg = np.all(mask_patch == bg_color, axis=2)
-    bg_proportion = np.sum(bg) / bg.size
+    mask_h, mask_w = integral.shape[0] - 1, integral.shape[1] - 1
+    if window > mask_h or window > mask_w:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.float32)
 
-    if bg_proportion <= (1 - thres):
-        output = 1
-    else:
-        output = 0
+    # Foreground fraction of the tile at each evaluated position
+    ys = np.arange(0, mask_h - window + 1, stride)
+    xs = np.arange(0, mask_w - window + 1, stride)
+    fractions = window_fractions(integral, xs[np.newaxis, :], ys[:, np.newaxis], window)
+
+    rows, cols = np.nonzero((fractions > 0) & (fractions >= thres))
+    positions = np.stack([xs[cols], ys[rows]], axis=1)
 
-    return output
+    return positions, fractions[rows, cols]
 
 
 def clean(slide):
@@ -272,7 +661,11 @@ def clean(slide):
     """
 
     if slide.method == "graph" or slide.method == "graphtestmode":
-        if not slide.save_mask:
-            os.remove(slide.img_outpath + "segmented_" + slide.sample_id + ".ppm")
-        if not slide.save_edges:
-            os.remove(slide.img_outpath + "edges_" + slide.sample_id + ".ppm")
\ No newline at end of file
+        segmented_file = slide.img_outpath + "segmented_" + slide.sample_id + ".ppm"
+        edges_file = slide.img_outpath + "edges_" + slide.sample_id + ".ppm"
+
+        # The files are only written when the segmentation executable is used or they are requested
+        if not slide.save_mask and os.path.isfile(segmented_file):
+            os.remove(segmented_file)
+        if not slide.save_edges and os.path.isfile(edges_file):
+            os.remove(edges_file)
\ No newline at end of file